@@ -1,5 +1,5 @@
 import argparse
-from typing import Tuple, Type
+from typing import Literal, Tuple, Type
 
 from pydantic import BaseModel
 from pydantic_settings import (
@@ -10,6 +10,14 @@ from pydantic_settings import (
 )
 
 
+class TransportSettings(BaseModel):
+    # https: TLS over TCP, uds: plain HTTP over a Unix domain socket, asgi: an ASGI application in this process
+    type: Literal['https', 'uds', 'asgi'] = 'https'
+    socket_path: str | None = None
+    # module:attribute of the ASGI application
+    app: str | None = None
+
+
 class AttachedKmes(BaseModel):
     url: str
     kme_id: str
@@ -18,6 +26,9 @@ class AttachedKmes(BaseModel):
     sae_cert: str
     sae_key: str
     distance: int
+    # Largest key in bits the KME hands out, max_key_size of the settings when not set
+    max_key_size: int | None = None
+    transport: TransportSettings = TransportSettings()
 
 
 class AttachedSaes(BaseModel):
@@ -30,6 +41,97 @@ class AttachedTrustedNodes(BaseModel):
     id: str
     cert: str
     key: str
+    transport: TransportSettings = TransportSettings()
+    # Routing area of the trusted node, the area of this trusted node when not set
+    area: str | None = None
+
+
+class ProfilingSettings(BaseModel):
+    output_dir: str = 'profiles'
+    # Requests sent with this value in the X-Profile header are profiled
+    token: str | None = None
+    # Seconds between the stack samples of a profiled request
+    sampling_interval: float = 0.01
+    # Sample the whole node continuously at this interval, disabled when not set
+    continuous_interval: float | None = None
+    continuous_dump_interval: float = 60
+
+
+class LoggingSettings(BaseModel):
+    # Level of the relay events
+    level: str = 'INFO'
+    # Share of the per key events that are logged
+    key_event_sample_rate: float = 1.0
+    # Relay events are written to stdout when not set
+    file: str | None = None
+
+
+class CircuitBreakerSettings(BaseModel):
+    # Number of recent calls to a peer that its failure rate is computed over
+    window: int = 10
+    min_calls: int = 3
+    failure_threshold: float = 0.5
+    # Seconds an open circuit rejects calls before letting a trial call through
+    open_duration: float = 10
+    probe_interval: float = 2
+    probe_timeout: float = 2
+
+
+class DeadlineSettings(BaseModel):
+    # Seconds an SAE request may take, across all the hops of its path
+    budget: float = 10
+    # Bounds of the timeout of a single call to a KME or trusted node
+    min_timeout: float = 0.5
+    max_timeout: float = 5
+    # A peer that answered at least min_samples of the last latency_window calls is given latency_factor times the
+    # latency_percentile of them to answer
+    latency_window: int = 100
+    latency_percentile: float = 0.99
+    latency_factor: float = 3
+    min_samples: int = 10
+    # Seconds of the budget each hop keeps for sending back its answer
+    hop_margin: float = 0.05
+
+
+class AsyncRelaySettings(BaseModel):
+    # enc_keys returns once the first hop accepted the keys, the rest of the path completes in the background
+    enabled: bool = False
+    # Seconds dec_keys waits for keys that are still on their way to this trusted node, when enabled
+    dec_keys_wait: float = 2
+
+
+class IdempotencySettings(BaseModel):
+    # Seconds the results of ext_keys and void are kept for, to answer retries of them. They hold key material, so
+    # this is kept short
+    ttl: float = 10
+    max_entries: int = 10000
+    # Times an ext_keys or void call is sent again after a connection error or timeout, waiting backoff seconds
+    # before the first retry and twice as long before each next one
+    retries: int = 2
+    backoff: float = 0.05
+
+
+class WarmUpSettings(BaseModel):
+    # Connect to the peers, discover the routes and prime the key buffers before reporting ready
+    enabled: bool = True
+    # QKD keys fetched into the buffer of each link, 0 to leave the buffers empty
+    prime_keys: int = 0
+    # Seconds after which the node reports ready even if the warm-up is not done yet
+    timeout: float = 30
+
+
+class PreDistributionSettings(BaseModel):
+    enabled: bool = False
+    # Seconds between two rounds of learning the demand and topping up the reserves
+    interval: float = 1
+    # Weight of the last round in the moving average of the demand
+    smoothing: float = 0.3
+    # Seconds of the expected demand each reserve should cover
+    lead_time: float = 10
+    # Most keys held in reserve per master SAE, slave SAE and key size
+    max_reserve: int = 100
+    # Seconds a key is held in reserve, it is voided at both ends when it was not claimed by then
+    max_age: float = 300
 
 
 class Settings(BaseSettings):
@@ -44,6 +146,8 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(json_file=_args.settings, json_file_encoding='utf-8')
 
     id: str
+    # Routing area, the trusted nodes only walk the network within their area
+    area: str | None = None
 
     server_cert_file: str
     server_key_file: str
@@ -59,6 +163,28 @@ class Settings(BaseSettings):
     attached_saes: list[AttachedSaes]
     attached_trusted_nodes: list[AttachedTrustedNodes]
 
+    reload_on_settings_change: bool = False
+    max_concurrent_relays: int = 8
+    # Maximum number of additional slave SAEs a key can be delivered to at once
+    max_sae_id_count: int = 8
+    traffic_capture_file: str | None = None
+    # Also serve on this Unix domain socket, for the trusted nodes on the same host
+    unix_socket: str | None = None
+    # Seconds the discovered routes are reused for by the status endpoint
+    route_cache_ttl: float = 5
+    # Seconds the key availability of a link is reused for, when balancing over several links to a trusted node
+    link_status_ttl: float = 1
+    # Path cost added per key on its way to a trusted node, when choosing between the ones the same SAE is attached to
+    replica_load_weight: float = 1
+    profiling: ProfilingSettings = ProfilingSettings()
+    circuit_breaker: CircuitBreakerSettings = CircuitBreakerSettings()
+    logging: LoggingSettings = LoggingSettings()
+    predistribution: PreDistributionSettings = PreDistributionSettings()
+    deadline: DeadlineSettings = DeadlineSettings()
+    async_relay: AsyncRelaySettings = AsyncRelaySettings()
+    warm_up: WarmUpSettings = WarmUpSettings()
+    idempotency: IdempotencySettings = IdempotencySettings()
+
     @classmethod
     def settings_customise_sources(
             cls,
@@ -69,3 +195,22 @@ class Settings(BaseSettings):
             file_secret_settings: PydanticBaseSettingsSource,
     ) -> Tuple[PydanticBaseSettingsSource, ...]:
         return init_settings, env_settings, dotenv_settings, JsonConfigSettingsSource(settings_cls)
+
+
+_settings: Settings | None = None
+
+
+def get_settings() -> Settings:
+    global _settings
+
+    if _settings is None:
+        _settings = Settings()
+
+    return _settings
+
+
+def replace_settings(settings: Settings):
+    # A single reference swap, so requests see either the old or the new settings, never a mix of both
+    global _settings
+
+    _settings = settings
@@ -1,32 +1,28 @@
-from functools import lru_cache
-from typing import Union
+from typing import Annotated, Union
 
-import OpenSSL
-from OpenSSL.crypto import X509
-from fastapi import HTTPException, Request
+from fastapi import Depends, HTTPException, Request
 
-from app.config import Settings
+from app.config import get_settings
+from app.internal.certificates import get_sae_identity
+from app.internal.client_identity import SCOPE_KEY, ClientIdentity
 from app.internal.lifecycle import Lifecycle
 from app.models.kme_sae_ids import KmeSaeIds
 
 
-def _get_common_name_from_certificate(certificate: X509) -> str:
-    common_name = tuple(filter(lambda x: x[0] == b'CN', certificate.get_subject().get_components()))
+def get_client_identity(request: Request) -> ClientIdentity:
+    # Parsed once per TLS connection by ClientIdentityProtocol
+    identity = request.scope.get(SCOPE_KEY)
 
-    return '' if len(common_name) == 0 else common_name[0][1].decode('utf-8')
+    if identity is None:
+        raise HTTPException(status_code=400, detail='A client certificate is required')
 
+    return identity
 
-def _get_client_certificate(request: Request) -> tuple[int, str]:
-    client_cert_binary = request.scope['transport'].get_extra_info('ssl_object').getpeercert(True)
-    client_cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, client_cert_binary)
 
-    return client_cert.get_serial_number(), _get_common_name_from_certificate(client_cert)
-
-
-async def validate_sae_id_from_tls_cert(request: Request):
+async def validate_sae_id_from_tls_cert(client: Annotated[ClientIdentity, Depends(get_client_identity)]):
     settings = get_settings()
 
-    request_cert_serial_number, request_sae_id = _get_client_certificate(request)
+    request_cert_serial_number, request_sae_id = client
 
     if len(settings.attached_saes) == 0:
         raise HTTPException(status_code=400, detail='There are no attached SAEs configured')
@@ -34,13 +30,10 @@ async def validate_sae_id_from_tls_cert(request: Request):
     cert_found = False
 
     for sae in settings.attached_saes:
-        cert = OpenSSL.crypto.load_certificate(
-            type=OpenSSL.crypto.FILETYPE_PEM,
-            buffer=open(sae.sae_cert, 'rb').read()
-        )
+        if sae.sae_id != request_sae_id:
+            continue
 
-        cert_sae_id = _get_common_name_from_certificate(cert)
-        cert_serial_number = cert.get_serial_number()
+        cert_serial_number, cert_sae_id = get_sae_identity(sae)
 
         if (
                 request_sae_id == sae.sae_id and
@@ -105,10 +98,5 @@ def get_kme_and_sae_ids_from_master_id(master_sae_id: str) -> KmeSaeIds:
     )
 
 
-@lru_cache
-def get_settings():
-    return Settings()
-
-
 def get_lifecycle(request: Request) -> Union[Lifecycle, None]:
     return request.app.lifecycle
@@ -0,0 +1,64 @@
+import os
+
+import OpenSSL
+from OpenSSL.crypto import X509
+
+from app.config import AttachedSaes
+
+# Parsed (serial number, common name) of the attached SAE certificates, keyed by file path and modification time
+_sae_identities: dict[tuple[str, int], tuple[int, str]] = {}
+
+
+def get_common_name_from_certificate(certificate: X509) -> str:
+    common_name = tuple(filter(lambda x: x[0] == b'CN', certificate.get_subject().get_components()))
+
+    return '' if len(common_name) == 0 else common_name[0][1].decode('utf-8')
+
+
+def load_certificate_identity(cert_file: str) -> tuple[int, str]:
+    cert = OpenSSL.crypto.load_certificate(
+        type=OpenSSL.crypto.FILETYPE_PEM,
+        buffer=open(cert_file, 'rb').read()
+    )
+
+    return cert.get_serial_number(), get_common_name_from_certificate(cert)
+
+
+def _identity_cache_key(cert_file: str) -> tuple[str, int]:
+    return cert_file, os.stat(cert_file).st_mtime_ns
+
+
+def get_sae_identity(sae: AttachedSaes) -> tuple[int, str]:
+    cache_key = _identity_cache_key(sae.sae_cert)
+
+    identity = _sae_identities.get(cache_key)
+
+    if identity is None:
+        identity = load_certificate_identity(sae.sae_cert)
+        _sae_identities[cache_key] = identity
+
+    return identity
+
+
+def refresh_sae_identities(attached_saes: list[AttachedSaes]) -> list[str]:
+    """
+    Rebuilds the SAE certificate cache for the given SAEs, re-parsing only those certificates that are new or have
+    changed on disk. Returns the changed certificate files.
+    """
+    global _sae_identities
+
+    identities = {}
+    changed = []
+
+    for sae in attached_saes:
+        cache_key = _identity_cache_key(sae.sae_cert)
+
+        if cache_key in _sae_identities:
+            identities[cache_key] = _sae_identities[cache_key]
+        else:
+            identities[cache_key] = load_certificate_identity(sae.sae_cert)
+            changed.append(sae.sae_cert)
+
+    _sae_identities = identities
+
+    return changed
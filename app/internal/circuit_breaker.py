@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import deque
+
+import requests
+
+from app.config import CircuitBreakerSettings, Settings, get_settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling a peer that is known to be down, handled like any other connection error."""
+
+
+class CircuitBreaker:
+    def __init__(self, peer_id: str, settings: CircuitBreakerSettings):
+        self.peer_id = peer_id
+        self.settings = settings
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+
+        # True for a successful call, False for a failed one
+        self._outcomes: deque[bool] = deque(maxlen=settings.window)
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def failure_rate(self) -> float:
+        if len(self._outcomes) == 0:
+            return 0.0
+
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def _close(self):
+        self.state = CLOSED
+        self._outcomes.clear()
+        self._trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.settings.open_duration:
+                self.state = HALF_OPEN
+
+            # Only a single trial call is let through, until it shows whether the peer has recovered
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+
+                return True
+
+            return self.state == CLOSED
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self._close()
+
+            self._outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._open()
+
+                return
+
+            self._outcomes.append(False)
+
+            if len(self._outcomes) >= self.settings.min_calls and self.failure_rate() >= self.settings.failure_threshold:
+                self._open()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(peer_id: str) -> CircuitBreaker:
+    breaker = _breakers.get(peer_id)
+
+    if breaker is None:
+        breaker = _breakers.setdefault(peer_id, CircuitBreaker(peer_id, get_settings().circuit_breaker))
+
+    return breaker
+
+
+def get_circuit_breakers() -> list[CircuitBreaker]:
+    return list(_breakers.values())
+
+
+def get_open_circuits() -> set[str]:
+    return {breaker.peer_id for breaker in _breakers.values() if breaker.state != CLOSED}
+
+
+def prune_circuit_breakers(settings: Settings):
+    """Forgets the circuits of removed peers and applies the (possibly changed) circuit breaker settings."""
+    peer_ids = {kme.kme_id for kme in settings.attached_kmes} | {node.id for node in settings.attached_trusted_nodes}
+
+    for peer_id, breaker in list(_breakers.items()):
+        if peer_id not in peer_ids:
+            del _breakers[peer_id]
+        elif breaker.settings != settings.circuit_breaker:
+            _breakers[peer_id] = CircuitBreaker(peer_id, settings.circuit_breaker)
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import socket
+import struct
+from typing import NamedTuple
+
+import OpenSSL
+from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol
+
+from app.internal.certificates import get_common_name_from_certificate
+
+SCOPE_KEY = 'client_identity'
+
+# "<serial number>:<common name>" of the caller, only trusted on the Unix socket from a process of the same user
+IDENTITY_HEADER = 'x-client-identity'
+
+
+class ClientIdentity(NamedTuple):
+    serial_number: int
+    common_name: str
+
+
+def parse_client_identity(transport: asyncio.Transport) -> ClientIdentity | None:
+    ssl_object = transport.get_extra_info('ssl_object')
+
+    if ssl_object is None:
+        return None
+
+    client_cert_binary = ssl_object.getpeercert(True)
+
+    if client_cert_binary is None:
+        return None
+
+    client_cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, client_cert_binary)
+
+    return ClientIdentity(client_cert.get_serial_number(), get_common_name_from_certificate(client_cert))
+
+
+def is_local_peer(transport: asyncio.Transport) -> bool:
+    sock = transport.get_extra_info('socket')
+
+    if sock is None or sock.family != socket.AF_UNIX or not hasattr(socket, 'SO_PEERCRED'):
+        return False
+
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+
+    return uid == os.getuid()
+
+
+def _parse_identity_header(headers: list[tuple[bytes, bytes]]) -> ClientIdentity | None:
+    for name, value in headers:
+        if name == IDENTITY_HEADER.encode():
+            serial_number, _, common_name = value.decode('latin-1').partition(':')
+
+            return ClientIdentity(int(serial_number), common_name)
+
+    return None
+
+
+class ClientIdentityProtocol(HttpToolsProtocol):
+    """
+    HTTP protocol that parses the client certificate once per TLS connection, when the handshake is done, and hands
+    the identity to every request sent over the connection in its scope. On the Unix socket, the identity is taken
+    from the header of each request instead.
+    """
+
+    client_identity: ClientIdentity | None = None
+    local_peer = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+
+        self.client_identity = parse_client_identity(transport)
+        self.local_peer = is_local_peer(transport)
+
+    def on_headers_complete(self):
+        if self.local_peer:
+            # The Unix socket of the same user is as private as TLS, so the application does not redirect either
+            self.scope['scheme'] = 'https'
+
+            try:
+                self.scope[SCOPE_KEY] = _parse_identity_header(self.headers)
+            except ValueError:
+                self.scope[SCOPE_KEY] = None
+        else:
+            self.scope[SCOPE_KEY] = self.client_identity
+
+        super().on_headers_complete()
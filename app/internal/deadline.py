@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+import requests
+
+from app.config import DeadlineSettings, Settings
+
+
+class DeadlineExceededError(requests.exceptions.Timeout):
+    """Raised instead of calling a peer when what is left of the budget of the request would not be enough."""
+
+
+class Deadline:
+    """
+    Point in time by which a request has to be answered, across all the hops of its path. It travels between the
+    trusted nodes as the budget (in seconds) that is left, so their clocks do not have to agree.
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def next_hop_budget(self, settings: DeadlineSettings) -> float:
+        # The next hop gives up a bit earlier than this one, so its answer still arrives in time
+        return max(0.0, self.remaining() - settings.hop_margin)
+
+
+class PeerLatencies:
+    def __init__(self, window: int):
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percentile: float, min_samples: int) -> float | None:
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+
+            samples = sorted(self._samples)
+
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+
+_latencies: dict[str, PeerLatencies] = {}
+_latencies_lock = threading.Lock()
+
+
+def get_peer_latencies(peer_id: str, settings: DeadlineSettings) -> PeerLatencies:
+    latencies = _latencies.get(peer_id)
+
+    if latencies is None:
+        with _latencies_lock:
+            latencies = _latencies.setdefault(peer_id, PeerLatencies(settings.latency_window))
+
+    return latencies
+
+
+def prune_peer_latencies(settings: Settings):
+    peer_ids = {kme.kme_id for kme in settings.attached_kmes} | {node.id for node in settings.attached_trusted_nodes}
+
+    with _latencies_lock:
+        for peer_id in [peer_id for peer_id in _latencies if peer_id not in peer_ids]:
+            del _latencies[peer_id]
+
+
+def get_timeout(peer_id: str, deadline: Deadline | None, settings: DeadlineSettings) -> tuple[float, bool]:
+    """
+    Returns the timeout of a call to the peer, and whether it was cut short by the deadline. A peer that has answered
+    enough calls gets latency_factor times its latency percentile, bounded by min_timeout and max_timeout.
+    """
+    timeout = settings.max_timeout
+    latency = get_peer_latencies(peer_id, settings).percentile(settings.latency_percentile, settings.min_samples)
+
+    if latency is not None:
+        timeout = min(timeout, max(settings.min_timeout, settings.latency_factor * latency))
+
+    if deadline is None:
+        return timeout, False
+
+    remaining = deadline.remaining()
+
+    # Not even a usual answer of the peer would arrive in time, so it is not worth calling
+    if remaining <= 0 or (latency is not None and remaining < latency):
+        raise DeadlineExceededError(f'{remaining:.3f} s left of the budget, not enough to call {peer_id}')
+
+    return min(timeout, remaining), remaining < timeout
@@ -1,33 +1,72 @@
 import logging
+import threading
+import time
 
 import requests
 from fastapi.encoders import jsonable_encoder
 
-from app.dependencies import get_settings
+from app.config import AttachedTrustedNodes, Settings, get_settings
+from app.internal.circuit_breaker import CircuitOpenError
+from app.internal.requestor import post_request
 from app.models.discover_requests import WalkedNode
 
 logger = logging.getLogger('uvicorn.error')
 
+# SAE ID -> ID of the (remote) trusted node it is attached to (None until first discovered), and the time the routes
+# were discovered at. Expired routes are still served while they are refreshed in the background
+_routes: dict[str, str] | None = None
+_routes_discovered_at: float | None = None
+_routes_refreshing = False
+_routes_lock = threading.Lock()
+_first_discovery_lock = threading.Lock()
+
+# (area, areas left out of the summaries) -> trusted nodes of the area, and the time they were discovered at
+_area_views: dict[tuple[str | None, frozenset[str | None]], tuple[list[WalkedNode], float]] = {}
+_area_views_lock = threading.Lock()
+
+
+def get_trusted_node_area(settings: Settings, trusted_node: AttachedTrustedNodes) -> str | None:
+    return settings.area if trusted_node.area is None else trusted_node.area
+
+
+def get_neighbour_areas(settings: Settings) -> set[str | None]:
+    """Returns the areas other than its own this trusted node borders on."""
+    return {get_trusted_node_area(settings, node) for node in settings.attached_trusted_nodes} - {settings.area}
+
 
 def discover_trusted_nodes(
-        walked_nodes: list[WalkedNode] = [],
-        distance: int = 0
+        walked_nodes: list[WalkedNode] | None = None,
+        distance: int = 0,
+        area: str | None = None,
+        summarized_areas: list[str | None] | None = None
 ) -> list[WalkedNode]:
+    """
+    Walks the trusted nodes of the given area (the area of this trusted node by default). Only the nodes of the area
+    are returned in full, a border node adds the SAEs it can reach in the other areas as summarized_sae_ids.
+    """
     settings = get_settings()
 
-    walked_nodes = walked_nodes
+    walked_nodes = [] if walked_nodes is None else walked_nodes
+    area = settings.area if area is None else area
+    summarized_areas = [] if summarized_areas is None else summarized_areas
 
     default_node = WalkedNode(
         trusted_node_id=settings.id,
         kme_ids=list(map(lambda kme: kme.kme_id, settings.attached_kmes)),
         sae_ids=list(map(lambda sae: sae.sae_id, settings.attached_saes)),
         trusted_node_ids=list(map(lambda node: node.id, settings.attached_trusted_nodes)),
-        distance=distance
+        distance=distance,
+        area=area,
+        summarized_sae_ids=_summarize_other_areas(settings, area, summarized_areas)
     )
 
     walked_nodes.append(default_node)
 
     for trusted_node in settings.attached_trusted_nodes:
+        # The other areas are only known by the summaries of their border nodes
+        if get_trusted_node_area(settings, trusted_node) != area:
+            continue
+
         # Prevent infinite loops (dirty, but works)
         try:
             for walked_node in walked_nodes:
@@ -36,25 +75,153 @@ def discover_trusted_nodes(
         except RuntimeWarning:
             continue
 
+        # A neighbour that is down is left out, the rest of the network can still be discovered through the others
         try:
-            response = requests.post(
-                url=f'{trusted_node.url}/api/v1/discover/trusted_nodes',
-                verify=False,
-                cert=(trusted_node.cert, trusted_node.key),
-                json={'walked_nodes': jsonable_encoder(walked_nodes), 'distance': distance + 1},
-                timeout=5
-            ).json()
+            response = post_request(
+                trusted_node.id,
+                '/api/v1/discover/trusted_nodes',
+                {
+                    'walked_nodes': jsonable_encoder(walked_nodes),
+                    'distance': distance + 1,
+                    'area': area,
+                    'summarized_areas': summarized_areas
+                }
+            )
 
             for walked_node in response['walked_nodes']:
                 if walked_node not in jsonable_encoder(walked_nodes):
                     walked_nodes.append(WalkedNode(**walked_node))
+        except CircuitOpenError:
+            logger.debug('Skipping %s, its circuit is open', trusted_node.url)
         except requests.exceptions.ConnectionError:
             logger.error('Failed to connect to %s', trusted_node.url)
-
-            return [default_node]
         except requests.exceptions.ReadTimeout:
             logger.error('Connection to %s timed out', trusted_node.url)
-
-            return [default_node]
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error('Failed to discover trusted nodes through %s: %s', trusted_node.url, e)
 
     return walked_nodes
+
+
+def get_area_view(area: str | None, summarized_areas: list[str | None]) -> list[WalkedNode]:
+    """
+    Returns the trusted nodes of an area this trusted node borders on, leaving the given areas out of the summaries.
+    The area is walked at most once per route_cache_ttl.
+    """
+    view = (area, frozenset(summarized_areas))
+    ttl = get_settings().route_cache_ttl
+    discovered = _area_views.get(view)
+
+    if discovered is None or time.monotonic() - discovered[1] >= ttl:
+        discovered = (discover_trusted_nodes(area=area, summarized_areas=summarized_areas), time.monotonic())
+
+        with _area_views_lock:
+            _area_views[view] = discovered
+
+    return discovered[0]
+
+
+def _summarize_other_areas(
+        settings: Settings,
+        area: str | None,
+        summarized_areas: list[str | None]
+) -> list[str]:
+    # The areas already summarized further up are left out, otherwise two border nodes would summarize each other
+    other_areas = get_neighbour_areas(settings) | {settings.area}
+    other_areas -= {area, *summarized_areas}
+
+    local_sae_ids = {sae.sae_id for sae in settings.attached_saes}
+    sae_ids = {}
+
+    for other_area in sorted(other_areas, key=str):
+        for trusted_node in get_area_view(other_area, [*summarized_areas, area]):
+            for sae_id in trusted_node.sae_ids + trusted_node.summarized_sae_ids:
+                if sae_id not in local_sae_ids:
+                    sae_ids.setdefault(sae_id)
+
+    return list(sae_ids)
+
+
+def invalidate_routes():
+    global _routes_discovered_at
+
+    _routes_discovered_at = None
+
+    with _area_views_lock:
+        _area_views.clear()
+
+
+def _build_routes(settings: Settings, trusted_nodes: list[WalkedNode]) -> dict[str, str]:
+    routes = {}
+    trusted_nodes = [node for node in trusted_nodes if node.trusted_node_id != settings.id]
+
+    for trusted_node in trusted_nodes:
+        for trusted_node_sae_id in trusted_node.sae_ids:
+            routes.setdefault(trusted_node_sae_id, trusted_node.trusted_node_id)
+
+    # The SAEs in the other areas are reached through the nearest border node advertising them
+    for trusted_node in sorted(trusted_nodes, key=lambda node: node.distance):
+        for trusted_node_sae_id in trusted_node.summarized_sae_ids:
+            routes.setdefault(trusted_node_sae_id, trusted_node.trusted_node_id)
+
+    return routes
+
+
+def prime_routes(trusted_nodes: list[WalkedNode]) -> int:
+    """Caches the routes of the given (just discovered) trusted nodes, returns how many SAEs can be routed to."""
+    global _routes, _routes_discovered_at
+
+    with _routes_lock:
+        _routes, _routes_discovered_at = _build_routes(get_settings(), trusted_nodes), time.monotonic()
+
+        return len(_routes)
+
+
+def _discover_routes() -> dict[str, str]:
+    global _routes, _routes_discovered_at
+
+    routes = _build_routes(get_settings(), discover_trusted_nodes())
+
+    with _routes_lock:
+        _routes, _routes_discovered_at = routes, time.monotonic()
+
+    return routes
+
+
+def _refresh_routes():
+    global _routes_refreshing
+
+    try:
+        _discover_routes()
+    except Exception as e:
+        logger.warning('Failed to refresh the routes to the SAEs, keeping the old ones: %s', e)
+    finally:
+        with _routes_lock:
+            _routes_refreshing = False
+
+
+def find_trusted_node_of_sae(sae_id: str) -> str | None:
+    """
+    Returns the remote trusted node the given SAE is attached to (the border node it is reached through, when it is in
+    another area), or None when it cannot be routed to. The routes are discovered at most once per route_cache_ttl,
+    so that frequent status requests do not walk the network each time. Only the very first discovery is waited for,
+    expired routes are served while a single background thread discovers them again.
+    """
+    global _routes_refreshing
+
+    ttl = get_settings().route_cache_ttl
+
+    with _routes_lock:
+        routes, discovered_at = _routes, _routes_discovered_at
+        expired = discovered_at is None or time.monotonic() - discovered_at >= ttl
+
+        if routes is not None and expired and not _routes_refreshing:
+            _routes_refreshing = True
+            threading.Thread(target=_refresh_routes, name='route-refresh', daemon=True).start()
+
+    if routes is None:
+        with _first_discovery_lock:
+            # Somebody else might have discovered the routes while waiting for the lock
+            routes = _routes if _routes is not None else _discover_routes()
+
+    return routes.get(sae_id)
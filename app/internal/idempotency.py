@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, TypeVar
+
+from app.config import get_settings
+
+T = TypeVar('T')
+
+# (endpoint, calling trusted node ID, key ID(s), end SAE ID, path, hop sequence) -> when the result expires, and the
+# result
+_results: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+_results_lock = threading.Lock()
+
+# Key -> [lock held by the call running for it, number of calls running or waiting for it]
+_running: dict[tuple, list] = {}
+
+
+def _get_result(key: tuple) -> tuple[bool, Any]:
+    with _results_lock:
+        cached = _results.get(key)
+
+        if cached is None or cached[0] <= time.monotonic():
+            return False, None
+
+        return True, cached[1]
+
+
+def _put_result(key: tuple, result: Any):
+    settings = get_settings().idempotency
+    now = time.monotonic()
+
+    with _results_lock:
+        _results[key] = (now + settings.ttl, result)
+        _results.move_to_end(key)
+
+        # The entries expire in the order they were added, so the stale ones are all at the front
+        while len(_results) > 0:
+            oldest_key, (expires_at, _) = next(iter(_results.items()))
+
+            if expires_at > now and len(_results) <= settings.max_entries:
+                break
+
+            del _results[oldest_key]
+
+
+def run_once(key: tuple | None, call: Callable[[], T]) -> T:
+    """
+    Returns the result of the call, or of the first call with the same key within the TTL, so that a retried kmapi
+    request does not take key material from the KMEs again. A retry arriving while the first call still runs waits for
+    its result. Failed calls are not kept and run again when retried.
+    """
+    if key is None:
+        return call()
+
+    found, result = _get_result(key)
+
+    if found:
+        return result
+
+    with _results_lock:
+        running = _running.setdefault(key, [threading.Lock(), 0])
+        running[1] += 1
+
+    try:
+        with running[0]:
+            # The call that held the lock may have finished meanwhile
+            found, result = _get_result(key)
+
+            if found:
+                return result
+
+            result = call()
+
+            _put_result(key, result)
+
+            return result
+    finally:
+        with _results_lock:
+            running[1] -= 1
+
+            if running[1] == 0:
+                del _running[key]
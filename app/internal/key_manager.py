@@ -1,78 +1,408 @@
 import base64
+import itertools
 import logging
-from typing import Union
+import sys
+import threading
+import time
+from bisect import bisect_right
+from operator import attrgetter
+from typing import Callable, Union
+from uuid import UUID
 
 from app.config import Settings
-from app.models.key_container import KeyContainer, ActivatedKeyContainer, ActivatedKeyMetadata
+from app.models.key_container import ActivatedKeyContainer, ActivatedKeyMetadata
 
 logger = logging.getLogger('uvicorn.error')
 
+# Deactivated keys kept in the ordered index at least, before it is compacted
+COMPACTION_MIN_KEYS = 1024
+
+
+class ActivatedKey:
+    __slots__ = ('key_id', 'master_sae_id', 'slave_sae_id', 'slave_sae_ids', 'size', 'slot', 'seq', 'created_at',
+                 'receivers', 'predistributed', 'peer_trusted_node_id')
+
+    def __init__(
+            self,
+            key_id: bytes,
+            master_sae_id: str,
+            slave_sae_id: str,
+            size: int,
+            slot: int,
+            seq: int,
+            created_at: float,
+            receivers: int = 1,
+            predistributed: bool = False,
+            peer_trusted_node_id: str | None = None,
+            slave_sae_ids: tuple[str, ...] | None = None
+    ):
+        self.key_id = key_id
+        self.master_sae_id = master_sae_id
+        self.slave_sae_id = slave_sae_id
+        # All the slave SAEs a key delivered to a group is meant for, the first of them is the slave_sae_id
+        self.slave_sae_ids = slave_sae_ids or (slave_sae_id,)
+        self.size = size
+        self.slot = slot
+        self.seq = seq
+        self.created_at = created_at
+        # Number of slave SAEs that are still to get a key delivered to a group
+        self.receivers = receivers
+        # Relayed ahead of demand, the slave SAE learns its key_ID only once the master SAE is handed the key
+        self.predistributed = predistributed
+        # Trusted node on the other end of the relay, which of them it was when the SAE is attached to several
+        self.peer_trusted_node_id = peer_trusted_node_id
+
+    @property
+    def key_uuid(self) -> UUID:
+        return UUID(bytes=self.key_id)
+
+
+class KeySlab:
+    """
+    Preallocated arena of fixed-size slots that holds the raw key material, so that a stored key costs a slot index
+    instead of a separate bytes/str object. The arena grows by whole chunks when all slots are taken.
+    """
+
+    def __init__(self, slot_size: int, slots_per_chunk: int):
+        self._slot_size = slot_size
+        self._slots_per_chunk = slots_per_chunk
+
+        self._chunks: list[bytearray] = []
+        self._free_slots: list[int] = []
+
+        self._grow()
+
+    @property
+    def slot_size(self) -> int:
+        return self._slot_size
+
+    def _grow(self):
+        first_slot = len(self._chunks) * self._slots_per_chunk
+
+        self._chunks.append(bytearray(self._slot_size * self._slots_per_chunk))
+
+        # Reversed, so that pop() hands out the lowest slot first
+        self._free_slots.extend(range(first_slot + self._slots_per_chunk - 1, first_slot - 1, -1))
+
+    def _locate(self, slot: int) -> tuple[bytearray, int]:
+        chunk, index = divmod(slot, self._slots_per_chunk)
+
+        return self._chunks[chunk], index * self._slot_size
+
+    def store(self, key: bytes) -> int:
+        if len(key) > self._slot_size:
+            raise ValueError(f'Key of {len(key)} bytes does not fit into a slot of {self._slot_size} bytes')
+
+        if not self._free_slots:
+            self._grow()
+
+        slot = self._free_slots.pop()
+        chunk, start = self._locate(slot)
+        chunk[start:start + len(key)] = key
+
+        return slot
+
+    def load(self, slot: int, size: int) -> bytes:
+        chunk, start = self._locate(slot)
+
+        return bytes(chunk[start:start + size])
+
+    def release(self, slot: int):
+        chunk, start = self._locate(slot)
+
+        # Do not leave the key material lying around in the free slot
+        chunk[start:start + self._slot_size] = bytes(self._slot_size)
+
+        self._free_slots.append(slot)
+
 
 class KeyManager:
     def __init__(self, settings: Settings):
         self._max_key_count = settings.max_key_count
 
-        self._activated_keys: list[ActivatedKeyContainer] = []
+        self._activated_keys: dict[bytes, ActivatedKey] = {}
 
-    def get_activated_key_count(self):
-        return len(self._activated_keys)
+        # The keys in activation (seq) order, for seeking to a cursor by bisection. Deactivated keys are left in until
+        # there are as many of them as there are live keys, then a new list is built, so readers can keep the old one
+        self._ordered_keys: list[ActivatedKey] = []
 
-    def _remove_key(self, key_id: str) -> bool:
-        removed = False
+        self._slab = KeySlab(slot_size=settings.max_key_size // 8, slots_per_chunk=settings.max_key_count)
 
-        for i, key in enumerate(self._activated_keys):
-            if str(key.key_ID) == key_id:
-                del self._activated_keys[i]
-                removed = True
+        # Keys are activated and deactivated from the relay worker threads as well
+        self._lock = threading.Lock()
 
-        if not removed:
-            logger.warning(f'Was asked to remove key from key pools, but the key did not exist, id: {key_id}')
+        # Key ID -> [event set once the key is activated, number of requests waiting for it]
+        self._key_waiters: dict[bytes, list] = {}
 
-        return removed
+        # Increasing sequence number of the activated keys, the pool is kept in this order and it serves as the cursor
+        self._seq = itertools.count(1)
+        self._key_counts: dict[tuple[str, str], int] = {}
 
-    def _activate_key(
-            self,
-            key: KeyContainer,
-            master_sae_id: str,
-            slave_sae_id: str,
-            size: int
-    ) -> ActivatedKeyContainer:
-        activated_key = ActivatedKeyContainer(
-            master_sae_id=master_sae_id,
-            slave_sae_id=slave_sae_id,
-            size=size,
-            key_ID=key.key_container.key_ID,
-            key=key.key
-        )
+        # Slave SAE ID -> callbacks called with every key activated for it
+        self._subscribers: dict[str, list[Callable[[ActivatedKey], None]]] = {}
 
-        self._activated_keys.append(activated_key)
+    def _count_key(self, key: ActivatedKey, delta: int):
+        for slave_sae_id in key.slave_sae_ids:
+            pair = (key.master_sae_id, slave_sae_id)
+            count = self._key_counts.get(pair, 0) + delta
 
-        return activated_key
+            if count > 0:
+                self._key_counts[pair] = count
+            else:
+                self._key_counts.pop(pair, None)
+
+    def apply_settings(self, settings: Settings):
+        self._max_key_count = settings.max_key_count
+
+        if settings.max_key_size // 8 <= self._slab.slot_size:
+            return
+
+        with self._lock:
+            # Bigger keys are now allowed, move the stored keys over into an arena with wider slots
+            slab = KeySlab(slot_size=settings.max_key_size // 8, slots_per_chunk=settings.max_key_count)
+
+            for key in self._activated_keys.values():
+                key.slot = slab.store(self._slab.load(key.slot, key.size))
+
+            self._slab = slab
+
+    def _compact_ordered_keys(self):
+        if len(self._ordered_keys) > 2 * len(self._activated_keys) + COMPACTION_MIN_KEYS:
+            self._ordered_keys = [key for key in self._ordered_keys if self._activated_keys.get(key.key_id) is key]
+
+    def get_activated_key_count(self):
+        return len(self._activated_keys)
+
+    def _to_container(self, key: ActivatedKey, material: bytes) -> ActivatedKeyContainer:
+        return ActivatedKeyContainer(
+            master_sae_id=key.master_sae_id,
+            slave_sae_id=key.slave_sae_id,
+            size=key.size,
+            key_ID=key.key_uuid,
+            key=base64.b64encode(material).decode('ascii')
+        )
 
     def add_activated_key(
             self,
             master_sae_id: str,
             slave_sae_id: str,
-            key: KeyContainer
-    ) -> ActivatedKeyContainer:
-        activated_key = ActivatedKeyContainer(
-            master_sae_id=master_sae_id,
-            slave_sae_id=slave_sae_id,
-            size=len(base64.b64decode(key.key)),
-            key_ID=key.key_ID,
-            key=key.key,
-        )
+            key_id: UUID,
+            key: bytes,
+            receivers: int = 1,
+            notify: bool = True,
+            predistributed: bool = False,
+            peer_trusted_node_id: str | None = None,
+            slave_sae_ids: list[str] | None = None
+    ) -> ActivatedKey:
+        with self._lock:
+            activated_key = ActivatedKey(
+                key_id=key_id.bytes,
+                master_sae_id=sys.intern(master_sae_id),
+                slave_sae_id=sys.intern(slave_sae_id),
+                slave_sae_ids=tuple(sys.intern(sae_id) for sae_id in slave_sae_ids) if slave_sae_ids else None,
+                size=len(key),
+                slot=self._slab.store(key),
+                seq=next(self._seq),
+                created_at=time.time(),
+                receivers=receivers,
+                predistributed=predistributed,
+                peer_trusted_node_id=sys.intern(peer_trusted_node_id) if peer_trusted_node_id is not None else None
+            )
+
+            replaced_key = self._activated_keys.pop(activated_key.key_id, None)
 
-        self._activated_keys.append(activated_key)
+            if replaced_key is not None:
+                self._slab.release(replaced_key.slot)
+                self._count_key(replaced_key, -1)
+
+            self._activated_keys[activated_key.key_id] = activated_key
+            self._ordered_keys.append(activated_key)
+            self._count_key(activated_key, 1)
+
+            if replaced_key is not None:
+                self._compact_ordered_keys()
+
+            waiter = self._key_waiters.pop(activated_key.key_id, None)
+
+            if waiter is not None:
+                waiter[0].set()
+
+        if notify and not predistributed:
+            for sae_id in activated_key.slave_sae_ids:
+                self.notify_subscribers(activated_key, sae_id)
 
         return activated_key
 
-    def _get_activated_key_by_id(self, key_id: str) -> ActivatedKeyContainer:
-        for key in self._activated_keys:
-            if str(key.key_ID) == key_id:
-                return key
+    def subscribe(self, slave_sae_id: str, callback: Callable[[ActivatedKey], None]):
+        with self._lock:
+            self._subscribers.setdefault(slave_sae_id, []).append(callback)
+
+    def unsubscribe(self, slave_sae_id: str, callback: Callable[[ActivatedKey], None]):
+        with self._lock:
+            callbacks = self._subscribers.get(slave_sae_id, [])
+
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+            if len(callbacks) == 0:
+                self._subscribers.pop(slave_sae_id, None)
+
+    def notify_subscribers(self, key: ActivatedKey, slave_sae_id: str):
+        for callback in list(self._subscribers.get(slave_sae_id, ())):
+            try:
+                callback(key)
+            except Exception as e:
+                logger.warning('Failed to notify %s of key %s: %s', slave_sae_id, key.key_uuid, e)
+
+    def release_keys(self, key_ids: list[str]) -> int:
+        """
+        Announces the given pre-distributed keys to their slave SAEs, now they were handed out to the master SAE.
+        Returns how many of them were still held back.
+        """
+        released = []
+
+        with self._lock:
+            for key_id in key_ids:
+                key = self._activated_keys.get(UUID(key_id).bytes)
+
+                if key is not None and key.predistributed:
+                    key.predistributed = False
+                    released.append(key)
+
+        for key in released:
+            for slave_sae_id in key.slave_sae_ids:
+                self.notify_subscribers(key, slave_sae_id)
+
+        return len(released)
+
+    def _get_activated_key_by_id(self, key_id: str) -> ActivatedKey:
+        try:
+            return self._activated_keys[UUID(key_id).bytes]
+        except (KeyError, ValueError):
+            raise ValueError('Key cannot be found because key_id is not found in activated keys')
+
+    def wait_for_keys(self, key_ids: list[str], timeout: float) -> bool:
+        """Waits up to timeout seconds for all the given keys to be activated, returns whether they were."""
+        try:
+            key_ids = [UUID(str(key_id)).bytes for key_id in key_ids]
+        except ValueError:
+            return False
+
+        deadline = time.monotonic() + timeout
+        waiters = []
+
+        with self._lock:
+            for key_id in key_ids:
+                if key_id not in self._activated_keys:
+                    waiter = self._key_waiters.setdefault(key_id, [threading.Event(), 0])
+                    waiter[1] += 1
+                    waiters.append((key_id, waiter))
+
+        try:
+            return all(waiter[0].wait(max(0.0, deadline - time.monotonic())) for _, waiter in waiters)
+        finally:
+            with self._lock:
+                for key_id, waiter in waiters:
+                    waiter[1] -= 1
+
+                    if waiter[1] == 0 and self._key_waiters.get(key_id) is waiter:
+                        del self._key_waiters[key_id]
+
+    def get_activated_keys_by_id(self, key_ids: list[str]) -> list[ActivatedKey]:
+        """Returns the activated keys of the given IDs, skipping those that have been deactivated."""
+        keys = []
 
-        raise ValueError('Key cannot be found because key_id is not found in activated keys')
+        for key_id in key_ids:
+            try:
+                keys.append(self._get_activated_key_by_id(key_id))
+            except ValueError:
+                continue
+
+        return keys
+
+    def get_activated_keys(self) -> list[ActivatedKeyContainer]:
+        with self._lock:
+            keys = [(key, self._slab.load(key.slot, key.size)) for key in self._activated_keys.values()]
+
+        return [self._to_container(key, material) for key, material in keys]
+
+    def get_key_count(self, master_sae_id: str, slave_sae_id: str) -> int:
+        return self._key_counts.get((master_sae_id, slave_sae_id), 0)
+
+    def get_key_counts(self) -> dict[tuple[str, str], int]:
+        return dict(self._key_counts)
+
+    def find_activated_keys(
+            self,
+            after: int = 0,
+            limit: int | None = None,
+            master_sae_id: str | None = None,
+            slave_sae_id: str | None = None,
+            min_age: float | None = None,
+            max_age: float | None = None
+    ) -> list[ActivatedKey]:
+        """
+        Returns the activated keys (without their material) that were activated after the given sequence number and
+        match the filters, in activation order. Ages are in seconds.
+        """
+        with self._lock:
+            # Keys activated later are appended to the same list, the range stops where it ends now
+            keys, end = self._ordered_keys, len(self._ordered_keys)
+
+        now = time.time()
+        found = []
+
+        for index in range(bisect_right(keys, after, hi=end, key=attrgetter('seq')), end):
+            key = keys[index]
+
+            if self._activated_keys.get(key.key_id) is not key:
+                continue
+
+            if master_sae_id is not None and key.master_sae_id != master_sae_id:
+                continue
+
+            if slave_sae_id is not None and slave_sae_id not in key.slave_sae_ids:
+                continue
+
+            if min_age is not None and now - key.created_at < min_age:
+                continue
+
+            if max_age is not None and now - key.created_at > max_age:
+                continue
+
+            found.append(key)
+
+            if limit is not None and len(found) >= limit:
+                break
+
+        return found
+
+    def export_keys(
+            self,
+            keys: list[ActivatedKey],
+            metadata_only: bool = True
+    ) -> list[Union[ActivatedKeyContainer, ActivatedKeyMetadata]]:
+        """Serializes the given keys, skipping those that have been deactivated in the meantime."""
+        if metadata_only:
+            return [
+                ActivatedKeyMetadata(
+                    master_sae_id=key.master_sae_id,
+                    slave_sae_id=key.slave_sae_id,
+                    size=key.size,
+                    key_ID=key.key_uuid,
+                )
+                for key in keys
+                if self._activated_keys.get(key.key_id) is key
+            ]
+
+        with self._lock:
+            loaded = [
+                (key, self._slab.load(key.slot, key.size))
+                for key in keys
+                if self._activated_keys.get(key.key_id) is key
+            ]
+
+        return [self._to_container(key, material) for key, material in loaded]
 
     def get_activated_key_metadata(self, key_id: str) -> Union[ActivatedKeyMetadata, None]:
         try:
@@ -82,14 +412,26 @@ class KeyManager:
                 master_sae_id=key.master_sae_id,
                 slave_sae_id=key.slave_sae_id,
                 size=key.size,
-                key_ID=key.key_ID,
+                key_ID=key.key_uuid,
             )
         except ValueError:
             return None
 
-    def deactivate_key(self, key_id: str) -> ActivatedKeyContainer:
-        activated_key = self._get_activated_key_by_id(key_id)
+    def deactivate_key(self, key_id: str, all_receivers: bool = False) -> ActivatedKeyContainer:
+        with self._lock:
+            activated_key = self._get_activated_key_by_id(key_id)
 
-        self._remove_key(key_id)
+            # A key delivered to a group stays activated until each of its slave SAEs got it
+            if activated_key.receivers > 1 and not all_receivers:
+                activated_key.receivers -= 1
 
-        return activated_key
+                return self._to_container(activated_key, self._slab.load(activated_key.slot, activated_key.size))
+
+            del self._activated_keys[activated_key.key_id]
+            self._count_key(activated_key, -1)
+            self._compact_ordered_keys()
+
+            material = self._slab.load(activated_key.slot, activated_key.size)
+            self._slab.release(activated_key.slot)
+
+        return self._to_container(activated_key, material)
@@ -0,0 +1,7 @@
+def xor_keys(key_a: bytes, key_b: bytes) -> bytes:
+    # Same semantics as zip(): the result is as long as the shorter key
+    length = min(len(key_a), len(key_b))
+
+    return (
+            int.from_bytes(key_a[:length], 'big') ^ int.from_bytes(key_b[:length], 'big')
+    ).to_bytes(length, 'big')
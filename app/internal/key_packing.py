@@ -0,0 +1,215 @@
+import base64
+import math
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, TypeVar
+
+from app.config import AttachedKmes, Settings, get_settings
+from app.internal.deadline import Deadline
+from app.internal.requestor import get_request
+
+T = TypeVar('T')
+
+# Partly used QKD keys a trusted node keeps for the senders on the other end of its links
+MAX_RECEIVED_KEYS = 1024
+
+
+class LinkPacker:
+    """
+    Serves key material of any length from the QKD keys of a single link. The KME is asked for keys of the largest
+    size it hands out, in bulk, and they are cut into slices, so one QKD key can encrypt several smaller keys, while
+    a longer key is made of several QKD keys. Each slice is described by a segment (key_ID, offset, length), that
+    the other end of the link needs to get the same material with load_segments().
+    """
+
+    def __init__(self, kme: AttachedKmes, trusted_node_id: str, key_size: int):
+        self.kme_id = kme.kme_id
+        self.trusted_node_id = trusted_node_id
+        self.key_size = key_size
+
+        # [key_ID, material, offset of the first unused byte]
+        self._buffer: deque[list] = deque()
+        self._lock = threading.Lock()
+
+    def _available(self) -> int:
+        return sum(len(material) - offset for _, material, offset in self._buffer)
+
+    def _fetch(self, length: int, settings: Settings, deadline: Deadline | None) -> list[list]:
+        number = math.ceil(length / (self.key_size // 8))
+        fetched = []
+
+        while number > 0:
+            batch = min(number, settings.max_keys_per_request)
+
+            keys = get_request(
+                self.kme_id,
+                f'/api/v1/keys/{self.trusted_node_id}/enc_keys?number={batch}&size={self.key_size}',
+                deadline
+            )['keys']
+
+            for key in keys:
+                fetched.append([key['key_ID'], base64.b64decode(key['key']), 0])
+
+            number -= batch
+
+        return fetched
+
+    def _take(self, length: int) -> tuple[bytes, list[dict]]:
+        material = bytearray()
+        segments = []
+
+        while length > 0:
+            entry = self._buffer[0]
+            key_id, key, offset = entry
+            taken = min(length, len(key) - offset)
+
+            material += key[offset:offset + taken]
+            segments.append({'key_ID': key_id, 'offset': offset, 'length': taken})
+
+            entry[2] += taken
+            length -= taken
+
+            if entry[2] == len(key):
+                self._buffer.popleft()
+
+        return bytes(material), segments
+
+    def _when_available(self, length: int, deadline: Deadline | None, then: Callable[[], T]) -> T:
+        # The KME is asked for what is missing without holding the lock, so the other relays over the link go on
+        # meanwhile. They may have taken some of the buffer by the time the keys arrive, then more is asked for
+        fetched = []
+
+        while True:
+            with self._lock:
+                self._buffer.extend(fetched)
+                missing = length - self._available()
+
+                if missing <= 0:
+                    return then()
+
+            fetched = self._fetch(missing, get_settings(), deadline)
+
+    def take(self, number: int, length: int, deadline: Deadline | None = None) -> list[tuple[bytes, list[dict]]]:
+        """Returns the given number of slices of the given length in bytes, with the segments they are made of."""
+        return self._when_available(number * length, deadline, lambda: [self._take(length) for _ in range(number)])
+
+    def prime(self, number: int) -> int:
+        """Fills the buffer up to the given number of QKD keys ahead of the first relay, returns how many it holds."""
+        key_length = self.key_size // 8
+
+        return self._when_available(number * key_length, None, lambda: math.ceil(self._available() / key_length))
+
+    def discard(self, key_ids: set[str]):
+        """Drops the given QKD keys from the buffer, so none of their bytes are used again."""
+        with self._lock:
+            self._buffer = deque(entry for entry in self._buffer if entry[0] not in key_ids)
+
+
+_packers: dict[tuple[str, str], LinkPacker] = {}
+_packers_lock = threading.Lock()
+
+
+def get_link_packer(kme: AttachedKmes, trusted_node_id: str) -> LinkPacker:
+    key_size = kme.max_key_size or get_settings().max_key_size
+    packer = _packers.get((kme.kme_id, trusted_node_id))
+
+    if packer is None or packer.key_size != key_size:
+        with _packers_lock:
+            packer = _packers.get((kme.kme_id, trusted_node_id))
+
+            if packer is None or packer.key_size != key_size:
+                packer = LinkPacker(kme, trusted_node_id, key_size)
+                _packers[(kme.kme_id, trusted_node_id)] = packer
+
+    return packer
+
+
+def discard_segments(kme_id: str, trusted_node_id: str, segments: list[dict]):
+    """
+    Drops the QKD keys the segments of a slice that failed to reach the other end were cut from. Whether that end got
+    them is not known, so the rest of them is not sent over to it.
+    """
+    packer = _packers.get((kme_id, trusted_node_id))
+
+    if packer is not None:
+        packer.discard({segment['key_ID'] for segment in segments})
+
+
+def prune_link_packers(settings: Settings):
+    kme_ids = {kme.kme_id for kme in settings.attached_kmes}
+
+    with _packers_lock:
+        for link in [link for link in _packers if link[0] not in kme_ids]:
+            del _packers[link]
+
+
+class _ReceivedKey:
+    def __init__(self):
+        self.material: bytes | None = None
+        self.used = 0
+        self.lock = threading.Lock()
+
+        # Number of requests putting together key material from it, it is not evicted while in use
+        self.users = 0
+
+
+# In the order they were last used in
+_received_keys: OrderedDict[tuple[str, str], _ReceivedKey] = OrderedDict()
+_received_keys_lock = threading.Lock()
+
+
+def _evict_received_keys():
+    # The sender gave up on the least recently used ones, or the link went down meanwhile
+    for key in [key for key, received_key in _received_keys.items() if received_key.users == 0]:
+        if len(_received_keys) <= MAX_RECEIVED_KEYS:
+            break
+
+        del _received_keys[key]
+
+
+def load_segments(kme_id: str, trusted_node_id: str, segments: list, deadline: Deadline | None = None) -> bytes:
+    """
+    Puts together the key material described by the segments of the sender. A QKD key can be taken from the KME only
+    once, so it is kept until all of its bytes have been used.
+    """
+    material = bytearray()
+
+    for segment in segments:
+        key_id = str(segment.key_ID)
+
+        with _received_keys_lock:
+            received_key = _received_keys.get((kme_id, key_id))
+
+            if received_key is None:
+                received_key = _received_keys[(kme_id, key_id)] = _ReceivedKey()
+            else:
+                _received_keys.move_to_end((kme_id, key_id))
+
+            received_key.users += 1
+
+            if len(_received_keys) > MAX_RECEIVED_KEYS:
+                _evict_received_keys()
+
+        try:
+            with received_key.lock:
+                if received_key.material is None:
+                    received_key.material = base64.b64decode(get_request(
+                        kme_id,
+                        f'/api/v1/keys/{trusted_node_id}/dec_keys?key_ID={key_id}',
+                        deadline
+                    )['keys'][0]['key'])
+
+                if segment.offset + segment.length > len(received_key.material):
+                    raise ValueError(f'Segment is out of the range of the key {key_id}')
+
+                material += received_key.material[segment.offset:segment.offset + segment.length]
+                received_key.used += segment.length
+        finally:
+            with _received_keys_lock:
+                received_key.users -= 1
+
+                if received_key.material is not None and received_key.used >= len(received_key.material):
+                    if _received_keys.get((kme_id, key_id)) is received_key:
+                        del _received_keys[(kme_id, key_id)]
+
+    return bytes(material)
@@ -1,60 +1,232 @@
+import asyncio
+import logging
+
 import urllib3
 from fastapi import FastAPI
-from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol
+from watchfiles import awatch
 
-from app.config import Settings
+from app.config import Settings, replace_settings
+from app.internal.certificates import refresh_sae_identities
+from app.internal.circuit_breaker import CLOSED, get_circuit_breakers, prune_circuit_breakers
+from app.internal.deadline import prune_peer_latencies
+from app.internal.discovery import invalidate_routes
 from app.internal.key_manager import KeyManager
+from app.internal.key_packing import prune_link_packers
+from app.internal.predistribution import KeyPreDistributor, Relay, Void
+from app.internal.profiler import run_continuous_sampling
+from app.internal.requestor import probe_peer, prune_sessions
+from app.internal.structured_logging import apply_logging_settings, start_structured_logging, stop_structured_logging
+from app.internal.warm_up import WarmUp
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def _diff_ids(old: list[str], new: list[str]) -> dict[str, list[str]]:
+    return {
+        'added': [item for item in new if item not in old],
+        'removed': [item for item in old if item not in new],
+    }
 
 
 class Lifecycle:
     key_manager: KeyManager | None = None
+    predistributor: KeyPreDistributor | None = None
+    warm_up: WarmUp | None = None
 
     def __init__(self, app: FastAPI, settings: Settings):
         self.app = app
         self.settings = settings
 
-    def _verify_settings(self):
-        if self.settings.min_key_size > self.settings.max_key_size:
+        self._reload_lock = asyncio.Lock()
+        self._settings_watcher: asyncio.Task | None = None
+        self._continuous_sampler: asyncio.Task | None = None
+        self._health_prober: asyncio.Task | None = None
+        self._predistribution: asyncio.Task | None = None
+        self._warm_up: asyncio.Task | None = None
+
+    @staticmethod
+    def _verify_settings(settings: Settings):
+        if settings.min_key_size > settings.max_key_size:
             raise ValueError('Please define a correct range of min, max key sizes')
 
-        if self.settings.min_key_size % 8 != 0:
+        if settings.min_key_size % 8 != 0:
             raise ValueError('Min key size must be a multiple of 8')
 
-        if self.settings.default_key_size % 8 != 0:
+        if settings.default_key_size % 8 != 0:
             raise ValueError('Default key size must be a multiple of 8')
 
-        if self.settings.max_key_size % 8 != 0:
+        if settings.max_key_size % 8 != 0:
             raise ValueError('Max key size must be a multiple of 8')
 
-        if self.settings.default_key_size < self.settings.min_key_size or self.settings.default_key_size > self.settings.max_key_size:
+        if settings.default_key_size < settings.min_key_size or settings.default_key_size > settings.max_key_size:
             raise ValueError('Default key size must be in the range of min/max key sizes')
 
         if (
-                self.settings.min_key_size <= 0 or
-                self.settings.max_key_size <= 0 or
-                self.settings.default_key_size <= 0 or
-                self.settings.max_key_count <= 0 or
-                self.settings.max_keys_per_request <= 0
+                settings.min_key_size <= 0 or
+                settings.max_key_size <= 0 or
+                settings.default_key_size <= 0 or
+                settings.max_key_count <= 0 or
+                settings.max_keys_per_request <= 0 or
+                settings.max_concurrent_relays <= 0
         ):
             raise ValueError('All numeric config values must be above 0')
 
-    def _configure_tls(self):
-        urllib3.disable_warnings()
+        if not isinstance(logging.getLevelName(settings.logging.level), int):
+            raise ValueError(f'Unknown logging level {settings.logging.level}')
+
+        if not 0 <= settings.logging.key_event_sample_rate <= 1:
+            raise ValueError('Key event sample rate must be between 0 and 1')
+
+        if settings.predistribution.interval <= 0 or settings.predistribution.max_reserve < 0:
+            raise ValueError('Pre-distribution interval must be above 0 and its reserve cannot be negative')
+
+        if settings.predistribution.max_age <= 0:
+            raise ValueError('Pre-distribution max age must be above 0')
+
+        if not 0 < settings.predistribution.smoothing <= 1:
+            raise ValueError('Pre-distribution smoothing must be above 0 and at most 1')
+
+        deadline = settings.deadline
+
+        if deadline.budget <= 0 or deadline.min_timeout <= 0 or deadline.min_timeout > deadline.max_timeout:
+            raise ValueError('The deadline budget and timeouts must be above 0, min timeout at most max timeout')
+
+        if not 0 < deadline.latency_percentile <= 1 or deadline.latency_window <= 0:
+            raise ValueError('The latency percentile must be above 0 and at most 1, over a window above 0')
+
+        idempotency = settings.idempotency
 
-        # Add mTLS certificates into the request scope
-        old_on_url = HttpToolsProtocol.on_url
+        if idempotency.ttl <= 0 or idempotency.max_entries <= 0 or idempotency.retries < 0:
+            raise ValueError('The idempotency TTL and cache size must be above 0, the retries cannot be negative')
 
-        def new_on_url(self, url):
-            old_on_url(self, url)
-            self.scope['transport'] = self.transport
+        if settings.warm_up.timeout <= 0 or settings.warm_up.prime_keys < 0:
+            raise ValueError('The warm-up timeout must be above 0 and the keys to prime cannot be negative')
 
-        HttpToolsProtocol.on_url = new_on_url
+        if settings.async_relay.dec_keys_wait < 0:
+            raise ValueError('The time dec_keys waits for keys on their way cannot be negative')
+
+        peers = [(kme.kme_id, kme.transport) for kme in settings.attached_kmes]
+        peers += [(node.id, node.transport) for node in settings.attached_trusted_nodes]
+
+        for peer_id, transport in peers:
+            if transport.type == 'uds' and transport.socket_path is None:
+                raise ValueError(f'The uds transport of {peer_id} needs a socket_path')
+
+            if transport.type == 'asgi' and transport.app is None:
+                raise ValueError(f'The asgi transport of {peer_id} needs an app')
+
+    def _configure_tls(self):
+        urllib3.disable_warnings()
+
+    async def reload_settings(self) -> dict:
+        """
+        Re-reads the settings file and swaps it in while the node keeps serving. The key pool and any in-flight
+        relays are kept, only the state derived from the changed parts of the configuration is rebuilt.
+        """
+        async with self._reload_lock:
+            settings = Settings()
+
+            self._verify_settings(settings)
+
+            # Parse the new SAE certificates before the swap, so a broken file leaves the old configuration in place
+            changed_certificates = refresh_sae_identities(settings.attached_saes)
+
+            old_settings = self.settings
+
+            replace_settings(settings)
+            self.settings = settings
+            self.key_manager.apply_settings(settings)
+
+            closed_sessions = prune_sessions(settings)
+            prune_circuit_breakers(settings)
+            prune_link_packers(settings)
+            prune_peer_latencies(settings)
+            apply_logging_settings(settings.logging)
+            invalidate_routes()
+
+            changes = {
+                'attached_kmes': _diff_ids(
+                    [kme.kme_id for kme in old_settings.attached_kmes],
+                    [kme.kme_id for kme in settings.attached_kmes]
+                ),
+                'attached_saes': _diff_ids(
+                    [sae.sae_id for sae in old_settings.attached_saes],
+                    [sae.sae_id for sae in settings.attached_saes]
+                ),
+                'attached_trusted_nodes': _diff_ids(
+                    [node.id for node in old_settings.attached_trusted_nodes],
+                    [node.id for node in settings.attached_trusted_nodes]
+                ),
+                'changed_certificates': changed_certificates,
+                'closed_connection_pools': closed_sessions,
+            }
+
+            logger.info('Settings reloaded: %s', changes)
+
+            return changes
+
+    async def _watch_settings_file(self):
+        async for _ in awatch(Settings.model_config['json_file']):
+            try:
+                await self.reload_settings()
+            except Exception as e:
+                logger.error('Failed to reload settings, keeping the previous ones: %s', e)
+
+    async def _probe_open_circuits(self):
+        while True:
+            await asyncio.sleep(self.settings.circuit_breaker.probe_interval)
+
+            breakers = [breaker for breaker in get_circuit_breakers() if breaker.state != CLOSED]
+
+            if len(breakers) == 0:
+                continue
+
+            results = await asyncio.gather(*(asyncio.to_thread(probe_peer, breaker.peer_id) for breaker in breakers))
+
+            for breaker, is_up in zip(breakers, results):
+                if is_up:
+                    logger.info('%s is reachable again, closing its circuit', breaker.peer_id)
+
+                    breaker.record_success()
 
     async def before_start(self):
-        self._verify_settings()
+        self._verify_settings(self.settings)
         self._configure_tls()
 
+        refresh_sae_identities(self.settings.attached_saes)
+
         self.key_manager = KeyManager(self.settings)
+        self.predistributor = KeyPreDistributor()
+        self.warm_up = WarmUp()
+
+        start_structured_logging(self.settings.logging)
+
+        if self.settings.reload_on_settings_change:
+            self._settings_watcher = asyncio.create_task(self._watch_settings_file())
+
+        self._health_prober = asyncio.create_task(self._probe_open_circuits())
+
+        # The node starts serving right away, the readiness endpoint tells when it is warmed up
+        self._warm_up = asyncio.create_task(self.warm_up.run(self.settings))
+
+        if self.settings.profiling.continuous_interval is not None:
+            self._continuous_sampler = asyncio.create_task(run_continuous_sampling(self.settings.profiling))
+
+    def start_predistribution(self, relay: Relay, void: Void):
+        # Runs even while disabled, so that it can be enabled by reloading the settings
+        self._predistribution = asyncio.create_task(self.predistributor.run(relay, void, lambda: self.settings))
 
     async def after_landing(self):
-        pass
+        tasks = (
+            self._settings_watcher,
+            self._continuous_sampler,
+            self._health_prober,
+            self._predistribution,
+            self._warm_up
+        )
+
+        for task in tasks:
+            if task is not None:
+                task.cancel()
+
+        stop_structured_logging()
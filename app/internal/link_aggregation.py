@@ -0,0 +1,96 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app.config import AttachedKmes, get_settings
+from app.internal.deadline import Deadline
+from app.internal.key_packing import get_link_packer
+from app.internal.requestor import get_request
+
+logger = logging.getLogger('uvicorn.error')
+
+# (KME ID, trusted node ID) -> number of QKD keys the KME had for the trusted node, and when that was seen
+_availability: dict[tuple[str, str], tuple[int, float]] = {}
+_availability_lock = threading.Lock()
+
+
+def get_link_availability(kme: AttachedKmes, trusted_node_id: str) -> int:
+    """
+    Returns how many QKD keys the KME has for the trusted node on the other end of its link, as last reported by its
+    status. The status is asked for at most once per link_status_ttl.
+    """
+    link = (kme.kme_id, trusted_node_id)
+    observed = _availability.get(link)
+
+    if observed is not None and time.monotonic() - observed[1] < get_settings().link_status_ttl:
+        return observed[0]
+
+    try:
+        stored_key_count = int(get_request(kme.kme_id, f'/api/v1/keys/{trusted_node_id}/status')['stored_key_count'])
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.warning('Failed to get the status of the link %s: %s', link, e)
+
+        stored_key_count = 0
+
+    record_link_availability(kme.kme_id, trusted_node_id, stored_key_count)
+
+    return stored_key_count
+
+
+def record_link_availability(kme_id: str, trusted_node_id: str, stored_key_count: int):
+    with _availability_lock:
+        _availability[(kme_id, trusted_node_id)] = (stored_key_count, time.monotonic())
+
+
+def choose_links(kmes: list[AttachedKmes], trusted_node_id: str, number: int) -> list[AttachedKmes]:
+    """
+    Picks a link (KME) for each of the given number of keys, at random, weighted by the key material each link had
+    available, so that the links are drained evenly and a link that ran dry is only used when all of them did.
+    """
+    if len(kmes) == 1:
+        return kmes * number
+
+    weights = [get_link_availability(kme, trusted_node_id) for kme in kmes]
+
+    if sum(weights) == 0:
+        weights = [1] * len(kmes)
+
+    return random.choices(kmes, weights=weights, k=number)
+
+
+def take_from_links(
+        kmes: list[AttachedKmes],
+        trusted_node_id: str,
+        number: int,
+        length: int,
+        deadline: Deadline | None = None
+) -> list[tuple[str, bytes, list[dict]]]:
+    """
+    Takes the given number of slices of key material from the links to the trusted node, spread across all of them.
+    Returns the ID of the KME each slice comes from, with the slice and its segments.
+    """
+    if len(kmes) == 0:
+        raise ValueError(f'No KME is shared with {trusted_node_id}')
+
+    counts: dict[str, int] = {}
+
+    for kme in choose_links(kmes, trusted_node_id, number):
+        counts[kme.kme_id] = counts.get(kme.kme_id, 0) + 1
+
+    chosen = [kme for kme in kmes if kme.kme_id in counts]
+
+    def take(kme: AttachedKmes) -> list[tuple[str, bytes, list[dict]]]:
+        slices = get_link_packer(kme, trusted_node_id).take(counts[kme.kme_id], length, deadline)
+
+        return [(kme.kme_id, material, segments) for material, segments in slices]
+
+    if len(chosen) == 1:
+        return take(chosen[0])
+
+    # Each link has a KME of its own, so they are drawn from at the same time
+    with ThreadPoolExecutor(max_workers=max(1, len(chosen))) as executor:
+        return [taken for slices in executor.map(take, chosen) for taken in slices]
@@ -0,0 +1,61 @@
+import threading
+from types import MappingProxyType
+from typing import Iterable, Mapping, NamedTuple
+
+from app.config import AttachedKmes, AttachedTrustedNodes, Settings, get_settings
+
+
+class LinkTable(NamedTuple):
+    """
+    Lookups into the attached KMEs and trusted nodes of a configuration, so that the relay does not scan the settings
+    on every call. It is built once per configuration and never changed, a reload builds a new one.
+    """
+
+    settings: Settings
+    # Attached KME ID -> the KME
+    kmes: Mapping[str, AttachedKmes]
+    # Attached trusted node ID -> the trusted node
+    trusted_nodes: Mapping[str, AttachedTrustedNodes]
+    # KME ID -> the KME, of the KMEs with distance 0 only, in the order of the settings
+    local_kmes: Mapping[str, AttachedKmes]
+    # KME ID -> the local KME on this end of its link
+    local_kmes_by_peer: Mapping[str, AttachedKmes]
+
+    def get_shared_kmes(self, kme_ids: Iterable[str]) -> list[AttachedKmes]:
+        """Returns the local KMEs among the given ones, i.e. those of the links to the trusted node listing them."""
+        kme_ids = set(kme_ids)
+
+        return [kme for kme_id, kme in self.local_kmes.items() if kme_id in kme_ids]
+
+
+def build_link_table(settings: Settings) -> LinkTable:
+    local_kmes = {kme.kme_id: kme for kme in settings.attached_kmes if kme.distance == 0}
+
+    return LinkTable(
+        settings=settings,
+        kmes=MappingProxyType({kme.kme_id: kme for kme in settings.attached_kmes}),
+        trusted_nodes=MappingProxyType({node.id: node for node in settings.attached_trusted_nodes}),
+        local_kmes=MappingProxyType(local_kmes),
+        local_kmes_by_peer=MappingProxyType({kme.linked_to: kme for kme in reversed(local_kmes.values())}),
+    )
+
+
+_table: LinkTable | None = None
+_table_lock = threading.Lock()
+
+
+def get_link_table() -> LinkTable:
+    """Returns the table of the current settings, building it once after every (re)load."""
+    global _table
+
+    settings = get_settings()
+    table = _table
+
+    if table is None or table.settings is not settings:
+        with _table_lock:
+            if _table is None or _table.settings is not settings:
+                _table = build_link_table(settings)
+
+            table = _table
+
+    return table
@@ -1,9 +1,11 @@
+import sys
+
 from app.internal.djikstras_algorithm import dijkstra_algorithm
 from app.internal.graph import Graph
 from app.models.discover_requests import WalkedNode
 
 
-def find_shortest_path(point_a_id: str, point_b_id: str, trusted_nodes: list[WalkedNode]):
+def _build_graph(trusted_nodes: list[WalkedNode], excluded_links: set[tuple[str, str]]) -> Graph:
     init_graph = {}
 
     for trusted_node in trusted_nodes:
@@ -11,9 +13,40 @@ def find_shortest_path(point_a_id: str, point_b_id: str, trusted_nodes: list[Wal
 
     for trusted_node in trusted_nodes:
         for tn_id in trusted_node.trusted_node_ids:
+            # Skip the neighbours that have not been discovered (e.g. they are down)
+            if tn_id not in init_graph:
+                continue
+
+            # Links are excluded in both directions
+            if (
+                    (trusted_node.trusted_node_id, tn_id) in excluded_links or
+                    (tn_id, trusted_node.trusted_node_id) in excluded_links
+            ):
+                continue
+
             init_graph[trusted_node.trusted_node_id][tn_id] = trusted_node.distance
 
-    graph = Graph(list(map(lambda node: node.trusted_node_id, trusted_nodes)), init_graph)
+    return Graph(list(map(lambda node: node.trusted_node_id, trusted_nodes)), init_graph)
+
+
+def find_path_costs(
+        point_a_id: str,
+        trusted_nodes: list[WalkedNode],
+        excluded_links: set[tuple[str, str]] = frozenset()
+) -> dict[str, int]:
+    """Returns the cost of the shortest path to each of the trusted nodes that can be reached from point_a_id."""
+    _, shortest_path = dijkstra_algorithm(graph=_build_graph(trusted_nodes, excluded_links), start_node=point_a_id)
+
+    return {node_id: cost for node_id, cost in shortest_path.items() if cost != sys.maxsize}
+
+
+def find_shortest_path(
+        point_a_id: str,
+        point_b_id: str,
+        trusted_nodes: list[WalkedNode],
+        excluded_links: set[tuple[str, str]] = frozenset()
+):
+    graph = _build_graph(trusted_nodes, excluded_links)
 
     previous_nodes, shortest_path = dijkstra_algorithm(graph=graph, start_node=point_a_id)
 
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from fastapi import HTTPException
+
+from app.config import PreDistributionSettings, Settings
+
+logger = logging.getLogger('uvicorn.error')
+
+# (master SAE ID, slave SAE ID, key size in bits)
+Destination = tuple[str, str, int]
+
+# Relays the given number of keys of the given size ahead of demand, returns the IDs of those that got through
+Relay = Callable[[str, str, int, int], list[str]]
+
+# Voids the keys of the given IDs, relayed ahead of demand from the master SAE to the slave SAE
+Void = Callable[[str, str, list[str]], None]
+
+# Demand (keys per second) below which a destination is forgotten, once its reserve is used up
+MIN_RATE = 0.01
+
+
+class KeyPreDistributor:
+    """
+    Learns how many keys each master SAE asks for per slave SAE and key size, and keeps a reserve of keys relayed to
+    those slave SAEs ahead of demand, so enc_keys does not have to wait for every hop of the path. The reserve is
+    topped up only while no keys are being relayed on demand. Keys that are not claimed within max_age are voided.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # Keys asked for since the last round, and the moving average of keys asked for per second
+        self._demand: dict[Destination, int] = {}
+        self._rates: dict[Destination, float] = {}
+
+        # IDs of the keys relayed ahead of demand, with the time they were relayed at, oldest first
+        self._reserves: dict[Destination, deque[tuple[str, float]]] = {}
+
+        self._relays_in_flight = 0
+
+    def record_demand(self, master_sae_id: str, slave_sae_id: str, size: int, number: int):
+        destination = (master_sae_id, slave_sae_id, size)
+
+        with self._lock:
+            self._demand[destination] = self._demand.get(destination, 0) + number
+
+    def claim(self, master_sae_id: str, slave_sae_id: str, size: int, number: int) -> list[str]:
+        """Takes up to the given number of key IDs out of the reserve of the destination."""
+        with self._lock:
+            reserve = self._reserves.get((master_sae_id, slave_sae_id, size))
+
+            if not reserve:
+                return []
+
+            return [reserve.popleft()[0] for _ in range(min(number, len(reserve)))]
+
+    def get_reserve_counts(self) -> dict[Destination, int]:
+        with self._lock:
+            return {destination: len(reserve) for destination, reserve in self._reserves.items() if reserve}
+
+    def begin_relay(self):
+        with self._lock:
+            self._relays_in_flight += 1
+
+    def end_relay(self):
+        with self._lock:
+            self._relays_in_flight -= 1
+
+    def _update_rates(self, settings: PreDistributionSettings):
+        with self._lock:
+            demand, self._demand = self._demand, {}
+
+            for destination in set(self._rates) | set(demand):
+                rate = demand.get(destination, 0) / settings.interval
+                rate = settings.smoothing * rate + (1 - settings.smoothing) * self._rates.get(destination, rate)
+
+                if rate < MIN_RATE and not self._reserves.get(destination):
+                    self._rates.pop(destination, None)
+                    self._reserves.pop(destination, None)
+                else:
+                    self._rates[destination] = rate
+
+    def _take_expired(self, settings: PreDistributionSettings) -> list[tuple[Destination, list[str]]]:
+        relayed_before = time.monotonic() - settings.max_age
+        expired = []
+
+        with self._lock:
+            for destination, reserve in self._reserves.items():
+                key_ids = []
+
+                while reserve and reserve[0][1] <= relayed_before:
+                    key_ids.append(reserve.popleft()[0])
+
+                if len(key_ids) > 0:
+                    expired.append((destination, key_ids))
+
+        return expired
+
+    @staticmethod
+    def _void_expired(void: Void, expired: list[tuple[Destination, list[str]]]):
+        for (master_sae_id, slave_sae_id, _), key_ids in expired:
+            logger.info('Voiding %s keys held in reserve for %s for too long', len(key_ids), slave_sae_id)
+
+            void(master_sae_id, slave_sae_id, key_ids)
+
+    def _get_shortfalls(self, settings: PreDistributionSettings) -> list[tuple[Destination, int]]:
+        with self._lock:
+            shortfalls = []
+
+            for destination, rate in self._rates.items():
+                target = min(settings.max_reserve, math.ceil(rate * settings.lead_time))
+                missing = target - len(self._reserves.get(destination, ()))
+
+                if missing > 0:
+                    shortfalls.append((destination, missing))
+
+        # The busiest destinations first
+        return sorted(shortfalls, key=lambda shortfall: self._rates.get(shortfall[0], 0), reverse=True)
+
+    def _top_up(self, relay: Relay, settings: Settings):
+        for (master_sae_id, slave_sae_id, size), missing in self._get_shortfalls(settings.predistribution):
+            # Give way to the SAEs as soon as they ask for keys
+            if self._relays_in_flight > 0:
+                return
+
+            try:
+                key_ids = relay(master_sae_id, slave_sae_id, min(missing, settings.max_keys_per_request), size)
+            except HTTPException as e:
+                logger.warning('Failed to pre-distribute keys to %s: %s', slave_sae_id, e.detail)
+                continue
+
+            relayed_at = time.monotonic()
+
+            with self._lock:
+                reserve = self._reserves.setdefault((master_sae_id, slave_sae_id, size), deque())
+                reserve.extend((key_id, relayed_at) for key_id in key_ids)
+
+    async def run(self, relay: Relay, void: Void, get_settings: Callable[[], Settings]):
+        while True:
+            settings = get_settings()
+
+            await asyncio.sleep(settings.predistribution.interval)
+
+            if not settings.predistribution.enabled:
+                continue
+
+            # Before the rates, so that a destination without demand is forgotten once its reserve has expired
+            expired = self._take_expired(settings.predistribution)
+
+            if len(expired) > 0:
+                try:
+                    await asyncio.to_thread(self._void_expired, void, expired)
+                except Exception as e:
+                    logger.error('Failed to void the expired key reserves: %s', e)
+
+            self._update_rates(settings.predistribution)
+
+            if self._relays_in_flight == 0:
+                try:
+                    await asyncio.to_thread(self._top_up, relay, settings)
+                except Exception as e:
+                    logger.error('Failed to top up the key reserves: %s', e)
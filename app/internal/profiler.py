@@ -0,0 +1,251 @@
+import asyncio
+import cProfile
+import functools
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.config import ProfilingSettings, get_settings
+
+logger = logging.getLogger('uvicorn.error')
+
+PROFILE_HEADER = b'x-profile'
+
+# Number of upcoming requests to profile, armed through the internal router
+_armed_requests = 0
+_armed_path_prefix = '/'
+
+# cProfile cannot profile overlapping requests on the same thread, so only one request is profiled at a time
+_profile_lock = threading.Lock()
+
+
+class _RequestProfile:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+        # Threads the handler of the request is running on, the only ones whose stacks are sampled
+        self.thread_ids: set[int] = set()
+
+    @contextmanager
+    def running(self):
+        thread_id = threading.get_ident()
+
+        self.thread_ids.add(thread_id)
+        self.profile.enable()
+
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            self.thread_ids.discard(thread_id)
+
+
+# Profile of the request being handled, it follows the request onto the worker thread of a plain function handler
+_request_profile: ContextVar[_RequestProfile | None] = ContextVar('request_profile', default=None)
+
+
+def _profile_handler(endpoint: Callable) -> Callable:
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def run_coroutine(*args, **kwargs):
+            request_profile = _request_profile.get()
+
+            if request_profile is None:
+                return await endpoint(*args, **kwargs)
+
+            with request_profile.running():
+                return await endpoint(*args, **kwargs)
+
+        return run_coroutine
+
+    @functools.wraps(endpoint)
+    def run(*args, **kwargs):
+        request_profile = _request_profile.get()
+
+        if request_profile is None:
+            return endpoint(*args, **kwargs)
+
+        with request_profile.running():
+            return endpoint(*args, **kwargs)
+
+    return run
+
+
+class ProfiledRoute(APIRoute):
+    """Profiles the handler of a profiled request on the thread it runs on, a worker thread for a plain function."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _profile_handler(endpoint), **kwargs)
+
+
+def arm_requests(count: int, path_prefix: str = '/'):
+    global _armed_requests, _armed_path_prefix
+
+    _armed_requests = count
+    _armed_path_prefix = path_prefix
+
+
+def get_armed_requests() -> int:
+    return _armed_requests
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of all the other threads (or only of the given ones) at a fixed interval and counts them in the
+    folded format ("thread;outer;...;inner count") that flamegraph.pl, inferno and speedscope read.
+    """
+
+    def __init__(self, interval: float, thread_ids: set[int] | None = None):
+        super().__init__(name='stack-sampler', daemon=True)
+
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.samples: Counter = Counter()
+
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        own_id = threading.get_ident()
+
+        while not self._stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                stacks.append(';'.join(reversed(stack)))
+
+            with self._lock:
+                self.samples.update(stacks)
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+
+        return self.take_samples()
+
+    def take_samples(self) -> Counter:
+        with self._lock:
+            samples, self.samples = self.samples, Counter()
+
+        return samples
+
+
+def write_folded_stacks(samples: Counter, path: str):
+    with open(path, 'w', encoding='utf-8') as file:
+        for stack, count in samples.most_common():
+            file.write(f'{stack} {count}\n')
+
+
+def _dump_name(settings: ProfilingSettings, name: str) -> str:
+    os.makedirs(settings.output_dir, exist_ok=True)
+
+    return os.path.join(settings.output_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 10 ** 9}-{name}')
+
+
+def _should_profile(scope: Scope, settings: ProfilingSettings) -> bool:
+    global _armed_requests
+
+    if settings.token is not None:
+        for header, value in scope['headers']:
+            if header == PROFILE_HEADER:
+                return hmac.compare_digest(value, settings.token.encode('latin-1'))
+
+    if _armed_requests > 0 and scope['path'].startswith(_armed_path_prefix):
+        _armed_requests -= 1
+
+        return True
+
+    return False
+
+
+class ProfilingMiddleware:
+    """
+    Profiles single requests with cProfile and a stack sampler, writing a .prof and a .folded file per request. Both
+    only cover the thread the handler runs on (see ProfiledRoute), not what else the node does meanwhile. A request is
+    profiled when it carries the X-Profile header with the configured token, or when requests have been armed through
+    POST /internal/profiling. Otherwise, it costs one comparison.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        settings = get_settings().profiling
+
+        if (settings.token is None and _armed_requests == 0) or not _should_profile(scope, settings):
+            return await self.app(scope, receive, send)
+
+        if not _profile_lock.acquire(blocking=False):
+            logger.warning('Another request is being profiled, not profiling %s', scope['path'])
+
+            return await self.app(scope, receive, send)
+
+        request_profile = _RequestProfile()
+        sampler = StackSampler(settings.sampling_interval, request_profile.thread_ids)
+        token = _request_profile.set(request_profile)
+
+        try:
+            sampler.start()
+
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                samples = sampler.stop()
+        finally:
+            _request_profile.reset(token)
+            _profile_lock.release()
+
+        name = _dump_name(settings, re.sub(r'[^A-Za-z0-9_-]+', '_', f'{scope["method"]}{scope["path"]}'))
+
+        # Writing the files is done off the event loop
+        await asyncio.to_thread(request_profile.profile.dump_stats, f'{name}.prof')
+        await asyncio.to_thread(write_folded_stacks, samples, f'{name}.folded')
+
+        logger.info('Profile of %s %s written to %s.*', scope['method'], scope['path'], name)
+
+
+async def run_continuous_sampling(settings: ProfilingSettings):
+    """Samples all threads at a low rate for as long as the node runs, writing a .folded file every dump interval."""
+    sampler = StackSampler(settings.continuous_interval)
+    sampler.start()
+
+    try:
+        while True:
+            await asyncio.sleep(settings.continuous_dump_interval)
+
+            samples = sampler.take_samples()
+
+            if samples:
+                await asyncio.to_thread(write_folded_stacks, samples, f'{_dump_name(settings, "continuous")}.folded')
+    finally:
+        sampler.stop()
@@ -1,34 +1,403 @@
-from uuid import UUID
-
-from fastapi import HTTPException
-
-from app.config import Settings
-from app.internal.discovery import discover_trusted_nodes
+import base64
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID, uuid4
+
+import requests
+from fastapi import BackgroundTasks, HTTPException
+from fastapi.encoders import jsonable_encoder
+
+from app.config import AttachedKmes, Settings
+from app.internal.circuit_breaker import get_open_circuits
+from app.internal.deadline import Deadline, DeadlineExceededError
+from app.internal.discovery import discover_trusted_nodes, get_area_view, get_neighbour_areas
+from app.internal.key_manager import ActivatedKey
+from app.internal.key_material import xor_keys
+from app.internal.key_packing import discard_segments
+from app.internal.link_aggregation import take_from_links
+from app.internal.link_table import get_link_table
 from app.internal.lifecycle import Lifecycle
-from app.internal.path_finder import find_shortest_path
-from app.internal.requestor import get_request, post_request
+from app.internal.path_finder import find_path_costs, find_shortest_path
+from app.internal.requestor import post_request
+from app.internal.structured_logging import log_key_event
 from app.models.discover_requests import WalkedNode
-from app.models.key_container import KeyContainer
+from app.models.requests import DeliveryTree
 
+logger = logging.getLogger('uvicorn.error')
 
-def _get_node_by_id(trusted_nodes: list[WalkedNode], trusted_node_id: str) -> WalkedNode:
-    return list(filter(
-        lambda node: node.trusted_node_id == trusted_node_id,
-        trusted_nodes)
-    )[0]
+# How many paths are tried, when a hop of the shortest one cannot relay the requested keys
+RESERVE_ATTEMPTS = 3
 
+# Trusted node ID -> keys being relayed to it at the moment
+_relays_in_flight: dict[str, int] = {}
+_relays_in_flight_lock = threading.Lock()
 
-def get_encryption_keys(
+
+def _index_nodes(trusted_nodes: list[WalkedNode]) -> dict[str, WalkedNode]:
+    return {node.trusted_node_id: node for node in trusted_nodes}
+
+
+def _find_path(
+        point_a_id: str,
+        point_b_id: str,
+        trusted_nodes: list[WalkedNode],
+        excluded_links: set[tuple[str, str]] = frozenset()
+) -> list[str]:
+    # Steer around the neighbours whose circuit is open
+    excluded_links = set(excluded_links) | {(point_a_id, peer_id) for peer_id in get_open_circuits()}
+
+    try:
+        return find_shortest_path(
+            point_a_id=point_a_id,
+            point_b_id=point_b_id,
+            trusted_nodes=trusted_nodes,
+            excluded_links=excluded_links
+        )
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f'No available path to the trusted node {point_b_id}')
+
+
+def _get_links(path: list[str]) -> set[tuple[str, str]]:
+    return set(zip(path, path[1:]))
+
+
+def _get_shared_kmes(trusted_node: WalkedNode) -> list[AttachedKmes]:
+    # All the links to the trusted node are used, each of them adds its key rate
+    open_circuits = get_open_circuits()
+
+    return [
+        kme for kme in get_link_table().get_shared_kmes(trusted_node.kme_ids)
+        if kme.kme_id not in open_circuits
+    ]
+
+
+def _reserve_path(
+        path_to_go: list[str],
+        number: int,
+        size: int,
+        discovered_network: list,
+        deadline: Deadline | None = None
+) -> tuple[str, str] | None:
+    """
+    Asks every hop after the first one, whether it has enough key material on the link to its next hop, before any
+    QKD keys are consumed. The first link is checked by the initiator itself when fetching the keys. Returns the link
+    that cannot take part in the relay, if any.
+    """
+    if len(path_to_go) <= 2:
+        return None
+
+    try:
+        response = post_request(path_to_go[1], '/api/v1/kmapi/v1/reserve', {
+            'number': number,
+            'size': size,
+            'path_to_go': path_to_go[1:],
+            'discovered_network': discovered_network
+        }, deadline)
+    except DeadlineExceededError:
+        raise
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Failed to reserve the path %s: %s', path_to_go, e)
+
+        return path_to_go[0], path_to_go[1]
+
+    if response['reserved']:
+        return None
+
+    return response['trusted_node_id'], response['next_trusted_node_id']
+
+
+def _find_reserved_path(
+        point_a_id: str,
+        point_b_id: str,
+        trusted_nodes: list[WalkedNode],
+        number: int,
+        size: int,
+        discovered_network: list,
+        excluded_links: set[tuple[str, str]] = frozenset(),
+        deadline: Deadline | None = None
+) -> list[str]:
+    excluded_links = set(excluded_links)
+
+    for _ in range(RESERVE_ATTEMPTS):
+        path_to_go = _find_path(point_a_id, point_b_id, trusted_nodes, excluded_links)
+
+        failed_link = _reserve_path(path_to_go, number, size, discovered_network, deadline)
+
+        if failed_link is None:
+            return path_to_go
+
+        logger.warning('The link %s cannot relay %d keys, looking for another path', failed_link, number)
+
+        excluded_links.add(failed_link)
+
+    raise HTTPException(status_code=400, detail=f'No path with enough key material to the trusted node {point_b_id}')
+
+
+def _resolve_key_size(size: int | None, settings: Settings) -> int:
+    if size is None:
+        return settings.default_key_size
+
+    if size < settings.min_key_size or size > settings.max_key_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Key size must be in the range of {settings.min_key_size} to {settings.max_key_size}'
+        )
+
+    return size
+
+
+def _roll_back_key(
+        key_id: str,
         master_sae_id: str,
         slave_sae_id: str,
+        path: list[str],
+        discovered_network: list,
+        settings: Settings
+):
+    # Remove the key from wherever it got on the failed path, so no orphan stays behind in a key pool. The relay
+    # usually failed on running out of its budget, so the void gets a budget of its own. The path just failed, so it
+    # is tried once, without retries on any of its hops
+    try:
+        post_request(path[1], f'/api/v1/kmapi/v1/void', {
+            'key_ids': [key_id],
+            'initiator_sae_id': master_sae_id,
+            'target_sae_id': slave_sae_id,
+            'end_sae_id': slave_sae_id,
+            'path_to_go': path[1:],
+            'discovered_network': discovered_network
+        }, Deadline(settings.deadline.budget))
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+
+
+def _carve_keys(
+        kmes: list[AttachedKmes],
+        trusted_node_id: str,
         number: int,
         size: int,
+        deadline: Deadline | None = None
+) -> list[dict]:
+    # Several keys can be cut from the same QKD key, so each of them gets an ID of its own
+    return [
+        {
+            'key_ID': str(uuid4()),
+            'key': base64.b64encode(material).decode('ascii'),
+            'segments': segments,
+            'kme_id': kme_id
+        }
+        for kme_id, material, segments in take_from_links(kmes, trusted_node_id, number, size // 8, deadline)
+    ]
+
+
+def _build_delivery_tree(root_id: str, paths: dict[str, list[str]]) -> DeliveryTree:
+    """Merges the paths to the slave SAEs into a tree, so that the links shared by several paths are used once."""
+    tree = DeliveryTree(trusted_node_id=root_id)
+
+    for slave_sae_id, path in paths.items():
+        node = tree
+
+        for trusted_node_id in path[1:]:
+            branch = next((branch for branch in node.branches if branch.trusted_node_id == trusted_node_id), None)
+
+            if branch is None:
+                branch = DeliveryTree(trusted_node_id=trusted_node_id)
+                node.branches.append(branch)
+
+            node = branch
+
+        node.slave_sae_ids.append(slave_sae_id)
+
+    return tree
+
+
+def _get_group_encryption_keys(
+        master_sae_id: str,
+        slave_sae_ids: list[str],
+        number: int,
+        size: int,
+        point_a: WalkedNode,
+        trusted_nodes: list[WalkedNode],
+        discovered_network: list,
         settings: Settings,
-        lifecycle: Lifecycle
+        lifecycle: Lifecycle,
+        deadline: Deadline
 ):
-    # Get list of all trusted nodes
-    trusted_nodes = discover_trusted_nodes()
+    paths: dict[str, list[str]] = {}
+
+    for slave_sae_id in slave_sae_ids:
+        point_b: WalkedNode | None = None
+
+        for trusted_node in trusted_nodes:
+            if trusted_node.trusted_node_id != settings.id and slave_sae_id in trusted_node.sae_ids:
+                point_b = trusted_node
+                break
+
+        if not point_b:
+            raise HTTPException(status_code=400, detail=f'The slave SAE {slave_sae_id} cannot be routed to')
+
+        paths[slave_sae_id] = _find_reserved_path(
+            point_a.trusted_node_id,
+            point_b.trusted_node_id,
+            trusted_nodes,
+            number,
+            size,
+            discovered_network,
+            deadline=deadline
+        )
+
+    tree = _build_delivery_tree(point_a.trusted_node_id, paths)
+    nodes_by_id = _index_nodes(trusted_nodes)
+    first_hop_kmes = []
+
+    for branch in tree.branches:
+        kmes = _get_shared_kmes(nodes_by_id[branch.trusted_node_id])
+
+        if len(kmes) == 0:
+            raise HTTPException(
+                status_code=400,
+                detail='Unable to find proper path to nodes, probably configuration error'
+            )
+
+        first_hop_kmes.append(kmes)
+
+    # The group key comes from the links towards the first slave SAE, the other first hops get it encrypted with keys
+    # of their own links
+    keys = _carve_keys(first_hop_kmes[0], tree.branches[0].trusted_node_id, number, size, deadline)
+
+    link_keys = [
+        take_from_links(kmes, branch.trusted_node_id, len(keys), size // 8, deadline)
+        for kmes, branch in zip(first_hop_kmes[1:], tree.branches[1:])
+    ]
+
+    primary_path = paths[slave_sae_ids[0]]
+
+    def relay_key(index: int, key: dict) -> dict | None:
+        key_material = base64.b64decode(key['key'])
+
+        lifecycle.key_manager.add_activated_key(
+            master_sae_id,
+            slave_sae_ids[0],
+            UUID(key['key_ID']),
+            key_material,
+            receivers=len(slave_sae_ids),
+            notify=False,
+            slave_sae_ids=slave_sae_ids
+        )
+
+        log_key_event('key_sent', key_id=key['key_ID'], to_slave_sae_ids=slave_sae_ids)
+
+        try:
+            for branch_index, branch in enumerate(tree.branches):
+                kme_id, segments, xor_key = key['kme_id'], key['segments'], None
+
+                if branch_index > 0:
+                    kme_id, link_material, segments = link_keys[branch_index - 1][index]
+                    xor_key = base64.b64encode(xor_keys(key_material, link_material)).decode('ascii')
+
+                try:
+                    post_request(branch.trusted_node_id, f'/api/v1/kmapi/v1/ext_keys', {
+                        'first_key_id': key['key_ID'],
+                        'key_id': segments[0]['key_ID'],
+                        'key': xor_key,
+                        'segments': segments,
+                        'kme_id': kme_id,
+                        'initiator_trusted_node_id': settings.id,
+                        'initiator_sae_id': master_sae_id,
+                        'target_trusted_node_id': primary_path[-1],
+                        'target_sae_node_id': slave_sae_ids[0],
+                        'path_to_go': primary_path[1:],
+                        'discovered_network': discovered_network,
+                        'delivery_tree': branch,
+                        'hop_sequence': 1
+                    }, deadline, idempotent=True)
+                except (requests.exceptions.RequestException, ValueError):
+                    discard_segments(kme_id, branch.trusted_node_id, segments)
+                    raise
+
+            return {'key_ID': key['key_ID'], 'key': key['key']}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error('Failed to relay key %s to the group of %s: %s', key['key_ID'], slave_sae_ids, e)
+
+        # A key is only of use when every slave SAE of the group got it
+        for slave_sae_id, path in paths.items():
+            _roll_back_key(key['key_ID'], master_sae_id, slave_sae_id, path, discovered_network, settings)
+
+        lifecycle.key_manager.deactivate_key(key['key_ID'], all_receivers=True)
+
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(settings.max_concurrent_relays, len(keys)))) as executor:
+        key_containers = [key for key in executor.map(relay_key, range(len(keys)), keys) if key is not None]
+
+    if len(keys) > 0 and len(key_containers) == 0:
+        if deadline.expired():
+            raise HTTPException(status_code=504, detail='None of the keys could be relayed to the slave SAEs in time')
+
+        raise HTTPException(status_code=400, detail='None of the keys could be relayed to the slave SAEs')
+
+    return {'keys': key_containers}
+
+
+def _count_relays_in_flight(trusted_node_id: str, number: int):
+    with _relays_in_flight_lock:
+        count = _relays_in_flight.get(trusted_node_id, 0) + number
+
+        if count > 0:
+            _relays_in_flight[trusted_node_id] = count
+        else:
+            _relays_in_flight.pop(trusted_node_id, None)
+
+
+def _choose_replica(settings: Settings, trusted_nodes: list[WalkedNode], replicas: list[WalkedNode]) -> WalkedNode:
+    # The SAE is attached to several trusted nodes, take the one that is cheapest to reach, counting the keys that
+    # are already on their way to each of them, so the load spreads over the replicas
+    costs = find_path_costs(settings.id, trusted_nodes, {(settings.id, peer_id) for peer_id in get_open_circuits()})
+
+    return min(
+        replicas,
+        key=lambda node: (
+            costs.get(node.trusted_node_id, math.inf) +
+            settings.replica_load_weight * _relays_in_flight.get(node.trusted_node_id, 0)
+        )
+    )
+
+
+def _find_trusted_node_of_sae(
+        settings: Settings,
+        trusted_nodes: list[WalkedNode],
+        sae_id: str,
+        trusted_node_id: str | None = None
+) -> WalkedNode | None:
+    replicas = [node for node in trusted_nodes if node.trusted_node_id != settings.id and sae_id in node.sae_ids]
+
+    # The trusted node the key was relayed with, when it is known
+    for trusted_node in replicas:
+        if trusted_node.trusted_node_id == trusted_node_id:
+            return trusted_node
+
+    if len(replicas) == 1:
+        return replicas[0]
+
+    if len(replicas) > 1:
+        return _choose_replica(settings, trusted_nodes, replicas)
+
+    # An SAE of another area is reached through the nearest border node summarizing it, which can be this one
+    return min(
+        (node for node in trusted_nodes if sae_id in node.summarized_sae_ids),
+        key=lambda node: node.distance,
+        default=None
+    )
 
+
+def _find_end_points(
+        settings: Settings,
+        trusted_nodes: list[WalkedNode],
+        slave_sae_id: str,
+        role: str = 'slave_sae_id',
+        trusted_node_id: str | None = None
+) -> tuple[WalkedNode, WalkedNode]:
     point_a: WalkedNode = list(filter(
         lambda node: node.trusted_node_id == settings.id and node.distance == 0,
         trusted_nodes)
@@ -37,127 +406,433 @@ def get_encryption_keys(
     if not point_a:
         raise HTTPException(status_code=400, detail='This should not have happened')
 
-    point_b: WalkedNode | None = None
-
-    for trusted_node in trusted_nodes:
-        if trusted_node.trusted_node_id != settings.id and slave_sae_id in trusted_node.sae_ids:
-            point_b = trusted_node
-            break
+    point_b = _find_trusted_node_of_sae(settings, trusted_nodes, slave_sae_id, trusted_node_id)
 
     if not point_b:
-        raise HTTPException(status_code=400, detail='The given slave_sae_id cannot be routed to')
+        raise HTTPException(status_code=400, detail=f'The given {role} cannot be routed to')
 
-    # Find the path of the least distance
-    path_to_go = find_shortest_path(
-        point_a_id=point_a.trusted_node_id,
-        point_b_id=point_b.trusted_node_id,
-        trusted_nodes=trusted_nodes
-    )
+    return point_a, point_b
 
-    key_containers = []
 
-    # Check all the statuses (maybe) to ensure reliable delivery
-    for trusted_node_id in path_to_go:
-        if trusted_node_id == settings.id:
-            continue
+def find_path_to_other_area(
+        settings: Settings,
+        sae_id: str,
+        incoming_area: str | None
+) -> tuple[list[WalkedNode], list[str]]:
+    """
+    Finds the path from this border node to the SAE through one of the areas it borders on, other than the one the
+    request came from. Returns the trusted nodes of that area and the path.
+    """
+    for area in sorted((get_neighbour_areas(settings) | {settings.area}) - {incoming_area}, key=str):
+        trusted_nodes = get_area_view(area, [incoming_area])
+        point_b = _find_trusted_node_of_sae(settings, trusted_nodes, sae_id)
 
-        trusted_node = _get_node_by_id(trusted_nodes, trusted_node_id)
+        if point_b is not None and point_b.trusted_node_id != settings.id:
+            return trusted_nodes, _find_path(settings.id, point_b.trusted_node_id, trusted_nodes)
 
-        for kme in settings.attached_kmes:
-            # Select attached KME
-            if kme.distance != 0:
-                continue
+    raise HTTPException(status_code=400, detail=f'The SAE {sae_id} cannot be routed to from {settings.id}')
 
-            # Select only that KME that is possible to be accessed by the other trusted node
-            if kme.kme_id not in trusted_node.kme_ids:
-                continue
 
-            response = get_request(
-                kme.kme_id,
-                f'/api/v1/keys/{trusted_node_id}/enc_keys?number={number}&size={size}'
-            )
+def _discover_route(
+        settings: Settings,
+        sae_id: str,
+        role: str = 'slave_sae_id',
+        trusted_node_id: str | None = None
+) -> tuple[list[WalkedNode], WalkedNode, WalkedNode]:
+    # Get list of all trusted nodes of the area
+    trusted_nodes = discover_trusted_nodes()
 
-            for key in response['keys']:
-                print(f'key to send: {key["key_ID"]}, {key["key"][:20]}')
+    point_a, point_b = _find_end_points(settings, trusted_nodes, sae_id, role, trusted_node_id)
 
-                lifecycle.key_manager.add_activated_key(master_sae_id, slave_sae_id, KeyContainer(**key))
+    # This node is the border the SAE is reached through, so the route starts in the next area right away
+    if point_b.trusted_node_id == settings.id:
+        trusted_nodes, path = find_path_to_other_area(settings, sae_id, settings.area)
+        nodes_by_id = _index_nodes(trusted_nodes)
+        point_a, point_b = nodes_by_id[path[0]], nodes_by_id[path[-1]]
 
-                response = post_request(trusted_node_id, f'/api/v1/kmapi/v1/ext_keys', {
-                    'first_key_id': key['key_ID'],
-                    'key_id': key['key_ID'],
-                    'initiator_trusted_node_id': settings.id,
-                    'initiator_sae_id': master_sae_id,
-                    'target_trusted_node_id': point_b.trusted_node_id,
-                    'target_sae_node_id': slave_sae_id,
-                    'path_to_go': path_to_go[1:],
-                    'discovered_network': trusted_nodes
-                })
+    return trusted_nodes, point_a, point_b
 
-                key_containers.append(response)
 
-        return {'keys': key_containers}
+def _relay_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        number: int,
+        size: int,
+        settings: Settings,
+        lifecycle: Lifecycle,
+        deadline: Deadline,
+        predistributed: bool = False
+) -> list[dict]:
+    trusted_nodes, point_a, point_b = _discover_route(settings, slave_sae_id)
+
+    discovered_network = jsonable_encoder(trusted_nodes)
+
+    # Find the path of the least distance, which has enough key material on every hop
+    path_to_go = _find_reserved_path(
+        point_a.trusted_node_id,
+        point_b.trusted_node_id,
+        trusted_nodes,
+        number,
+        size,
+        discovered_network,
+        deadline=deadline
+    )
 
-    raise HTTPException(
-        status_code=400,
-        detail='Unable to find proper path to nodes, probably configuration error'
+    first_trusted_node_id = path_to_go[1]
+    nodes_by_id = _index_nodes(trusted_nodes)
+    kmes = _get_shared_kmes(nodes_by_id[first_trusted_node_id])
+
+    if len(kmes) == 0:
+        raise HTTPException(
+            status_code=400,
+            detail='Unable to find proper path to nodes, probably configuration error'
+        )
+
+    def send_key(first_key_id: str, key: str | None, kme_id: str, segments: list[dict], path: list[str]) -> dict:
+        try:
+            return post_request(path[1], f'/api/v1/kmapi/v1/ext_keys', {
+                'first_key_id': first_key_id,
+                'key_id': segments[0]['key_ID'],
+                'key': key,
+                'segments': segments,
+                'kme_id': kme_id,
+                'initiator_trusted_node_id': settings.id,
+                'initiator_sae_id': master_sae_id,
+                'target_trusted_node_id': point_b.trusted_node_id,
+                'target_sae_node_id': slave_sae_id,
+                'path_to_go': path[1:],
+                'discovered_network': discovered_network,
+                'predistributed': predistributed,
+                # Keys relayed ahead of demand are only kept once they got through the whole path
+                'acknowledge_early': settings.async_relay.enabled and not predistributed,
+                'hop_sequence': 1
+            }, deadline, idempotent=True)
+        except (requests.exceptions.RequestException, ValueError):
+            discard_segments(kme_id, path[1], segments)
+            raise
+
+    def reroute_key(key_id: str, key_material: bytes, failed_path: list[str]) -> dict:
+        # The key itself is still good, only the path failed. Send it over a path that does not share any link with
+        # the failed one, encrypted with a fresh key of the new first link, so no key material is wasted
+        alternate_path = _find_reserved_path(
+            point_a.trusted_node_id,
+            point_b.trusted_node_id,
+            trusted_nodes,
+            1,
+            size,
+            discovered_network,
+            _get_links(failed_path),
+            deadline
+        )
+
+        alternate_kmes = _get_shared_kmes(nodes_by_id[alternate_path[1]])
+
+        if len(alternate_kmes) == 0:
+            raise HTTPException(status_code=400, detail=f'No KME is shared with {alternate_path[1]}')
+
+        (kme_id, link_material, segments), = take_from_links(
+            alternate_kmes,
+            alternate_path[1],
+            1,
+            len(key_material),
+            deadline
+        )
+
+        xor_key = base64.b64encode(xor_keys(key_material, link_material)).decode('ascii')
+
+        return send_key(key_id, xor_key, kme_id, segments, alternate_path)
+
+    def relay_key(key: dict) -> dict | None:
+        log_key_event('key_sent', key_id=key['key_ID'], to_trusted_node_id=first_trusted_node_id)
+
+        key_material = base64.b64decode(key['key'])
+
+        # The slave SAE is attached to another trusted node, there is no one to notify here
+        lifecycle.key_manager.add_activated_key(
+            master_sae_id,
+            slave_sae_id,
+            UUID(key['key_ID']),
+            key_material,
+            notify=False,
+            peer_trusted_node_id=point_b.trusted_node_id
+        )
+
+        try:
+            return send_key(key['key_ID'], None, key['kme_id'], key['segments'], path_to_go)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning('Failed to relay key %s over %s, trying another path: %s', key['key_ID'], path_to_go, e)
+
+        _roll_back_key(key['key_ID'], master_sae_id, slave_sae_id, path_to_go, discovered_network, settings)
+
+        try:
+            # Another path is only worth a try while there is time left for it
+            if deadline.expired():
+                raise DeadlineExceededError('No time is left to try another path')
+
+            return reroute_key(key['key_ID'], key_material, path_to_go)
+        except (requests.exceptions.RequestException, ValueError, HTTPException) as e:
+            logger.error('Failed to relay key %s to %s: %s', key['key_ID'], point_b.trusted_node_id, e)
+
+        # Do not leave a key in the pool that the slave SAE will never be able to get
+        lifecycle.key_manager.deactivate_key(key['key_ID'])
+
+        return None
+
+    _count_relays_in_flight(point_b.trusted_node_id, number)
+
+    try:
+        keys = _carve_keys(kmes, first_trusted_node_id, number, size, deadline)
+
+        # Relay the keys concurrently, but keep them in the order they were cut from the QKD keys
+        with ThreadPoolExecutor(max_workers=max(1, min(settings.max_concurrent_relays, len(keys)))) as executor:
+            key_containers = [key for key in executor.map(relay_key, keys) if key is not None]
+    finally:
+        _count_relays_in_flight(point_b.trusted_node_id, -number)
+
+    if len(keys) > 0 and len(key_containers) == 0:
+        if deadline.expired():
+            raise HTTPException(status_code=504, detail='None of the keys could be relayed to the slave SAE in time')
+
+        raise HTTPException(status_code=400, detail='None of the keys could be relayed to the slave SAE')
+
+    return key_containers
+
+
+def predistribute_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        number: int,
+        size: int,
+        settings: Settings,
+        lifecycle: Lifecycle
+) -> list[str]:
+    keys = _relay_keys(
+        master_sae_id,
+        slave_sae_id,
+        number,
+        size,
+        settings,
+        lifecycle,
+        Deadline(settings.deadline.budget),
+        predistributed=True
     )
 
+    return [key['key_ID'] for key in keys]
 
-def get_decryption_keys(
+
+def _get_key_ids_by_peer(activated_keys: list[ActivatedKey]) -> dict[str, list[str]]:
+    # The trusted nodes the keys were relayed to
+    key_ids_by_peer: dict[str, list[str]] = {}
+
+    for key in activated_keys:
+        if key.peer_trusted_node_id is not None:
+            key_ids_by_peer.setdefault(key.peer_trusted_node_id, []).append(str(key.key_uuid))
+
+    return key_ids_by_peer
+
+
+def _find_path_to_peer(
+        settings: Settings,
+        slave_sae_id: str,
+        peer_trusted_node_id: str
+) -> tuple[list[WalkedNode], list[str]]:
+    trusted_nodes, point_a, point_b = _discover_route(settings, slave_sae_id, trusted_node_id=peer_trusted_node_id)
+
+    return trusted_nodes, _find_path(point_a.trusted_node_id, point_b.trusted_node_id, trusted_nodes)
+
+
+def _release_predistributed_keys(
         master_sae_id: str,
         slave_sae_id: str,
-        key_ids: list[UUID],
+        key_ids_by_peer: dict[str, list[str]],
+        settings: Settings
+):
+    # The slave SAE was not told about the keys while they were held in reserve, the trusted nodes they were relayed
+    # to announce them now
+    for peer_trusted_node_id, key_ids in key_ids_by_peer.items():
+        try:
+            trusted_nodes, path_to_go = _find_path_to_peer(settings, slave_sae_id, peer_trusted_node_id)
+
+            post_request(path_to_go[1], f'/api/v1/kmapi/v1/release', {
+                'key_ids': key_ids,
+                'initiator_sae_id': master_sae_id,
+                'target_sae_id': slave_sae_id,
+                'path_to_go': path_to_go[1:],
+                'discovered_network': jsonable_encoder(trusted_nodes)
+            }, Deadline(settings.deadline.budget))
+        except (requests.exceptions.RequestException, ValueError, HTTPException) as e:
+            logger.warning('Failed to announce the pre-distributed keys %s to %s: %s', key_ids, slave_sae_id, e)
+
+
+def void_predistributed_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        key_ids: list[str],
         settings: Settings,
         lifecycle: Lifecycle
 ):
-    # Get list of all trusted nodes
-    trusted_nodes = discover_trusted_nodes()
+    """Voids keys that were held in reserve for too long, at the trusted nodes they were relayed to and here."""
+    key_ids_by_peer = _get_key_ids_by_peer(lifecycle.key_manager.get_activated_keys_by_id(key_ids))
 
-    point_a: WalkedNode = list(filter(
-        lambda node: node.trusted_node_id == settings.id and node.distance == 0,
-        trusted_nodes)
-    )[0]
+    for peer_trusted_node_id, peer_key_ids in key_ids_by_peer.items():
+        try:
+            trusted_nodes, path_to_go = _find_path_to_peer(settings, slave_sae_id, peer_trusted_node_id)
 
-    if not point_a:
-        raise HTTPException(status_code=400, detail='This should not have happened')
+            post_request(path_to_go[1], f'/api/v1/kmapi/v1/void', {
+                'key_ids': peer_key_ids,
+                'initiator_sae_id': master_sae_id,
+                'target_sae_id': slave_sae_id,
+                'end_sae_id': slave_sae_id,
+                'path_to_go': path_to_go[1:],
+                'discovered_network': jsonable_encoder(trusted_nodes),
+                'hop_sequence': 1
+            }, Deadline(settings.deadline.budget), idempotent=True)
+        except (requests.exceptions.RequestException, ValueError, HTTPException) as e:
+            logger.warning('Failed to void the expired keys %s at %s: %s', peer_key_ids, peer_trusted_node_id, e)
 
-    point_b: WalkedNode | None = None
+    for key_id in key_ids:
+        try:
+            lifecycle.key_manager.deactivate_key(key_id)
+        except ValueError:
+            pass
 
-    for trusted_node in trusted_nodes:
-        if trusted_node.trusted_node_id != settings.id and master_sae_id in trusted_node.sae_ids:
-            point_b = trusted_node
-            break
 
-    if not point_b:
-        raise HTTPException(status_code=400, detail='The given master_sae_id cannot be routed to')
+def _claim_predistributed_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        number: int,
+        size: int,
+        settings: Settings,
+        lifecycle: Lifecycle,
+        background_tasks: BackgroundTasks | None
+) -> list[dict]:
+    key_ids = lifecycle.predistributor.claim(master_sae_id, slave_sae_id, size, number)
+    activated_keys = lifecycle.key_manager.get_activated_keys_by_id(key_ids)
+    keys = lifecycle.key_manager.export_keys(activated_keys, metadata_only=False)
+    key_ids_by_peer = _get_key_ids_by_peer(activated_keys)
 
-    # Find the path of the least distance
-    path_to_go = find_shortest_path(
-        point_a_id=point_a.trusted_node_id,
-        point_b_id=point_b.trusted_node_id,
-        trusted_nodes=trusted_nodes
+    # Announced once the response is sent, the master SAE does not wait for it
+    if len(key_ids_by_peer) > 0 and background_tasks is not None:
+        background_tasks.add_task(_release_predistributed_keys, master_sae_id, slave_sae_id, key_ids_by_peer, settings)
+    elif len(key_ids_by_peer) > 0:
+        _release_predistributed_keys(master_sae_id, slave_sae_id, key_ids_by_peer, settings)
+
+    return [{'key_ID': str(key.key_ID), 'key': key.key} for key in keys]
+
+
+def get_encryption_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        number: int,
+        size: int | None,
+        settings: Settings,
+        lifecycle: Lifecycle,
+        additional_slave_sae_ids: list[str] | None = None,
+        background_tasks: BackgroundTasks | None = None
+):
+    size = _resolve_key_size(size, settings)
+    deadline = Deadline(settings.deadline.budget)
+
+    # The key material of the links is taken in batches, a single request must not be able to drain them
+    if number > settings.max_keys_per_request:
+        raise HTTPException(
+            status_code=400,
+            detail=f'At most {settings.max_keys_per_request} keys can be requested at once'
+        )
+
+    if additional_slave_sae_ids:
+        additional_slave_sae_ids = [
+            sae_id for sae_id in dict.fromkeys(additional_slave_sae_ids) if sae_id != slave_sae_id
+        ]
+
+        if len(additional_slave_sae_ids) > settings.max_sae_id_count:
+            raise HTTPException(
+                status_code=400,
+                detail=f'At most {settings.max_sae_id_count} additional slave SAEs are supported'
+            )
+
+    if additional_slave_sae_ids:
+        # Get list of all trusted nodes
+        trusted_nodes = discover_trusted_nodes()
+
+        point_a, _ = _find_end_points(settings, trusted_nodes, slave_sae_id)
+
+        return _get_group_encryption_keys(
+            master_sae_id,
+            [slave_sae_id, *additional_slave_sae_ids],
+            number,
+            size,
+            point_a,
+            trusted_nodes,
+            jsonable_encoder(trusted_nodes),
+            settings,
+            lifecycle,
+            deadline
+        )
+
+    if not settings.predistribution.enabled:
+        return {'keys': _relay_keys(master_sae_id, slave_sae_id, number, size, settings, lifecycle, deadline)}
+
+    lifecycle.predistributor.record_demand(master_sae_id, slave_sae_id, size, number)
+
+    # Keys relayed ahead of demand are at hand already, only the rest is relayed now
+    keys = _claim_predistributed_keys(master_sae_id, slave_sae_id, number, size, settings, lifecycle, background_tasks)
+
+    if len(keys) == number:
+        return {'keys': keys}
+
+    lifecycle.predistributor.begin_relay()
+
+    try:
+        keys += _relay_keys(master_sae_id, slave_sae_id, number - len(keys), size, settings, lifecycle, deadline)
+    except (HTTPException, DeadlineExceededError):
+        # Better the keys that are at hand than none
+        if len(keys) == 0:
+            raise
+    finally:
+        lifecycle.predistributor.end_relay()
+
+    return {'keys': keys}
+
+
+def get_decryption_keys(
+        master_sae_id: str,
+        slave_sae_id: str,
+        key_ids: list[UUID],
+        settings: Settings,
+        lifecycle: Lifecycle
+):
+    # The key was relayed from one of the trusted nodes the master SAE is attached to, void it on that one
+    peer_trusted_node_ids = [
+        key.peer_trusted_node_id
+        for key in lifecycle.key_manager.get_activated_keys_by_id([str(key_id) for key_id in key_ids])
+        if key.peer_trusted_node_id is not None
+    ]
+
+    trusted_nodes, point_a, point_b = _discover_route(
+        settings,
+        master_sae_id,
+        'master_sae_id',
+        peer_trusted_node_ids[0] if len(peer_trusted_node_ids) > 0 else None
     )
 
+    # Find the path of the least distance
+    path_to_go = _find_path(point_a.trusted_node_id, point_b.trusted_node_id, trusted_nodes)
+
+    nodes_by_id = _index_nodes(trusted_nodes)
+
     # Check all the statuses (maybe) to ensure reliable delivery
     for trusted_node_id in path_to_go:
         if trusted_node_id == settings.id:
             continue
 
-        trusted_node = _get_node_by_id(trusted_nodes, trusted_node_id)
-
-        for kme in settings.attached_kmes:
-            # Select attached KME
-            if kme.distance != 0:
-                continue
-
-            # Select only that KME that is possible to be accessed by the other trusted node
-            if kme.kme_id not in trusted_node.kme_ids:
-                continue
+        trusted_node = nodes_by_id[trusted_node_id]
 
+        if len(get_link_table().get_shared_kmes(trusted_node.kme_ids)) > 0:
             for key_id in key_ids:
                 key_id = str(key_id)
 
-                print(f'key to deactivate: {key_id}')
+                log_key_event('key_deactivated', key_id=key_id, master_sae_id=master_sae_id)
 
                 lifecycle.key_manager.deactivate_key(key_id)
 
@@ -165,9 +840,11 @@ def get_decryption_keys(
                 'key_ids': key_ids,
                 'initiator_sae_id': master_sae_id,
                 'target_sae_id': slave_sae_id,
+                'end_sae_id': master_sae_id,
                 'path_to_go': path_to_go[1:],
-                'discovered_network': trusted_nodes
-            })
+                'discovered_network': trusted_nodes,
+                'hop_sequence': 1
+            }, Deadline(settings.deadline.budget), idempotent=True)
 
             return {'keys': response}
 
@@ -1,37 +1,156 @@
-from typing import Any
+import time
+from typing import Any, Callable
 
 import requests
 from fastapi.encoders import jsonable_encoder
 
-from app.config import AttachedKmes, AttachedTrustedNodes
-from app.dependencies import get_settings
+from app.config import Settings, TransportSettings, get_settings
+from app.internal.circuit_breaker import CircuitOpenError, get_circuit_breaker
+from app.internal.deadline import Deadline, DeadlineExceededError, get_peer_latencies, get_timeout
+from app.internal.link_table import get_link_table
+from app.internal.transports import Transport, create_transport
 
+# Keep-alive connection pools (or local transports), one per peer URL, client certificate and transport
+_sessions: dict[tuple, Transport] = {}
 
-def get_request(kme_id: str, endpoint: str) -> Any:
-    settings = get_settings()
 
-    kme: AttachedKmes = list(filter(lambda kme: kme.kme_id == kme_id, settings.attached_kmes))[0]
+def _session_key(url: str, cert: str, key: str, transport: TransportSettings) -> tuple:
+    return url, cert, key, transport.type, transport.socket_path, transport.app
 
-    return requests.get(
+
+def get_session(url: str, cert: str, key: str, transport: TransportSettings = TransportSettings()) -> Transport:
+    session_key = _session_key(url, cert, key, transport)
+    session = _sessions.get(session_key)
+
+    if session is None:
+        session = _sessions.setdefault(session_key, create_transport(transport, cert, key))
+
+    return session
+
+
+def prune_sessions(settings: Settings) -> int:
+    """Closes the connection pools of peers that are no longer configured, keeping all the others warm."""
+    configured = {_session_key(kme.url, kme.sae_cert, kme.sae_key, kme.transport) for kme in settings.attached_kmes}
+    configured |= {
+        _session_key(node.url, node.cert, node.key, node.transport) for node in settings.attached_trusted_nodes
+    }
+
+    stale = [session_key for session_key in _sessions if session_key not in configured]
+
+    for session_key in stale:
+        _sessions.pop(session_key).close()
+
+    return len(stale)
+
+
+def _send(peer_id: str, send: Callable[[float], requests.Response], deadline: Deadline | None = None) -> Any:
+    breaker = get_circuit_breaker(peer_id)
+
+    if not breaker.allow_request():
+        raise CircuitOpenError(f'The circuit to {peer_id} is open, not calling it')
+
+    settings = get_settings().deadline
+    timeout, cut_short = get_timeout(peer_id, deadline, settings)
+    started_at = time.monotonic()
+
+    try:
+        response = send(timeout)
+    except requests.exceptions.Timeout as e:
+        # The peer was not given its usual time, that does not make it a failing one
+        if cut_short:
+            raise DeadlineExceededError(f'Ran out of the budget waiting for {peer_id}') from e
+
+        breaker.record_failure()
+        raise
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        raise
+
+    get_peer_latencies(peer_id, settings).record(time.monotonic() - started_at)
+
+    # A client error still means that the peer is up and responding, so does a bad gateway or a gateway timeout,
+    # which a trusted node returns when a hop further down the path failed or ran out of the budget
+    if response.status_code >= 500 and response.status_code not in (502, 504):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    response.raise_for_status()
+
+    return response.json()
+
+
+def get_request(kme_id: str, endpoint: str, deadline: Deadline | None = None) -> Any:
+    kme = get_link_table().kmes[kme_id]
+
+    return _send(kme_id, lambda timeout: get_session(kme.url, kme.sae_cert, kme.sae_key, kme.transport).get(
         url=f'{kme.url}{endpoint}',
-        verify=False,
-        cert=(kme.sae_cert, kme.sae_key),
-        timeout=5
-    ).json()
-
-
-def post_request(trusted_node_id: str, endpoint: str, json) -> Any:
-    settings = get_settings()
-
-    trusted_node: AttachedTrustedNodes = list(filter(
-        lambda tn: tn.id == trusted_node_id,
-        settings.attached_trusted_nodes)
-    )[0]
-
-    return requests.post(
-        url=f'{trusted_node.url}{endpoint}',
-        verify=False,
-        cert=(trusted_node.cert, trusted_node.key),
-        timeout=5,
-        json=jsonable_encoder(json)
-    ).json()
+        timeout=timeout
+    ), deadline)
+
+
+def post_request(
+        trusted_node_id: str,
+        endpoint: str,
+        json,
+        deadline: Deadline | None = None,
+        idempotent: bool = False
+) -> Any:
+    """
+    Sends the request to the trusted node, with what will be left of the budget of the deadline when given. An
+    idempotent request (one the trusted node answers from its result cache when it sees it again) is sent again after
+    a connection error or timeout, as long as the budget allows.
+    """
+    table = get_link_table()
+    trusted_node = table.trusted_nodes[trusted_node_id]
+
+    def with_budget() -> Any:
+        if deadline is None:
+            return json
+
+        return {**json, 'timeout_budget': deadline.next_hop_budget(table.settings.deadline)}
+
+    def send() -> Any:
+        return _send(trusted_node_id, lambda timeout: get_session(
+            trusted_node.url,
+            trusted_node.cert,
+            trusted_node.key,
+            trusted_node.transport
+        ).post(
+            url=f'{trusted_node.url}{endpoint}',
+            timeout=timeout,
+            json=jsonable_encoder(with_budget())
+        ), deadline)
+
+    retries = table.settings.idempotency.retries if idempotent else 0
+
+    for retry in range(retries):
+        try:
+            return send()
+        except (CircuitOpenError, DeadlineExceededError):
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            time.sleep(table.settings.idempotency.backoff * 2 ** retry)
+
+    return send()
+
+
+def probe_peer(peer_id: str) -> bool:
+    """
+    Checks whether a KME or trusted node responds at all, bypassing its circuit breaker. Trusted nodes are asked for
+    /kmapi/versions, KMEs (which do not have it) for their root URL.
+    """
+    table = get_link_table()
+
+    if peer_id in table.kmes:
+        kme = table.kmes[peer_id]
+        session, url = get_session(kme.url, kme.sae_cert, kme.sae_key, kme.transport), f'{kme.url}/'
+    else:
+        trusted_node = table.trusted_nodes[peer_id]
+        session = get_session(trusted_node.url, trusted_node.cert, trusted_node.key, trusted_node.transport)
+        url = f'{trusted_node.url}/api/v1/kmapi/versions'
+
+    try:
+        return session.get(url=url, timeout=table.settings.circuit_breaker.probe_timeout).status_code < 500
+    except requests.exceptions.RequestException:
+        return False
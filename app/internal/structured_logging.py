@@ -0,0 +1,99 @@
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from app.config import LoggingSettings
+
+# Relay events, one line of JSON each
+relay_logger = logging.getLogger('uvicorn.error.relay')
+
+REDACTED_FIELDS = frozenset({'key', 'key_material', 'xor_key'})
+
+_sample_rate = 1.0
+_listener: QueueListener | None = None
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # The default prepare() formats the record in the calling thread, here that is left to the listener thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+
+        for name, value in getattr(record, 'fields', {}).items():
+            event[name] = '<redacted>' if name in REDACTED_FIELDS else value
+
+        return json.dumps(event, default=str)
+
+
+def log_key_event(event: str, **fields):
+    """
+    Logs an event of a single key, of which there are several per key and hop. Only a sample_rate share of them is
+    logged, the formatting and writing are done by the listener thread.
+    """
+    if not relay_logger.isEnabledFor(logging.INFO):
+        return
+
+    if _sample_rate < 1 and random.random() >= _sample_rate:
+        return
+
+    relay_logger.info(event, extra={'fields': fields})
+
+
+def apply_logging_settings(settings: LoggingSettings):
+    global _sample_rate
+
+    relay_logger.setLevel(settings.level)
+    _sample_rate = settings.key_event_sample_rate
+
+
+def start_structured_logging(settings: LoggingSettings):
+    global _listener
+
+    apply_logging_settings(settings)
+
+    if settings.file is not None:
+        handler = logging.FileHandler(settings.file, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+
+    handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+
+    relay_logger.addHandler(_DeferredQueueHandler(records))
+    relay_logger.propagate = False
+
+    _listener = QueueListener(records, handler)
+    _listener.start()
+
+
+def stop_structured_logging():
+    global _listener
+
+    if _listener is None:
+        return
+
+    # Writes out what is still queued
+    _listener.stop()
+
+    for handler in _listener.handlers:
+        handler.close()
+
+    _listener = None
+
+    for handler in list(relay_logger.handlers):
+        relay_logger.removeHandler(handler)
+
+    relay_logger.propagate = True
@@ -0,0 +1,142 @@
+import json
+import queue
+import threading
+import time
+from typing import Any
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import get_settings
+from app.internal.client_identity import SCOPE_KEY
+
+CAPTURED_PATH_PREFIXES = ('/api/v1/keys/', '/api/v1/kmapi/')
+
+REDACTED = '<redacted>'
+
+# Put into the queue of a writer to have it close its file and exit, once the records before it are written
+_STOP = object()
+
+
+def redact_key_material(body: Any) -> Any:
+    if isinstance(body, dict):
+        return {
+            field: REDACTED if field == 'key' and value is not None else redact_key_material(value)
+            for field, value in body.items()
+        }
+
+    if isinstance(body, list):
+        return [redact_key_material(item) for item in body]
+
+    return body
+
+
+class _CaptureWriter(threading.Thread):
+    """Serializes and appends the captured records off the event loop."""
+
+    def __init__(self, capture_file: str):
+        super().__init__(name='traffic-capture', daemon=True)
+
+        self.capture_file = capture_file
+        self.records: queue.SimpleQueue = queue.SimpleQueue()
+
+    def run(self):
+        with open(self.capture_file, 'a', encoding='utf-8') as file:
+            while True:
+                record = self.records.get()
+
+                if record is _STOP:
+                    return
+
+                file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+                if self.records.empty():
+                    file.flush()
+
+    def stop(self):
+        self.records.put(_STOP)
+
+
+class TrafficCaptureMiddleware:
+    """
+    Records the shape and timing of the SAE (keys) and trusted node (kmapi) requests into a JSONL file, when
+    traffic_capture_file is set. The key material in the request bodies is redacted. See replay.py for replaying it.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+        self._writer: _CaptureWriter | None = None
+
+    def _stop_writer(self):
+        # Not joined, so the event loop does not wait for the records still queued, the thread exits after them
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
+    def _get_writer(self, capture_file: str) -> _CaptureWriter:
+        if self._writer is None or self._writer.capture_file != capture_file:
+            self._stop_writer()
+
+            self._writer = _CaptureWriter(capture_file)
+            self._writer.start()
+
+        return self._writer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not scope['path'].startswith(CAPTURED_PATH_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        settings = get_settings()
+
+        if settings.traffic_capture_file is None:
+            self._stop_writer()
+
+            return await self.app(scope, receive, send)
+
+        body = bytearray()
+        response = {'status': None, 'size': 0}
+
+        async def capturing_receive() -> Message:
+            message = await receive()
+
+            if message['type'] == 'http.request':
+                body.extend(message.get('body', b''))
+
+            return message
+
+        async def capturing_send(message: Message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+
+            await send(message)
+
+        started_at = time.time()
+        started = time.perf_counter()
+
+        try:
+            await self.app(scope, capturing_receive, capturing_send)
+        finally:
+            duration = time.perf_counter() - started
+
+            identity = scope.get(SCOPE_KEY)
+            client = identity.common_name if identity is not None else None
+
+            try:
+                request_body = redact_key_material(json.loads(body)) if body else None
+            except ValueError:
+                request_body = {'unparsable_size': len(body)}
+
+            self._get_writer(settings.traffic_capture_file).records.put({
+                'timestamp': started_at,
+                'node': settings.id,
+                'client': client,
+                'method': scope['method'],
+                'path': scope['path'],
+                'query': scope['query_string'].decode('latin-1'),
+                'body': request_body,
+                'status': response['status'],
+                'response_size': response['size'],
+                'duration': duration,
+            })
@@ -0,0 +1,135 @@
+import asyncio
+import importlib
+import threading
+from typing import Any
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+from app.config import TransportSettings
+from app.internal.certificates import load_certificate_identity
+from app.internal.client_identity import IDENTITY_HEADER, SCOPE_KEY, ClientIdentity
+
+
+def _path_of(url: str) -> str:
+    # Local transports ignore the configured address of the peer, only the path and the query are sent
+    parts = urlsplit(url)
+
+    return f'{parts.path}?{parts.query}' if parts.query else parts.path
+
+
+def _to_requests_response(response: httpx.Response) -> requests.Response:
+    # Callers only know requests, so the responses and errors of httpx are converted to those of requests
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted.headers.update(response.headers)
+    converted.url = str(response.url)
+    converted.encoding = response.encoding
+    converted._content = response.content
+
+    return converted
+
+
+def _to_requests_error(error: httpx.HTTPError) -> requests.exceptions.RequestException:
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+
+    if isinstance(error, httpx.TransportError):
+        return requests.exceptions.ConnectionError(str(error))
+
+    return requests.exceptions.RequestException(str(error))
+
+
+class UnixSocketTransport:
+    """
+    Plain HTTP over the Unix domain socket of a trusted node or KME on the same host, instead of TLS over TCP. The
+    peer learns who is calling from a header, which it only accepts on its Unix socket from the same user.
+    """
+
+    def __init__(self, socket_path: str, identity: ClientIdentity):
+        self._client = httpx.Client(
+            transport=httpx.HTTPTransport(uds=socket_path),
+            base_url='http://localhost',
+            headers={IDENTITY_HEADER: f'{identity.serial_number}:{identity.common_name}'}
+        )
+
+    def _request(self, method: str, url: str, timeout: float, json: Any = None) -> requests.Response:
+        try:
+            return _to_requests_response(self._client.request(method, _path_of(url), json=json, timeout=timeout))
+        except httpx.HTTPError as e:
+            raise _to_requests_error(e) from e
+
+    def get(self, url: str, timeout: float) -> requests.Response:
+        return self._request('GET', url, timeout)
+
+    def post(self, url: str, timeout: float, json: Any = None) -> requests.Response:
+        return self._request('POST', url, timeout, json)
+
+    def close(self):
+        self._client.close()
+
+
+class AsgiTransport:
+    """
+    Calls an ASGI application loaded into this process, e.g. a stand-in KME of a test mesh, without any socket. The
+    application runs on an event loop of its own, so it can be called from the event loop of this node as well as
+    from the relay worker threads.
+    """
+
+    def __init__(self, app_path: str, identity: ClientIdentity):
+        module_name, _, attribute = app_path.partition(':')
+        app = getattr(importlib.import_module(module_name), attribute)
+
+        async def app_with_identity(scope, receive, send):
+            scope[SCOPE_KEY] = identity
+
+            await app(scope, receive, send)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name=f'asgi-{app_path}', daemon=True)
+        self._thread.start()
+
+        # The scheme is https, so the application does not redirect
+        self._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app_with_identity), base_url='https://asgi')
+
+    def _request(self, method: str, url: str, timeout: float, json: Any = None) -> requests.Response:
+        request = self._client.request(method, _path_of(url), json=json)
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(request, timeout), self._loop)
+
+        try:
+            return _to_requests_response(future.result())
+        except (asyncio.TimeoutError, TimeoutError) as e:
+            future.cancel()
+
+            raise requests.exceptions.Timeout(f'{method} {url} timed out') from e
+        except httpx.HTTPError as e:
+            raise _to_requests_error(e) from e
+
+    def get(self, url: str, timeout: float) -> requests.Response:
+        return self._request('GET', url, timeout)
+
+    def post(self, url: str, timeout: float, json: Any = None) -> requests.Response:
+        return self._request('POST', url, timeout, json)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+Transport = requests.Session | UnixSocketTransport | AsgiTransport
+
+
+def create_transport(settings: TransportSettings, cert: str, key: str) -> Transport:
+    if settings.type == 'uds':
+        return UnixSocketTransport(settings.socket_path, ClientIdentity(*load_certificate_identity(cert)))
+
+    if settings.type == 'asgi':
+        return AsgiTransport(settings.app, ClientIdentity(*load_certificate_identity(cert)))
+
+    session = requests.Session()
+    session.verify = False
+    session.cert = (cert, key)
+
+    return session
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+
+import requests
+
+from app.config import Settings
+from app.internal.discovery import discover_trusted_nodes, prime_routes
+from app.internal.key_packing import get_link_packer
+from app.internal.link_table import get_link_table
+from app.internal.requestor import probe_peer
+from app.models.discover_requests import WalkedNode
+
+logger = logging.getLogger('uvicorn.error')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+TIMED_OUT = 'timed_out'
+
+
+class WarmUp:
+    """
+    Gets a (re)started trusted node ready for the first SAE requests: it opens the connection pools to all the
+    attached KMEs and trusted nodes, discovers the network and caches the routes to the SAEs, and optionally fills
+    the key buffers of the links. The node reports ready once it is done, or gave up after the timeout.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {
+            'connections': {'state': PENDING},
+            'routes': {'state': PENDING},
+            'key_buffers': {'state': PENDING},
+        }
+
+        self._started_at: float | None = None
+        self._finished_at: float | None = None
+        self._trusted_nodes: list[WalkedNode] = []
+
+    @property
+    def ready(self) -> bool:
+        return self._finished_at is not None
+
+    def get_progress(self) -> dict:
+        started_at = self._started_at or time.monotonic()
+
+        return {
+            'ready': self.ready,
+            'seconds': round((self._finished_at or time.monotonic()) - started_at, 3),
+            'stages': self.stages,
+        }
+
+    async def _connect(self, settings: Settings) -> dict:
+        peer_ids = [kme.kme_id for kme in settings.attached_kmes]
+        peer_ids += [node.id for node in settings.attached_trusted_nodes]
+
+        # The probes go through the connection pools, so the TLS handshakes are done by the time they return
+        results = await asyncio.gather(*(asyncio.to_thread(probe_peer, peer_id) for peer_id in peer_ids))
+
+        return {
+            'reachable': sum(results),
+            'unreachable': [peer_id for peer_id, is_up in zip(peer_ids, results) if not is_up],
+        }
+
+    async def _discover_routes(self) -> dict:
+        self._trusted_nodes = await asyncio.to_thread(discover_trusted_nodes)
+
+        return {'trusted_nodes': len(self._trusted_nodes), 'routes': prime_routes(self._trusted_nodes)}
+
+    def _prime_key_buffers(self, settings: Settings) -> dict:
+        table = get_link_table()
+        links = {}
+
+        for trusted_node in self._trusted_nodes:
+            if trusted_node.trusted_node_id not in table.trusted_nodes:
+                continue
+
+            for kme in table.get_shared_kmes(trusted_node.kme_ids):
+                link = f'{kme.kme_id}/{trusted_node.trusted_node_id}'
+
+                try:
+                    links[link] = get_link_packer(kme, trusted_node.trusted_node_id).prime(settings.warm_up.prime_keys)
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    logger.warning('Failed to prime the key buffer of the link %s: %s', link, e)
+
+        return {'keys_per_link': links}
+
+    async def _run_stage(self, name: str, stage):
+        self.stages[name] = {'state': RUNNING}
+        started_at = time.monotonic()
+
+        try:
+            result = await stage
+        except Exception as e:
+            logger.warning('Warm-up stage %s failed: %s', name, e)
+
+            self.stages[name] = {'state': FAILED, 'error': str(e)}
+            return
+
+        self.stages[name] = {'state': DONE, 'seconds': round(time.monotonic() - started_at, 3), **result}
+
+    async def _run_stages(self, settings: Settings):
+        await self._run_stage('connections', self._connect(settings))
+        await self._run_stage('routes', self._discover_routes())
+
+        if settings.warm_up.prime_keys > 0 and len(self._trusted_nodes) > 0:
+            await self._run_stage('key_buffers', asyncio.to_thread(self._prime_key_buffers, settings))
+        else:
+            self.stages['key_buffers'] = {'state': SKIPPED}
+
+    async def run(self, settings: Settings):
+        self._started_at = time.monotonic()
+
+        try:
+            if settings.warm_up.enabled:
+                await asyncio.wait_for(self._run_stages(settings), settings.warm_up.timeout)
+            else:
+                self.stages = {name: {'state': SKIPPED} for name in self.stages}
+        except asyncio.TimeoutError:
+            logger.warning('Warm-up did not finish in %s s, reporting ready anyway', settings.warm_up.timeout)
+
+            for name, stage in self.stages.items():
+                if stage['state'] in (PENDING, RUNNING):
+                    self.stages[name] = {'state': TIMED_OUT}
+        finally:
+            self._finished_at = time.monotonic()
+
+        logger.info('Warm-up finished: %s', self.get_progress())
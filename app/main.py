@@ -8,7 +8,11 @@ from fastapi.responses import JSONResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from app.dependencies import get_settings
+from app.internal.deadline import DeadlineExceededError
 from app.internal.lifecycle import Lifecycle
+from app.internal.profiler import ProfilingMiddleware
+from app.internal.request_processor import predistribute_keys, void_predistributed_keys
+from app.internal.traffic_capture import TrafficCaptureMiddleware
 from app.routers import keys, discover, kmapi, internal
 
 
@@ -20,12 +24,24 @@ async def lifespan(api: FastAPI):
     api.lifecycle = lifecycle
 
     await lifecycle.before_start()
+
+    lifecycle.start_predistribution(
+        lambda master_sae_id, slave_sae_id, number, size: predistribute_keys(
+            master_sae_id, slave_sae_id, number, size, lifecycle.settings, lifecycle
+        ),
+        lambda master_sae_id, slave_sae_id, key_ids: void_predistributed_keys(
+            master_sae_id, slave_sae_id, key_ids, lifecycle.settings, lifecycle
+        )
+    )
+
     yield
     await lifecycle.after_landing()
 
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(HTTPSRedirectMiddleware)
+app.add_middleware(TrafficCaptureMiddleware)
+app.add_middleware(ProfilingMiddleware)
 
 app.include_router(router=discover.router, prefix='/api/v1')
 app.include_router(router=internal.router, prefix='/api/v1')
@@ -41,6 +57,14 @@ async def http_exception_handler(request, exc):
     )
 
 
+@app.exception_handler(DeadlineExceededError)
+async def deadline_exceeded_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        content={'message': str(exc)}
+    )
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     return JSONResponse(
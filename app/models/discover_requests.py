@@ -7,8 +7,14 @@ class WalkedNode(BaseModel):
     sae_ids: list[str]
     trusted_node_ids: list[str]
     distance: int
+    area: str | None = None
+    # SAE IDs in the other areas, reachable through this (border) trusted node
+    summarized_sae_ids: list[str] = []
 
 
 class DiscoverTrustedNodesRequest(BaseModel):
     walked_nodes: list[WalkedNode] = []
     distance: int = 0
+    area: str | None = None
+    # Areas whose SAEs are already being summarized, so the summaries do not go in circles
+    summarized_areas: list[str | None] = []
@@ -2,25 +2,22 @@ from typing import Annotated, Union
 from uuid import UUID
 
 from fastapi import Path, Query
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from app.dependencies import get_settings
 from app.models.discover_requests import WalkedNode
 from app.models.key_container import KeyIDContainer
 
-settings = get_settings()
-
 
+# The size range and default come from the settings, which can be reloaded at runtime, so they are checked when
+# the request is processed, not here
 class GetEncryptionKeysRequest(BaseModel):
     number: Annotated[int, Query(ge=1)] = 1
-    size: Annotated[
-        int, Query(ge=settings.min_key_size, le=settings.max_key_size, multiple_of=8)] = settings.default_key_size
+    size: Annotated[Union[int, None], Query(ge=8, multiple_of=8)] = None
 
 
 class PostEncryptionKeysRequest(BaseModel):
     number: Annotated[int, Path(ge=1)] = 1
-    size: Annotated[
-        int, Path(ge=settings.min_key_size, le=settings.max_key_size, multiple_of=8)] = settings.default_key_size
+    size: Annotated[Union[int, None], Path(ge=8, multiple_of=8)] = None
     additional_slave_SAE_IDs: Union[list[str], None] = None
     extension_mandatory: Union[list[dict], None] = None
     extension_optional: Union[list[dict], None] = None
@@ -35,6 +32,19 @@ class PostDecryptionKeysRequest(BaseModel):
     key_IDs_extension: Union[dict, None] = None
 
 
+class DeliveryTree(BaseModel):
+    trusted_node_id: str
+    # Slave SAEs attached to this trusted node, that the key is delivered to
+    slave_sae_ids: list[str] = []
+    branches: list['DeliveryTree'] = []
+
+
+class KeySegment(BaseModel):
+    key_ID: UUID
+    offset: Annotated[int, Field(ge=0)]
+    length: Annotated[int, Field(ge=1)]
+
+
 class ExternalKeysRequest(BaseModel):
     first_key_id: UUID
     key_id: UUID
@@ -45,11 +55,64 @@ class ExternalKeysRequest(BaseModel):
     target_sae_node_id: str
     path_to_go: list[str]
     discovered_network: list[WalkedNode]
+    delivery_tree: Union[DeliveryTree, None] = None
+    # Slices of the QKD keys of the link, that key is encrypted with (or is, when not given)
+    segments: Union[list[KeySegment], None] = None
+    # KME of the sender, on the link the segments are taken from, when the trusted nodes share several links
+    kme_id: Union[str, None] = None
+    # Relayed ahead of demand, not to be announced to the slave SAE
+    predistributed: bool = False
+    # Answer as soon as the key is taken over, and relay it on in the background
+    acknowledge_early: bool = False
+    # Number of the hop on the path, with first_key_id it tells a retry of the call from a new one
+    hop_sequence: Union[int, None] = None
+    # Seconds left until the SAE request this is part of has to be answered
+    timeout_budget: Union[float, None] = None
+
+
+class ReserveKeysRequest(BaseModel):
+    number: int
+    size: int
+    path_to_go: list[str]
+    discovered_network: list[WalkedNode]
+    timeout_budget: Union[float, None] = None
 
 
 class VoidKeysRequest(BaseModel):
     key_ids: list[UUID]
     initiator_sae_id: str
     target_sae_id: str
+    # SAE attached at the end of the path, a border node passes the void on when it is in another area
+    end_sae_id: Union[str, None] = None
+    # Number of the hop on the path, with key_ids it tells a retry of the call from a new one
+    hop_sequence: Union[int, None] = None
     path_to_go: list[str]
     discovered_network: list[WalkedNode]
+    timeout_budget: Union[float, None] = None
+
+
+class ReleaseKeysRequest(BaseModel):
+    key_ids: list[UUID]
+    initiator_sae_id: str
+    target_sae_id: str
+    path_to_go: list[str]
+    discovered_network: list[WalkedNode]
+    timeout_budget: Union[float, None] = None
+
+
+class KeyStoreExportRequest(BaseModel):
+    master_sae_id: Union[str, None] = None
+    slave_sae_id: Union[str, None] = None
+    min_age: Annotated[Union[float, None], Query(ge=0)] = None
+    max_age: Annotated[Union[float, None], Query(ge=0)] = None
+    metadata_only: bool = True
+
+
+class KeyStorePageRequest(KeyStoreExportRequest):
+    cursor: Annotated[int, Query(ge=0)] = 0
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100
+
+
+class ArmProfilingRequest(BaseModel):
+    requests: Annotated[int, Query(ge=0, le=1000)] = 1
+    path_prefix: str = '/api/v1/keys/'
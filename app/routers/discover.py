@@ -3,6 +3,7 @@ import logging
 from fastapi import APIRouter
 
 from app.internal.discovery import discover_trusted_nodes
+from app.internal.profiler import ProfiledRoute
 from app.models.discover_requests import DiscoverTrustedNodesRequest
 
 logger = logging.getLogger('uvicorn.error')
@@ -10,12 +11,13 @@ logger = logging.getLogger('uvicorn.error')
 router = APIRouter(
     prefix='/discover',
     tags=['discover'],
-    responses={404: {'message': 'Not found'}}
+    responses={404: {'message': 'Not found'}},
+    route_class=ProfiledRoute
 )
 
 
 @router.post('/trusted_nodes')
-async def trusted_nodes(data: DiscoverTrustedNodesRequest):
+def trusted_nodes(data: DiscoverTrustedNodesRequest):
     return {
-        'walked_nodes': discover_trusted_nodes(data.walked_nodes, data.distance)
+        'walked_nodes': discover_trusted_nodes(data.walked_nodes, data.distance, data.area, data.summarized_areas)
     }
@@ -1,15 +1,24 @@
+import asyncio
 from typing import Annotated
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from app.config import Settings
 from app.dependencies import get_settings, get_lifecycle
+from app.internal.circuit_breaker import get_circuit_breakers
 from app.internal.lifecycle import Lifecycle
+from app.internal.profiler import ProfiledRoute, arm_requests, get_armed_requests
+from app.models.requests import KeyStoreExportRequest, KeyStorePageRequest, ArmProfilingRequest
+
+# How many keys are serialized at once before giving the event loop back to the serving path
+EXPORT_BATCH_SIZE = 500
 
 router = APIRouter(
     prefix='/internal',
     tags=['internal'],
-    responses={404: {'message': 'Not found'}}
+    responses={404: {'message': 'Not found'}},
+    route_class=ProfiledRoute
 )
 
 
@@ -19,5 +28,110 @@ async def get_key_store(
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
 ):
     return {
-        'activated_keys': lifecycle.key_manager._activated_keys,
+        'activated_keys': lifecycle.key_manager.get_activated_keys(),
+    }
+
+
+@router.get('/key_stores/counts')
+async def get_key_store_counts(
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
+):
+    key_counts = lifecycle.key_manager.get_key_counts()
+
+    return {
+        'activated_key_count': sum(key_counts.values()),
+        'sae_pairs': [
+            {'master_sae_id': master_sae_id, 'slave_sae_id': slave_sae_id, 'activated_key_count': count}
+            for (master_sae_id, slave_sae_id), count in key_counts.items()
+        ],
+    }
+
+
+@router.get('/key_stores/page')
+async def get_key_store_page(
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
+        query: KeyStorePageRequest = Depends()
+):
+    keys = lifecycle.key_manager.find_activated_keys(
+        after=query.cursor,
+        limit=query.limit,
+        master_sae_id=query.master_sae_id,
+        slave_sae_id=query.slave_sae_id,
+        min_age=query.min_age,
+        max_age=query.max_age,
+    )
+
+    return {
+        'activated_keys': lifecycle.key_manager.export_keys(keys, query.metadata_only),
+        'next_cursor': keys[-1].seq if len(keys) == query.limit else None,
+    }
+
+
+@router.get('/key_stores/stream')
+async def stream_key_store(
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
+        query: KeyStoreExportRequest = Depends()
+):
+    keys = lifecycle.key_manager.find_activated_keys(
+        master_sae_id=query.master_sae_id,
+        slave_sae_id=query.slave_sae_id,
+        min_age=query.min_age,
+        max_age=query.max_age,
+    )
+
+    async def generate_lines():
+        for i in range(0, len(keys), EXPORT_BATCH_SIZE):
+            exported_keys = lifecycle.key_manager.export_keys(keys[i:i + EXPORT_BATCH_SIZE], query.metadata_only)
+
+            yield ''.join(key.model_dump_json() + '\n' for key in exported_keys)
+
+            await asyncio.sleep(0)
+
+    return StreamingResponse(generate_lines(), media_type='application/x-ndjson')
+
+
+@router.post('/reload_settings')
+async def reload_settings(
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
+):
+    try:
+        changes = await lifecycle.reload_settings()
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f'New settings were rejected: {e}')
+
+    return {
+        'message': 'Settings reloaded',
+        'changes': changes,
     }
+
+
+@router.post('/profiling')
+async def arm_profiling(
+        settings: Annotated[Settings, Depends(get_settings)],
+        query: ArmProfilingRequest = Depends()
+):
+    arm_requests(query.requests, query.path_prefix)
+
+    return {
+        'armed_requests': get_armed_requests(),
+        'path_prefix': query.path_prefix,
+        'output_dir': settings.profiling.output_dir,
+    }
+
+
+@router.get('/circuit_breakers')
+async def circuit_breakers():
+    return {
+        'circuit_breakers': [
+            {'peer_id': breaker.peer_id, 'state': breaker.state, 'failure_rate': breaker.failure_rate()}
+            for breaker in get_circuit_breakers()
+        ],
+    }
+
+
+@router.get('/readiness')
+async def readiness(lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]):
+    """Progress of the warm-up, with 503 until it is done, so load balancers keep away from a cold node."""
+    progress = lifecycle.warm_up.get_progress()
+
+    return JSONResponse(status_code=200 if progress['ready'] else 503, content=progress)
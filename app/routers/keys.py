@@ -1,43 +1,51 @@
+import asyncio
+import json
+import logging
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 
 from app.config import Settings
-from app.dependencies import get_settings, get_lifecycle, validate_sae_id_from_tls_cert, _get_client_certificate
+from app.dependencies import get_settings, get_lifecycle, validate_sae_id_from_tls_cert, get_client_identity
 from app.internal import request_processor
-from app.internal.discovery import discover_trusted_nodes
+from app.internal.client_identity import ClientIdentity
+from app.internal.discovery import find_trusted_node_of_sae
+from app.internal.key_manager import ActivatedKey
 from app.internal.lifecycle import Lifecycle
+from app.internal.profiler import ProfiledRoute
 from app.models.requests import PostEncryptionKeysRequest, GetEncryptionKeysRequest, GetDecryptionKeysRequest, \
     PostDecryptionKeysRequest
 
+logger = logging.getLogger('uvicorn.error')
+
+# Seconds between the comments sent over an idle notification stream, so proxies do not close it
+NOTIFICATION_KEEPALIVE = 15
+NOTIFICATION_QUEUE_SIZE = 1000
+
 router = APIRouter(
     prefix='/keys',
     tags=['keys'],
     dependencies=[Depends(validate_sae_id_from_tls_cert)],
-    responses={404: {'message': 'Not found'}}
+    responses={404: {'message': 'Not found'}},
+    route_class=ProfiledRoute
 )
 
 
+# The first route discovery walks the network, as a plain function it is run on a worker thread
 @router.get('/{slave_sae_id}/status')
-async def status(
-        request: Request,
+def status(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         slave_sae_id: str,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
 ):
-    trusted_nodes = discover_trusted_nodes()
-
-    slave_kme_id = None
-
-    for trusted_node in trusted_nodes:
-        if trusted_node.trusted_node_id != settings.id and slave_sae_id in trusted_node.sae_ids:
-            slave_kme_id = trusted_node.trusted_node_id
-            break
+    slave_kme_id = find_trusted_node_of_sae(slave_sae_id)
 
     if not slave_kme_id:
         raise HTTPException(status_code=400, detail='The given slave_sae_id cannot be routed to')
 
-    master_sae_id = _get_client_certificate(request)[1]
+    master_sae_id = client.common_name
 
     return {
         'source_KME_ID': settings.id,
@@ -45,24 +53,27 @@ async def status(
         'master_SAE_ID': master_sae_id,
         'slave_SAE_ID': slave_sae_id,
         'key_size': settings.default_key_size,
-        'stored_key_count': 0,
+        'stored_key_count': lifecycle.key_manager.get_key_count(master_sae_id, slave_sae_id),
         'max_key_count': settings.max_key_count,
         'max_key_per_request': settings.max_keys_per_request,
         'max_key_size': settings.max_key_size,
         'min_key_size': settings.min_key_size,
-        'max_SAE_ID_count': 0,
+        'max_SAE_ID_count': settings.max_sae_id_count,
     }
 
 
+# Relaying blocks on the KMEs and the trusted nodes, as a plain function it is run on a worker thread and does not
+# hold up the event loop
 @router.get('/{slave_sae_id}/enc_keys')
-async def get_encryption_keys(
-        request: Request,
+def get_encryption_keys(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         slave_sae_id: str,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
+        background_tasks: BackgroundTasks,
         query: GetEncryptionKeysRequest = Depends()
 ):
-    master_sae_id = _get_client_certificate(request)[1]
+    master_sae_id = client.common_name
 
     return request_processor.get_encryption_keys(
         master_sae_id=master_sae_id,
@@ -71,18 +82,20 @@ async def get_encryption_keys(
         size=query.size,
         settings=settings,
         lifecycle=lifecycle,
+        background_tasks=background_tasks,
     )
 
 
 @router.post('/{slave_sae_id}/enc_keys')
-async def post_encryption_keys(
-        request: Request,
+def post_encryption_keys(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         slave_sae_id: str,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
+        background_tasks: BackgroundTasks,
         data: PostEncryptionKeysRequest
 ):
-    master_sae_id = _get_client_certificate(request)[1]
+    master_sae_id = client.common_name
 
     return request_processor.get_encryption_keys(
         master_sae_id=master_sae_id,
@@ -91,18 +104,31 @@ async def post_encryption_keys(
         size=data.size,
         settings=settings,
         lifecycle=lifecycle,
+        additional_slave_sae_ids=data.additional_slave_SAE_IDs,
+        background_tasks=background_tasks,
     )
 
 
+def _wait_for_keys(key_ids: list, settings: Settings, lifecycle: Lifecycle):
+    # With the relay acknowledged early, the master SAE may have got the keys before the relay reached this trusted
+    # node, give them a moment to arrive
+    if settings.async_relay.enabled and settings.async_relay.dec_keys_wait > 0:
+        lifecycle.key_manager.wait_for_keys(key_ids, settings.async_relay.dec_keys_wait)
+
+
+# Waiting for the keys and voiding them block, as a plain function it is run on a worker thread and does not hold up
+# the event loop
 @router.get('/{master_sae_id}/dec_keys')
-async def get_decryption_keys(
-        request: Request,
+def get_decryption_keys(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         master_sae_id: str,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
         query: GetDecryptionKeysRequest = Depends()
 ):
-    slave_sae_id = _get_client_certificate(request)[1]
+    slave_sae_id = client.common_name
+
+    _wait_for_keys([query.key_ID], settings, lifecycle)
 
     return request_processor.get_decryption_keys(
         master_sae_id=master_sae_id,
@@ -114,19 +140,78 @@ async def get_decryption_keys(
 
 
 @router.post('/{master_sae_id}/dec_keys')
-async def get_decryption_keys(
-        request: Request,
+def get_decryption_keys(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         master_sae_id: str,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
         data: PostDecryptionKeysRequest
 ):
-    slave_sae_id = _get_client_certificate(request)[1]
+    slave_sae_id = client.common_name
+    key_ids = list(map(lambda key: key.key_ID, data.key_IDs))
+
+    _wait_for_keys(key_ids, settings, lifecycle)
 
     return request_processor.get_decryption_keys(
         master_sae_id=master_sae_id,
         slave_sae_id=slave_sae_id,
-        key_ids=list(map(lambda key: key.key_ID, data.key_IDs)),
+        key_ids=key_ids,
         settings=settings,
         lifecycle=lifecycle,
     )
+
+
+def _key_event(key: ActivatedKey) -> str:
+    data = {'key_ID': str(key.key_uuid), 'master_SAE_ID': key.master_sae_id, 'size': key.size * 8}
+
+    return f'event: key\ndata: {json.dumps(data)}\n\n'
+
+
+@router.get('/{master_sae_id}/notifications')
+async def get_key_notifications(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
+        master_sae_id: str,
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
+):
+    """
+    Server-Sent Events stream of the keys of the master SAE that became available to the calling slave SAE, starting
+    with the ones already waiting. Each event carries the key_ID to call dec_keys with.
+    """
+    slave_sae_id = client.common_name
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[ActivatedKey] = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+
+    def enqueue(key: ActivatedKey):
+        try:
+            queue.put_nowait(key)
+        except asyncio.QueueFull:
+            logger.warning('Notification stream of %s is full, dropping key %s', slave_sae_id, key.key_uuid)
+
+    def on_key(key: ActivatedKey):
+        # Keys are activated from the relay worker threads as well
+        if key.master_sae_id == master_sae_id:
+            loop.call_soon_threadsafe(enqueue, key)
+
+    async def stream():
+        try:
+            # Subscribed only once the response is streamed, so that a stream that never starts leaves no callback
+            # behind, and before listing the waiting keys, so that none is missed in between
+            lifecycle.key_manager.subscribe(slave_sae_id, on_key)
+
+            for key in lifecycle.key_manager.find_activated_keys(master_sae_id=master_sae_id, slave_sae_id=slave_sae_id):
+                if not key.predistributed:
+                    yield _key_event(key)
+
+            while True:
+                try:
+                    key = await asyncio.wait_for(queue.get(), NOTIFICATION_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                yield _key_event(key)
+        finally:
+            lifecycle.key_manager.unsubscribe(slave_sae_id, on_key)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
@@ -1,20 +1,38 @@
 import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
+from uuid import UUID
 
-from fastapi import APIRouter, Depends, Request
+import requests
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 
 from app.config import Settings, AttachedKmes
-from app.dependencies import get_settings, get_lifecycle, _get_client_certificate
+from app.dependencies import get_settings, get_lifecycle, get_client_identity
+from app.internal.deadline import Deadline, DeadlineExceededError
+from app.internal.idempotency import run_once
+from app.internal.key_material import xor_keys
+from app.internal.key_packing import discard_segments, load_segments
+from app.internal.link_aggregation import record_link_availability, take_from_links
+from app.internal.link_table import get_link_table
+from app.internal.client_identity import ClientIdentity
 from app.internal.lifecycle import Lifecycle
+from app.internal.profiler import ProfiledRoute
+from app.internal.request_processor import find_path_to_other_area
+from app.internal.structured_logging import log_key_event
 from app.internal.requestor import get_request, post_request
 from app.models.discover_requests import WalkedNode
 from app.models.key_container import KeyContainer
-from app.models.requests import ExternalKeysRequest, VoidKeysRequest
+from app.models.requests import DeliveryTree, ExternalKeysRequest, ReleaseKeysRequest, ReserveKeysRequest, \
+    VoidKeysRequest
+
+logger = logging.getLogger('uvicorn.error')
 
 router = APIRouter(
     prefix='/kmapi',
     tags=['kmapi'],
-    responses={404: {'message': 'Not found'}}
+    responses={404: {'message': 'Not found'}},
+    route_class=ProfiledRoute
 )
 
 
@@ -28,15 +46,100 @@ async def versions():
     }
 
 
+def _get_deadline(timeout_budget: float | None) -> Deadline | None:
+    # Requests of trusted nodes that do not send a budget are not limited
+    if timeout_budget is None:
+        return None
+
+    if timeout_budget <= 0:
+        raise HTTPException(status_code=504, detail='No time is left to process the request')
+
+    return Deadline(timeout_budget)
+
+
+def _get_receiving_kme(sender_kme_id: str | None, caller_trusted_node: WalkedNode) -> AttachedKmes | None:
+    table = get_link_table()
+
+    # The other end of the link the sender took the key material from
+    if sender_kme_id is not None:
+        return table.local_kmes_by_peer.get(sender_kme_id)
+
+    kmes = table.get_shared_kmes(caller_trusted_node.kme_ids)
+
+    return kmes[0] if len(kmes) > 0 else None
+
+
+def _is_attached_sae(settings: Settings, sae_id: str) -> bool:
+    return any(sae.sae_id == sae_id for sae in settings.attached_saes)
+
+
+def _get_incoming_area(settings: Settings, discovered_network: list[WalkedNode]) -> str | None:
+    # The area the path so far went through, as this node was walked in it
+    for node in discovered_network:
+        if node.trusted_node_id == settings.id:
+            return node.area
+
+    return settings.area
+
+
+def _get_idempotency_key(
+        endpoint: str,
+        trusted_node_id: str,
+        key_ids: list,
+        end_sae_id: str | None,
+        path_to_go: list[str],
+        hop_sequence: int | None
+) -> tuple | None:
+    # Trusted nodes that do not number the hops are answered anew every time. The same keys are sent towards several
+    # SAEs, or along several paths, by the group relays and their voids
+    if hop_sequence is None:
+        return None
+
+    return (
+        endpoint,
+        trusted_node_id,
+        tuple(str(key_id) for key_id in key_ids),
+        end_sae_id,
+        tuple(path_to_go),
+        hop_sequence
+    )
+
+
+# The kmapi calls block on the KMEs and the next hops, as plain functions they are run on worker threads, so that
+# the relays of several keys go on at once and the event loop stays free
 @router.post('/v1/ext_keys')
-async def ext_keys(
-        request: Request,
+def ext_keys(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         data: ExternalKeysRequest,
         settings: Annotated[Settings, Depends(get_settings)],
-        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)],
+        background_tasks: BackgroundTasks
+):
+    # A retry gets the key that was already taken over, no key material is taken from the KME for it again
+    return run_once(
+        _get_idempotency_key(
+            'ext_keys',
+            client.common_name,
+            [data.first_key_id],
+            data.target_sae_node_id,
+            data.path_to_go,
+            data.hop_sequence
+        ),
+        lambda: _receive_key(client, data, settings, lifecycle, background_tasks)
+    )
+
+
+def _receive_key(
+        client: ClientIdentity,
+        data: ExternalKeysRequest,
+        settings: Settings,
+        lifecycle: Lifecycle,
+        background_tasks: BackgroundTasks
 ):
     # Get from where the request was coming from
-    trusted_node_id = _get_client_certificate(request)[1]
+    trusted_node_id = client.common_name
+
+    deadline = _get_deadline(data.timeout_budget)
 
     # Find the requesting trusted node
     caller_trusted_node: WalkedNode = list(filter(
@@ -45,107 +148,308 @@ async def ext_keys(
     ))[0]
 
     # Find the appropriate KME
-    for kme in settings.attached_kmes:
-        if kme.distance != 0:
-            continue
+    kme = _get_receiving_kme(data.kme_id, caller_trusted_node)
 
-        if kme.kme_id not in caller_trusted_node.kme_ids:
-            continue
+    if kme is None:
+        raise HTTPException(status_code=400, detail=f'No KME is shared with {trusted_node_id}')
 
+    if data.segments is not None:
+        key_material = load_segments(kme.kme_id, trusted_node_id, data.segments, deadline)
+        key = {'key_ID': str(data.first_key_id), 'key': base64.b64encode(key_material).decode('ascii')}
+    else:
         key = get_request(
             kme.kme_id,
-            f'/api/v1/keys/{trusted_node_id}/dec_keys?key_ID={data.key_id}'
+            f'/api/v1/keys/{trusted_node_id}/dec_keys?key_ID={data.key_id}',
+            deadline
         )['keys'][0]
 
-        print(f'key taken from KME: {key["key_ID"]}, {key["key"][:20]}')
+    path_to_go = data.path_to_go[1:]
 
-        path_to_go = data.path_to_go[1:]
+    if type(data.key) is tuple:
+        xor_key = data.key[0]
+    else:
+        xor_key = data.key
 
-        if type(data.key) is tuple:
-            xor_key = data.key[0]
-        else:
-            xor_key = data.key
+    key_material = base64.b64decode(key['key'])
+    key_id = key['key_ID']
 
-        if xor_key is None:
-            print(f'key taken from API: {data.key_id}, -')
-        else:
-            print(f'key taken from API: {data.key_id}, {xor_key[:20]}')
+    if xor_key is not None:
+        key_material = xor_keys(base64.b64decode(xor_key), key_material)
+        key_id = data.first_key_id
 
-        if xor_key is not None:
-            key_a = base64.b64decode(xor_key)
-            key_b = base64.b64decode(key['key'])
+    log_key_event(
+        'key_received',
+        key_id=key_id,
+        link_key_id=data.key_id,
+        from_trusted_node_id=trusted_node_id,
+        encrypted=xor_key is not None,
+        size=len(key_material) * 8
+    )
 
-            key['key_ID'] = data.first_key_id
-            key['key'] = base64.b64encode(
-                bytes(a ^ b for a, b in zip(key_a, key_b))
-            ).decode('ascii')
+    if data.delivery_tree is not None:
+        return _deliver_to_tree(data, data.delivery_tree, key_material, settings, lifecycle, deadline)
 
-            print(f'key taken after de-xored: {data.first_key_id}, {key["key"][:20]}')
+    if len(path_to_go) == 0 and _is_attached_sae(settings, data.target_sae_node_id):
+        lifecycle.key_manager.add_activated_key(
+            data.initiator_sae_id,
+            data.target_sae_node_id,
+            UUID(str(key_id)),
+            key_material,
+            predistributed=data.predistributed,
+            peer_trusted_node_id=data.initiator_trusted_node_id
+        )
 
-        if len(path_to_go) == 0:
-            lifecycle.key_manager.add_activated_key(data.initiator_sae_id, data.target_sae_node_id, KeyContainer(**key))
+        return KeyContainer(key_ID=key_id, key=base64.b64encode(key_material).decode('ascii'))
 
-            return key
+    # The initiator only waits for this hop to take the key over
+    if data.acknowledge_early:
+        background_tasks.add_task(_pass_on_in_background, data, key_material, path_to_go, settings, deadline)
 
-        next_trusted_node_id = path_to_go[0]
-        next_kme: AttachedKmes | None = None
+        return KeyContainer(key_ID=key_id, key=base64.b64encode(key_material).decode('ascii'))
 
-        for kme in settings.attached_kmes:
-            if kme.distance != 0:
-                continue
+    return _pass_on(data, key_material, path_to_go, settings, deadline)
 
-            for node in data.discovered_network:
-                if node.trusted_node_id != next_trusted_node_id:
-                    continue
 
-                if kme.kme_id not in node.kme_ids:
-                    continue
+def _pass_on(
+        data: ExternalKeysRequest,
+        key_material: bytes,
+        path_to_go: list[str],
+        settings: Settings,
+        deadline: Deadline | None = None
+):
+    # This is the border node the slave SAE was summarized by, the key goes on through the next area
+    if len(path_to_go) == 0:
+        trusted_nodes, path = find_path_to_other_area(
+            settings,
+            data.target_sae_node_id,
+            _get_incoming_area(settings, data.discovered_network)
+        )
 
-                next_kme = kme
+        return _forward_key(data, key_material, path[1], {
+            'path_to_go': path[1:],
+            'target_trusted_node_id': path[-1],
+            'discovered_network': trusted_nodes
+        }, settings, deadline)
 
-                break
+    return _forward_key(data, key_material, path_to_go[0], {'path_to_go': path_to_go}, settings, deadline)
 
-        key_a = base64.b64decode(key['key'])
 
-        next_key = get_request(
-            next_kme.kme_id,
-            f'/api/v1/keys/{next_trusted_node_id}/enc_keys?size={len(key_a) * 8}'
-        )['keys'][0]
+def _pass_on_in_background(
+        data: ExternalKeysRequest,
+        key_material: bytes,
+        path_to_go: list[str],
+        settings: Settings,
+        deadline: Deadline | None = None
+):
+    try:
+        _pass_on(data, key_material, path_to_go, settings, deadline)
+
+        return
+    except HTTPException as e:
+        logger.error('Failed to complete the relay of key %s: %s', data.first_key_id, e.detail)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error('Failed to complete the relay of key %s: %s', data.first_key_id, e)
+
+    # The master SAE already has the key, void it there so it is not used for anything the slave SAE cannot decrypt
+    try:
+        post_request(data.initiator_trusted_node_id, f'/api/v1/kmapi/v1/void', {
+            'key_ids': [data.first_key_id],
+            'initiator_sae_id': data.initiator_sae_id,
+            'target_sae_id': data.target_sae_node_id,
+            'end_sae_id': data.initiator_sae_id,
+            'path_to_go': [data.initiator_trusted_node_id],
+            'discovered_network': data.discovered_network,
+            'hop_sequence': 1
+        }, idempotent=True)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Failed to void key %s at %s: %s', data.first_key_id, data.initiator_trusted_node_id, e)
 
-        print(f'key sent over QKD: {next_key["key_ID"]}, {next_key["key"][:20]}')
 
-        key_b = base64.b64decode(next_key['key'])
+def _forward_key(
+        data: ExternalKeysRequest,
+        key_material: bytes,
+        next_trusted_node_id: str,
+        route: dict,
+        settings: Settings,
+        deadline: Deadline | None = None
+):
+    next_trusted_node = next(
+        (node for node in route.get('discovered_network', data.discovered_network)
+         if node.trusted_node_id == next_trusted_node_id),
+        None
+    )
+    next_kmes = get_link_table().get_shared_kmes(next_trusted_node.kme_ids if next_trusted_node else ())
+
+    # A failure further down the path is reported as a bad gateway, so the initiator can roll back and re-route
+    # the key, and the circuit breakers do not take this (healthy) node for a failing one
+    try:
+        (kme_id, link_material, segments), = take_from_links(
+            next_kmes,
+            next_trusted_node_id,
+            1,
+            len(key_material),
+            deadline
+        )
+
+        xor_key = base64.b64encode(xor_keys(key_material, link_material)).decode('ascii')
+
+        log_key_event(
+            'key_forwarded',
+            key_id=data.first_key_id,
+            link_key_ids=[segment['key_ID'] for segment in segments],
+            to_trusted_node_id=next_trusted_node_id
+        )
+
+        try:
+            return post_request(next_trusted_node_id, f'/api/v1/kmapi/v1/ext_keys', {
+                'first_key_id': data.first_key_id,
+                'key_id': segments[0]['key_ID'],
+                'key': xor_key,
+                'segments': segments,
+                'kme_id': kme_id,
+                'initiator_trusted_node_id': data.initiator_trusted_node_id,
+                'initiator_sae_id': data.initiator_sae_id,
+                'target_trusted_node_id': data.target_trusted_node_id,
+                'target_sae_node_id': data.target_sae_node_id,
+                'path_to_go': data.path_to_go,
+                'discovered_network': data.discovered_network,
+                'predistributed': data.predistributed,
+                'hop_sequence': data.hop_sequence + 1 if data.hop_sequence is not None else None,
+                **route
+            }, deadline, idempotent=data.hop_sequence is not None)
+        except (requests.exceptions.RequestException, ValueError):
+            # The next node may not have got the QKD keys of the slice, the rest of them is not sent over to it
+            discard_segments(kme_id, next_trusted_node_id, segments)
+            raise
+    except DeadlineExceededError as e:
+        logger.warning('Gave up relaying key %s to %s: %s', data.first_key_id, next_trusted_node_id, e)
+
+        raise HTTPException(status_code=504, detail=f'Ran out of time relaying the key from {settings.id}')
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Failed to relay key %s to %s: %s', data.first_key_id, next_trusted_node_id, e)
+
+        raise HTTPException(
+            status_code=502,
+            detail=f'Failed to relay the key from {settings.id} to {next_trusted_node_id}'
+        )
+
+
+def _deliver_to_tree(
+        data: ExternalKeysRequest,
+        tree: DeliveryTree,
+        key_material: bytes,
+        settings: Settings,
+        lifecycle: Lifecycle,
+        deadline: Deadline | None = None
+):
+    # The key is activated once for all the slave SAEs attached here, it is kept until each of them got it
+    if len(tree.slave_sae_ids) > 0:
+        lifecycle.key_manager.add_activated_key(
+            data.initiator_sae_id,
+            tree.slave_sae_ids[0],
+            UUID(str(data.first_key_id)),
+            key_material,
+            receivers=len(tree.slave_sae_ids),
+            peer_trusted_node_id=data.initiator_trusted_node_id,
+            slave_sae_ids=tree.slave_sae_ids
+        )
+
+    delivered_to = list(tree.slave_sae_ids)
+
+    # The key crosses every link of the tree once, it is only copied where the paths to the slave SAEs split
+    with ThreadPoolExecutor(max_workers=max(1, len(tree.branches))) as executor:
+        responses = executor.map(
+            lambda branch: _forward_key(
+                data,
+                key_material,
+                branch.trusted_node_id,
+                {'delivery_tree': branch},
+                settings,
+                deadline
+            ),
+            tree.branches
+        )
+
+        for response in responses:
+            delivered_to.extend(response['delivered_to'])
+
+    return {'key_ID': data.first_key_id, 'delivered_to': delivered_to}
+
+
+@router.post('/v1/reserve')
+def reserve(
+        data: ReserveKeysRequest,
+        settings: Annotated[Settings, Depends(get_settings)]
+):
+    path_to_go = data.path_to_go[1:]
+    deadline = _get_deadline(data.timeout_budget)
 
-        xor_key = base64.b64encode(
-            bytes(a ^ b for a, b in zip(key_a, key_b))
-        ).decode('ascii')
+    if len(path_to_go) == 0:
+        return {'reserved': True}
 
-        print(f'key sent over API: {next_key["key_ID"]}, {xor_key[:20]}')
+    next_trusted_node_id = path_to_go[0]
+    refused = {'reserved': False, 'trusted_node_id': settings.id, 'next_trusted_node_id': next_trusted_node_id}
 
-        resp = post_request(next_trusted_node_id, f'/api/v1/kmapi/v1/ext_keys', {
-            'first_key_id': data.first_key_id,
-            'key_id': next_key['key_ID'],
-            'key': xor_key,
-            'initiator_trusted_node_id': data.initiator_trusted_node_id,
-            'initiator_sae_id': data.initiator_sae_id,
-            'target_trusted_node_id': data.target_trusted_node_id,
-            'target_sae_node_id': data.target_sae_node_id,
+    next_trusted_node = next(
+        (node for node in data.discovered_network if node.trusted_node_id == next_trusted_node_id),
+        None
+    )
+    next_kmes = get_link_table().get_shared_kmes(next_trusted_node.kme_ids if next_trusted_node else ())
+
+    if len(next_kmes) == 0:
+        return refused
+
+    # QKD keys cannot be held back for a relay, so this checks that the links have enough of them at the moment
+    try:
+        available_bits = 0
+
+        for kme in next_kmes:
+            status = get_request(kme.kme_id, f'/api/v1/keys/{next_trusted_node_id}/status', deadline)
+
+            record_link_availability(kme.kme_id, next_trusted_node_id, status['stored_key_count'])
+
+            # The keys are packed into and split across QKD keys of the largest size
+            available_bits += status['stored_key_count'] * status['max_key_size']
+
+        if available_bits < data.number * data.size:
+            return refused
+
+        return post_request(next_trusted_node_id, f'/api/v1/kmapi/v1/reserve', {
+            'number': data.number,
+            'size': data.size,
             'path_to_go': path_to_go,
             'discovered_network': data.discovered_network
-        })
+        }, deadline)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.warning('Failed to reserve keys towards %s: %s', next_trusted_node_id, e)
 
-        return resp
+        return refused
 
 
 @router.post('/v1/void')
-async def void(
-        request: Request,
+def void(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
         data: VoidKeysRequest,
         settings: Annotated[Settings, Depends(get_settings)],
         lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
 ):
+    # A retry gets the keys that were already deactivated, instead of failing on them being gone
+    return run_once(
+        _get_idempotency_key(
+            'void',
+            client.common_name,
+            data.key_ids,
+            data.end_sae_id,
+            data.path_to_go,
+            data.hop_sequence
+        ),
+        lambda: _void_keys(client, data, settings, lifecycle)
+    )
+
+
+def _void_keys(client: ClientIdentity, data: VoidKeysRequest, settings: Settings, lifecycle: Lifecycle):
     # Get from where the request was coming from
-    trusted_node_id = _get_client_certificate(request)[1]
+    trusted_node_id = client.common_name
 
     # Find the requesting trusted node
     caller_trusted_node: WalkedNode = list(filter(
@@ -154,36 +458,90 @@ async def void(
     ))[0]
 
     # Find the appropriate KME
-    for kme in settings.attached_kmes:
-        if kme.distance != 0:
-            continue
-
-        if kme.kme_id not in caller_trusted_node.kme_ids:
-            continue
+    if _get_receiving_kme(None, caller_trusted_node) is None:
+        raise HTTPException(status_code=400, detail=f'No KME is shared with {trusted_node_id}')
+
+    path_to_go = data.path_to_go[1:]
+    discovered_network = data.discovered_network
+
+    # The SAE at the end is in another area, the keys are voided along the path through it
+    if len(path_to_go) == 0 and data.end_sae_id is not None and not _is_attached_sae(settings, data.end_sae_id):
+        discovered_network, path_to_go = find_path_to_other_area(
+            settings,
+            data.end_sae_id,
+            _get_incoming_area(settings, data.discovered_network)
+        )
+        path_to_go = path_to_go[1:]
+
+    if len(path_to_go) == 0:
+        deactivated_keys = []
+
+        for key_id in data.key_ids:
+            # A key that is already gone was delivered or voided before, voiding it is done
+            try:
+                deactivated_key = lifecycle.key_manager.deactivate_key(str(key_id))
+            except ValueError:
+                logger.info('Key %s to void is already gone', key_id)
+                continue
 
-        path_to_go = data.path_to_go[1:]
+            deactivated_keys.append(KeyContainer(
+                key_ID=deactivated_key.key_ID,
+                key=deactivated_key.key
+            ))
 
-        if len(path_to_go) == 0:
-            deactivated_keys = []
+        return deactivated_keys
 
-            for key_id in data.key_ids:
-                deactivated_key = lifecycle.key_manager.deactivate_key(str(key_id))
+    next_trusted_node_id = path_to_go[0]
 
-                deactivated_keys.append(KeyContainer(
-                    key_ID=deactivated_key.key_ID,
-                    key=deactivated_key.key
-                ))
+    resp = post_request(next_trusted_node_id, f'/api/v1/kmapi/v1/void', {
+        'key_ids': data.key_ids,
+        'initiator_sae_id': data.initiator_sae_id,
+        'target_sae_id': data.target_sae_id,
+        'end_sae_id': data.end_sae_id,
+        'path_to_go': path_to_go,
+        'discovered_network': discovered_network,
+        'hop_sequence': data.hop_sequence + 1 if data.hop_sequence is not None else None
+    }, _get_deadline(data.timeout_budget), idempotent=data.hop_sequence is not None)
 
-            return deactivated_keys
+    return resp
 
-        next_trusted_node_id = path_to_go[0]
 
-        resp = post_request(next_trusted_node_id, f'/api/v1/kmapi/v1/void', {
-            'key_ids': data.key_ids,
-            'initiator_sae_id': data.initiator_sae_id,
-            'target_sae_id': data.target_sae_id,
-            'path_to_go': path_to_go,
-            'discovered_network': data.discovered_network
-        })
-
-        return resp
+@router.post('/v1/release')
+def release(
+        client: Annotated[ClientIdentity, Depends(get_client_identity)],
+        data: ReleaseKeysRequest,
+        settings: Annotated[Settings, Depends(get_settings)],
+        lifecycle: Annotated[Lifecycle, Depends(get_lifecycle)]
+):
+    # Pre-distributed keys were handed out to the master SAE, they are announced to the slave SAE at the end of the path
+    trusted_node_id = client.common_name
+
+    caller_trusted_node = next(
+        (node for node in data.discovered_network if node.trusted_node_id == trusted_node_id),
+        None
+    )
+
+    if caller_trusted_node is None or _get_receiving_kme(None, caller_trusted_node) is None:
+        raise HTTPException(status_code=400, detail=f'No KME is shared with {trusted_node_id}')
+
+    path_to_go = data.path_to_go[1:]
+    discovered_network = data.discovered_network
+
+    if len(path_to_go) == 0 and not _is_attached_sae(settings, data.target_sae_id):
+        discovered_network, path_to_go = find_path_to_other_area(
+            settings,
+            data.target_sae_id,
+            _get_incoming_area(settings, data.discovered_network)
+        )
+        path_to_go = path_to_go[1:]
+
+    if len(path_to_go) == 0:
+        return {'released': lifecycle.key_manager.release_keys([str(key_id) for key_id in data.key_ids])}
+
+    return post_request(path_to_go[0], f'/api/v1/kmapi/v1/release', {
+        'key_ids': data.key_ids,
+        'initiator_sae_id': data.initiator_sae_id,
+        'target_sae_id': data.target_sae_id,
+        'path_to_go': path_to_go,
+        'discovered_network': discovered_network
+    }, _get_deadline(data.timeout_budget))
@@ -0,0 +1,71 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+
+from benchmarks.harness import describe_environment, prepare_environment
+
+SUITES = ['routing', 'key_store', 'relay', 'models', 'sae_validation']
+
+
+def compare(baseline_file: str, results: list[dict]):
+    with open(baseline_file, encoding='utf-8') as file:
+        baseline = {
+            (result['name'], json.dumps(result['params'], sort_keys=True)): result
+            for result in json.load(file)['results']
+        }
+
+    print(f'{"benchmark":<32} {"params":<40} {"baseline us":>14} {"current us":>14} {"ratio":>8}')
+
+    for result in results:
+        params = json.dumps(result['params'], sort_keys=True)
+        previous = baseline.get((result['name'], params))
+
+        if previous is None:
+            continue
+
+        ratio = result['seconds_per_op'] / previous['seconds_per_op']
+
+        print(
+            f'{result["name"]:<32} {params:<40} {previous["seconds_per_op"] * 1e6:>14.2f} '
+            f'{result["seconds_per_op"] * 1e6:>14.2f} {ratio:>8.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the microbenchmarks of the trusted node, offline')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='JSON file to write the results to (benchmarks/results/<commit>.json by default)')
+    parser.add_argument('--suite', choices=SUITES, action='append',
+                        help='Run only this suite, can be given more than once')
+    parser.add_argument('--quick', action='store_true', help='Leave out the largest graphs, pools and networks')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results of an earlier run to compare with')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='qkd-benchmarks-') as directory:
+        # The settings of the app are read when it is imported, so the suites are imported only after this
+        prepare_environment(directory)
+
+        environment = describe_environment()
+        results = []
+
+        for suite in args.suite or SUITES:
+            results.extend(importlib.import_module(f'benchmarks.{suite}').run(args.quick))
+
+    output = args.output or os.path.join('benchmarks', 'results', f'{environment["commit"] or "unknown"}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({'environment': environment, 'quick': args.quick, 'results': results}, file, indent=2)
+
+    print(f'Results written to {output}', file=sys.stderr)
+
+    if args.compare is not None:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
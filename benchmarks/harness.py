@@ -0,0 +1,156 @@
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+BENCHMARK_SAE_ID = 'sae-bench'
+BENCHMARK_TRUSTED_NODE_ID = 'tn-bench'
+
+
+def generate_certificate(directory: str, common_name: str) -> tuple[str, str, int]:
+    """Writes a self-signed certificate and its key, returns their paths and the serial number."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_file = os.path.join(directory, f'{common_name}.crt')
+    key_file = os.path.join(directory, f'{common_name}.key')
+
+    with open(cert_file, 'wb') as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+    with open(key_file, 'wb') as file:
+        file.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+
+    return cert_file, key_file, certificate.serial_number
+
+
+def prepare_environment(directory: str) -> str:
+    """
+    Writes a settings file of a trusted node without any peers, with generated certificates, and points the settings
+    of the app at it. It has to be called before anything of the app is imported, as the settings are read then.
+    """
+    cert_file, key_file, _ = generate_certificate(directory, BENCHMARK_TRUSTED_NODE_ID)
+    sae_cert_file, _, _ = generate_certificate(directory, BENCHMARK_SAE_ID)
+
+    settings_file = os.path.join(directory, 'settings.json')
+
+    with open(settings_file, 'w', encoding='utf-8') as file:
+        json.dump({
+            'id': BENCHMARK_TRUSTED_NODE_ID,
+            'server_cert_file': cert_file,
+            'server_key_file': key_file,
+            'ca_file': cert_file,
+            'min_key_size': 64,
+            'max_key_size': 256,
+            'default_key_size': 256,
+            'max_key_count': 1000,
+            'max_keys_per_request': 100,
+            'attached_kmes': [],
+            'attached_saes': [{'sae_id': BENCHMARK_SAE_ID, 'sae_cert': sae_cert_file}],
+            'attached_trusted_nodes': []
+        }, file)
+
+    sys.argv = [sys.argv[0], '-s', settings_file]
+
+    return settings_file
+
+
+def measure(
+        name: str,
+        params: dict[str, Any],
+        operation: Callable[[], Any],
+        min_time: float = 0.2,
+        repeat: int = 5
+) -> dict:
+    """
+    Times the operation the way timeit does: it is run in loops long enough to last min_time, and the loop is timed
+    repeat times. The median of the loops is reported, per operation.
+    """
+    number = 1
+
+    while True:
+        started = time.perf_counter()
+
+        for _ in range(number):
+            operation()
+
+        elapsed = time.perf_counter() - started
+
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+
+    timings = [elapsed / number]
+
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+
+        for _ in range(number):
+            operation()
+
+        timings.append((time.perf_counter() - started) / number)
+
+    return summarize(name, params, timings, number)
+
+
+def summarize(name: str, params: dict[str, Any], timings: list[float], loops: int) -> dict:
+    """Reports the timings (in seconds per operation) of the given number of loops of a benchmark."""
+    result = {
+        'name': name,
+        'params': params,
+        'seconds_per_op': statistics.median(timings),
+        'min_seconds_per_op': min(timings),
+        'loops': loops,
+        'repeat': len(timings),
+    }
+
+    print(f'{name:<32} {json.dumps(params):<40} {result["seconds_per_op"] * 1e6:>14.2f} us', file=sys.stderr)
+
+    return result
+
+
+def describe_environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
@@ -0,0 +1,74 @@
+import os
+import random
+import time
+from uuid import UUID
+
+from app.config import get_settings
+from app.internal.key_manager import KeyManager
+
+from benchmarks.harness import measure, summarize
+
+POOL_SIZES = [1000, 10000, 100000, 1000000]
+
+# Keys added (and deactivated again) per timed loop
+BATCH_SIZE = 10000
+
+MASTER_SAE_ID = 'sae-master'
+SLAVE_SAE_ID = 'sae-slave'
+
+
+def fill_key_manager(pool_size: int) -> KeyManager:
+    settings = get_settings().model_copy(update={'max_key_count': pool_size + BATCH_SIZE})
+    key_manager = KeyManager(settings)
+    key = os.urandom(settings.default_key_size // 8)
+
+    for index in range(pool_size):
+        key_manager.add_activated_key(MASTER_SAE_ID, SLAVE_SAE_ID, UUID(int=index), key)
+
+    return key_manager
+
+
+def run(quick: bool) -> list[dict]:
+    results = []
+    key = os.urandom(get_settings().default_key_size // 8)
+
+    for pool_size in POOL_SIZES:
+        if quick and pool_size > 100000:
+            continue
+
+        key_manager = fill_key_manager(pool_size)
+        rng = random.Random(pool_size)
+
+        lookup_ids = [str(UUID(int=rng.randrange(pool_size))) for _ in range(1024)]
+        lookups = iter(range(1 << 62))
+
+        results.append(measure(
+            'key_manager.lookup',
+            {'pool_size': pool_size},
+            lambda: key_manager.get_activated_key_metadata(lookup_ids[next(lookups) % len(lookup_ids)])
+        ))
+
+        # Adding and deactivating a batch of keys leaves the pool at its size, so each loop sees the same pool
+        batch_ids = [UUID(int=pool_size + index) for index in range(BATCH_SIZE)]
+        batch_id_strings = [str(key_id) for key_id in batch_ids]
+        add_timings, deactivate_timings = [], []
+
+        for _ in range(5):
+            started = time.perf_counter()
+
+            for key_id in batch_ids:
+                key_manager.add_activated_key(MASTER_SAE_ID, SLAVE_SAE_ID, key_id, key, notify=False)
+
+            add_timings.append((time.perf_counter() - started) / BATCH_SIZE)
+
+            started = time.perf_counter()
+
+            for key_id in batch_id_strings:
+                key_manager.deactivate_key(key_id)
+
+            deactivate_timings.append((time.perf_counter() - started) / BATCH_SIZE)
+
+        results.append(summarize('key_manager.add', {'pool_size': pool_size}, add_timings, BATCH_SIZE))
+        results.append(summarize('key_manager.deactivate', {'pool_size': pool_size}, deactivate_timings, BATCH_SIZE))
+
+    return results
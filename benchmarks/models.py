@@ -0,0 +1,44 @@
+from uuid import uuid4
+
+from app.models.requests import ExternalKeysRequest
+
+from benchmarks.harness import measure
+from benchmarks.routing import generate_network
+
+NETWORK_SIZES = [1, 10, 100, 1000, 10000]
+
+
+def build_ext_keys_payload(network_size: int) -> dict:
+    network = [node.model_dump() for node in generate_network(network_size)]
+
+    return {
+        'first_key_id': str(uuid4()),
+        'key_id': str(uuid4()),
+        'key': None,
+        'segments': [{'key_ID': str(uuid4()), 'offset': 0, 'length': 32}],
+        'initiator_trusted_node_id': network[0]['trusted_node_id'],
+        'initiator_sae_id': 'sae-0',
+        'target_trusted_node_id': network[-1]['trusted_node_id'],
+        'target_sae_node_id': f'sae-{network_size - 1}',
+        'path_to_go': [node['trusted_node_id'] for node in network[:min(5, network_size)]],
+        'discovered_network': network,
+        'timeout_budget': 10,
+    }
+
+
+def run(quick: bool) -> list[dict]:
+    results = []
+
+    for network_size in NETWORK_SIZES:
+        if quick and network_size > 1000:
+            continue
+
+        payload = build_ext_keys_payload(network_size)
+
+        results.append(measure(
+            'ExternalKeysRequest.validate',
+            {'discovered_network': network_size},
+            lambda: ExternalKeysRequest.model_validate(payload)
+        ))
+
+    return results
@@ -0,0 +1,33 @@
+import base64
+import os
+
+from app.internal.key_material import xor_keys
+
+from benchmarks.harness import measure
+
+KEY_SIZES = [64, 256, 1024, 8192]
+
+
+def receive_and_forward(xor_key: str, kme_key: str, next_link_material: bytes) -> str:
+    # What ext_keys does with a key at an intermediate hop: decrypt it with the key of the incoming link, and encrypt
+    # it with the key of the outgoing one
+    key_material = xor_keys(base64.b64decode(xor_key), base64.b64decode(kme_key))
+
+    return base64.b64encode(xor_keys(key_material, next_link_material)).decode('ascii')
+
+
+def run(quick: bool) -> list[dict]:
+    results = []
+
+    for key_size in KEY_SIZES:
+        xor_key = base64.b64encode(os.urandom(key_size // 8)).decode('ascii')
+        kme_key = base64.b64encode(os.urandom(key_size // 8)).decode('ascii')
+        next_link_material = os.urandom(key_size // 8)
+
+        results.append(measure(
+            'ext_keys.xor_base64',
+            {'key_size': key_size},
+            lambda: receive_and_forward(xor_key, kme_key, next_link_material)
+        ))
+
+    return results
@@ -0,0 +1,83 @@
+import random
+
+from app.internal.djikstras_algorithm import dijkstra_algorithm
+from app.internal.graph import Graph
+from app.internal.path_finder import find_shortest_path
+from app.models.discover_requests import WalkedNode
+
+from benchmarks.harness import measure
+
+NODE_COUNTS = [10, 100, 1000, 10000]
+
+
+def generate_network(node_count: int, degree: int = 4, seed: int = 0) -> list[WalkedNode]:
+    """
+    A ring of trusted nodes with random chords, so that it is connected and each node has about the given number of
+    neighbours. The distances are those discovery would report, walking from the first node.
+    """
+    rng = random.Random(seed)
+    ids = [f'tn-{index}' for index in range(node_count)]
+    neighbours: list[set[int]] = [set() for _ in range(node_count)]
+
+    for index in range(node_count):
+        neighbours[index].add((index + 1) % node_count)
+        neighbours[(index + 1) % node_count].add(index)
+
+    for _ in range(node_count * max(0, degree - 2) // 2):
+        a, b = rng.randrange(node_count), rng.randrange(node_count)
+
+        if a != b:
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+
+    distances = {0: 0}
+    queue = [0]
+
+    for index in queue:
+        for neighbour in neighbours[index]:
+            if neighbour not in distances:
+                distances[neighbour] = distances[index] + 1
+                queue.append(neighbour)
+
+    return [
+        WalkedNode(
+            trusted_node_id=ids[index],
+            kme_ids=[f'kme-{index}-{neighbour}' for neighbour in sorted(neighbours[index])],
+            sae_ids=[f'sae-{index}'],
+            trusted_node_ids=[ids[neighbour] for neighbour in sorted(neighbours[index])],
+            distance=distances[index]
+        )
+        for index in range(node_count)
+    ]
+
+
+def run(quick: bool) -> list[dict]:
+    results = []
+
+    for node_count in NODE_COUNTS:
+        if quick and node_count > 1000:
+            continue
+
+        network = generate_network(node_count)
+        target = network[node_count // 2].trusted_node_id
+
+        results.append(measure(
+            'find_shortest_path',
+            {'nodes': node_count},
+            lambda: find_shortest_path(network[0].trusted_node_id, target, network),
+            repeat=3 if node_count > 1000 else 5
+        ))
+
+        graph = Graph(
+            [node.trusted_node_id for node in network],
+            {node.trusted_node_id: {tn_id: max(1, node.distance) for tn_id in node.trusted_node_ids} for node in network}
+        )
+
+        results.append(measure(
+            'dijkstra_algorithm',
+            {'nodes': node_count},
+            lambda: dijkstra_algorithm(graph=graph, start_node=network[0].trusted_node_id),
+            repeat=3 if node_count > 1000 else 5
+        ))
+
+    return results
@@ -0,0 +1,52 @@
+from app.config import AttachedSaes, get_settings, replace_settings
+from app.dependencies import validate_sae_id_from_tls_cert
+from app.internal.certificates import load_certificate_identity, refresh_sae_identities
+from app.internal.client_identity import ClientIdentity
+
+from benchmarks.harness import BENCHMARK_SAE_ID, measure
+
+SAE_COUNTS = [1, 10, 100, 1000, 10000]
+
+
+def validate(client: ClientIdentity):
+    # The dependency does not await anything, so it is driven to completion without an event loop
+    coroutine = validate_sae_id_from_tls_cert(client)
+
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        return
+
+    raise RuntimeError('The SAE validation was expected to complete without waiting')
+
+
+def run(quick: bool) -> list[dict]:
+    results = []
+    original_settings = get_settings()
+    benchmark_sae = next(sae for sae in original_settings.attached_saes if sae.sae_id == BENCHMARK_SAE_ID)
+    client = ClientIdentity(*load_certificate_identity(benchmark_sae.sae_cert))
+
+    try:
+        for sae_count in SAE_COUNTS:
+            if quick and sae_count > 1000:
+                continue
+
+            # The calling SAE is the last one, so all the others are looked at first. They share its certificate
+            # file, only the matching SAE has its certificate checked
+            saes = [
+                AttachedSaes(sae_id=f'sae-{index}', sae_cert=benchmark_sae.sae_cert) for index in range(sae_count - 1)
+            ]
+            saes.append(benchmark_sae)
+
+            replace_settings(original_settings.model_copy(update={'attached_saes': saes}))
+            refresh_sae_identities(saes)
+
+            results.append(measure(
+                'validate_sae_id_from_tls_cert',
+                {'attached_saes': sae_count},
+                lambda: validate(client)
+            ))
+    finally:
+        replace_settings(original_settings)
+
+    return results
@@ -1,9 +1,16 @@
 import argparse
+import asyncio
 import ssl
 
 import uvicorn
 
 from app.config import Settings
+from app.internal.client_identity import ClientIdentityProtocol
+
+
+async def serve(*servers: uvicorn.Server):
+    await asyncio.gather(*(server.serve() for server in servers))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -16,14 +23,27 @@ if __name__ == '__main__':
 
     settings = Settings()
 
-    uvicorn.run(
-        'app.main:app',
+    options = dict(
         host='0.0.0.0',
         port=args.port,
-        reload=args.reload,
+        http=ClientIdentityProtocol,
         ssl_cert_reqs=ssl.CERT_REQUIRED,
         ssl_version=ssl.PROTOCOL_TLSv1_2,
         ssl_keyfile=settings.server_key_file,
         ssl_certfile=settings.server_cert_file,
         ssl_ca_certs=settings.ca_file
     )
+
+    if settings.unix_socket is None or args.reload:
+        uvicorn.run('app.main:app', reload=args.reload, **options)
+    else:
+        # The same application is served on the Unix socket too, its lifespan is run by the TLS server only
+        asyncio.run(serve(
+            uvicorn.Server(uvicorn.Config('app.main:app', **options)),
+            uvicorn.Server(uvicorn.Config(
+                'app.main:app',
+                uds=settings.unix_socket,
+                http=ClientIdentityProtocol,
+                lifespan='off'
+            ))
+        ))
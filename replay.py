@@ -0,0 +1,192 @@
+import argparse
+import json
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+
+
+def parse_mapping(values: list[str], name: str) -> dict[str, str]:
+    mapping = {}
+
+    for value in values:
+        if '=' not in value:
+            raise SystemExit(f'--{name} must be given as <id>=<value>, got: {value}')
+
+        key, value = value.split('=', 1)
+        mapping[key] = value
+
+    return mapping
+
+
+def load_records(capture_file: str, include_kmapi: bool) -> list[dict]:
+    records = []
+
+    with open(capture_file, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+
+            # Hops between trusted nodes are caused by the SAE requests, so replaying them would duplicate the load
+            if record['path'].startswith('/api/v1/kmapi/') and not include_kmapi:
+                continue
+
+            records.append(record)
+
+    return sorted(records, key=lambda record: record['timestamp'])
+
+
+def endpoint_name(record: dict) -> str:
+    # /api/v1/keys/sae-b/enc_keys -> GET keys/*/enc_keys
+    parts = record['path'].removeprefix('/api/v1/').split('/')
+
+    if parts[0] == 'keys' and len(parts) == 3:
+        parts[1] = '*'
+
+    return f'{record["method"]} {"/".join(parts)}'
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Replayer:
+    def __init__(self, args: argparse.Namespace):
+        self.targets = parse_mapping(args.node_target, 'node-target')
+        self.identities = {
+            client: tuple(value.split(':', 1))
+            for client, value in parse_mapping(args.identity, 'identity').items()
+        }
+
+        self.default_target = args.target
+        self.default_identity = (args.cert, args.key) if args.cert and args.key else None
+
+        self.timeout = args.timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, Counter] = defaultdict(Counter)
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._local.session.verify = False
+
+        return self._local.session
+
+    def send(self, record: dict):
+        endpoint = endpoint_name(record)
+
+        target = self.targets.get(record['node'], self.default_target)
+        identity = self.identities.get(record['client'], self.default_identity)
+
+        query = f'?{record["query"]}' if record['query'] else ''
+
+        started = time.perf_counter()
+
+        try:
+            response = self._session().request(
+                method=record['method'],
+                url=f'{target}{record["path"]}{query}',
+                json=record['body'],
+                cert=identity,
+                timeout=self.timeout,
+            )
+
+            outcome = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            outcome = type(e).__name__
+
+        latency = time.perf_counter() - started
+
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.outcomes[endpoint][outcome] += 1
+
+    def report(self, records: list[dict], elapsed: float):
+        captured = defaultdict(list)
+
+        for record in records:
+            captured[endpoint_name(record)].append(record['duration'])
+
+        print(f'Replayed {len(records)} requests in {elapsed:.2f} s ({len(records) / max(elapsed, 1e-9):.1f} req/s)')
+
+        for endpoint, latencies in sorted(self.latencies.items()):
+            print()
+            print(endpoint)
+            print(f'  requests: {len(latencies)}')
+            print(
+                '  latency ms: '
+                f'p50 {percentile(latencies, 0.5) * 1000:.1f}, '
+                f'p90 {percentile(latencies, 0.9) * 1000:.1f}, '
+                f'p99 {percentile(latencies, 0.99) * 1000:.1f}, '
+                f'max {max(latencies) * 1000:.1f}, '
+                f'mean {statistics.fmean(latencies) * 1000:.1f}'
+            )
+            print(f'  captured latency ms: p50 {percentile(captured[endpoint], 0.5) * 1000:.1f}')
+            print(f'  outcomes: {dict(self.outcomes[endpoint])}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays traffic captured with the traffic_capture_file setting')
+
+    parser.add_argument('capture_file', type=str, help='JSONL file written by the trusted node')
+    parser.add_argument('-t', '--target', type=str, default='https://localhost:9000',
+                        help='Trusted node to send the requests to')
+    parser.add_argument('--node-target', action='append', default=[],
+                        help='Send the requests captured on a node elsewhere, e.g. tn-1-a2b2=https://localhost:9000')
+    parser.add_argument('--cert', type=str, help='Client certificate to use, when no --identity matches')
+    parser.add_argument('--key', type=str, help='Client certificate key to use, when no --identity matches')
+    parser.add_argument('--identity', action='append', default=[],
+                        help='Client certificate per captured client, e.g. sae-a=certs/sae-a.crt:certs/sae-a.key')
+    parser.add_argument('-r', '--rate', type=str, default='1',
+                        help='Replay speed as a multiple of the captured rate (1, 2, 10, ...) or "max"')
+    parser.add_argument('-c', '--concurrency', type=int, default=32, help='Maximum requests in flight')
+    parser.add_argument('--timeout', type=float, default=30, help='Timeout of a single request in seconds')
+    parser.add_argument('--include-kmapi', action='store_true',
+                        help='Also replay the requests between trusted nodes, not only those of the SAEs')
+
+    args = parser.parse_args()
+
+    urllib3.disable_warnings()
+
+    records = load_records(args.capture_file, args.include_kmapi)
+
+    if len(records) == 0:
+        raise SystemExit('Nothing to replay')
+
+    rate = None if args.rate == 'max' else float(args.rate)
+
+    if rate is not None and rate <= 0:
+        raise SystemExit('--rate must be above 0 or "max"')
+
+    replayer = Replayer(args)
+
+    first_timestamp = records[0]['timestamp']
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for record in records:
+            if rate is not None:
+                delay = (record['timestamp'] - first_timestamp) / rate - (time.perf_counter() - started)
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            executor.submit(replayer.send, record)
+
+    replayer.report(records, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
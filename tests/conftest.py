@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from benchmarks.harness import generate_certificate
+
+TRUSTED_NODE_ID = 'tn-b'
+PEER_TRUSTED_NODE_ID = 'tn-a'
+SAE_ID = 'sae-b'
+PEER_SAE_ID = 'sae-a'
+KME_ID = 'kme-b'
+PEER_KME_ID = 'kme-a'
+
+
+def _prepare_settings(directory: str) -> str:
+    # A trusted node whose KME and peer run in this process, the settings are read once the app is imported
+    cert_file, key_file, _ = generate_certificate(directory, TRUSTED_NODE_ID)
+    sae_cert_file, _, _ = generate_certificate(directory, SAE_ID)
+
+    settings_file = os.path.join(directory, 'settings.json')
+
+    with open(settings_file, 'w', encoding='utf-8') as file:
+        json.dump({
+            'id': TRUSTED_NODE_ID,
+            'server_cert_file': cert_file,
+            'server_key_file': key_file,
+            'ca_file': cert_file,
+            'min_key_size': 64,
+            'max_key_size': 256,
+            'default_key_size': 128,
+            'max_key_count': 1000,
+            'max_keys_per_request': 10,
+            'attached_kmes': [{
+                'url': f'https://{KME_ID}',
+                'kme_id': KME_ID,
+                'linked_to': PEER_KME_ID,
+                'kme_cert': cert_file,
+                'sae_cert': cert_file,
+                'sae_key': key_file,
+                'distance': 0,
+                'transport': {'type': 'asgi', 'app': 'tests.stub_kme:app'}
+            }],
+            'attached_saes': [{'sae_id': SAE_ID, 'sae_cert': sae_cert_file}],
+            'attached_trusted_nodes': [],
+            'warm_up': {'enabled': False}
+        }, file)
+
+    return settings_file
+
+
+sys.argv = [sys.argv[0], '-s', _prepare_settings(tempfile.mkdtemp(prefix='qkd-tests-'))]
+
+
+@pytest.fixture(scope='session')
+def lifecycle():
+    from app.main import app
+
+    # The lifespan runs on an event loop of its own, as uvicorn would run it
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    lifespan = app.router.lifespan_context(app)
+    asyncio.run_coroutine_threadsafe(lifespan.__aenter__(), loop).result()
+
+    yield app.lifecycle
+
+    asyncio.run_coroutine_threadsafe(lifespan.__aexit__(None, None, None), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+@pytest.fixture(scope='session')
+def peer(lifecycle):
+    """The trusted node under test, as called by its peer over the in-process ASGI transport."""
+    from app.internal.client_identity import ClientIdentity
+    from app.internal.transports import AsgiTransport
+
+    transport = AsgiTransport('app.main:app', ClientIdentity(1, PEER_TRUSTED_NODE_ID))
+
+    yield transport
+
+    transport.close()
+
+
+@pytest.fixture
+def stub_kme():
+    from tests import stub_kme
+
+    stub_kme.calls.clear()
+    stub_kme.delay, stub_kme.failures = 0, 0
+
+    yield stub_kme
+
+    stub_kme.delay, stub_kme.failures = 0, 0
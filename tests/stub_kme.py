@@ -0,0 +1,29 @@
+import asyncio
+import base64
+from uuid import UUID
+
+from fastapi import FastAPI, HTTPException
+
+# Key IDs dec_keys was called with, and how the next calls behave
+calls: list[str] = []
+delay: float = 0
+failures: int = 0
+
+app = FastAPI()
+
+
+@app.get('/api/v1/keys/{master_sae_id}/dec_keys')
+async def get_decryption_keys(master_sae_id: str, key_ID: str):
+    global failures
+
+    calls.append(key_ID)
+
+    await asyncio.sleep(delay)
+
+    if failures > 0:
+        failures -= 1
+
+        raise HTTPException(status_code=503, detail='The KME is not available')
+
+    # The same key ID always stands for the same material, as with a real KME link
+    return {'keys': [{'key_ID': key_ID, 'key': base64.b64encode(UUID(key_ID).bytes).decode('ascii')}]}
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import pytest
+import requests
+
+from tests.conftest import KME_ID, PEER_KME_ID, PEER_SAE_ID, PEER_TRUSTED_NODE_ID, SAE_ID, TRUSTED_NODE_ID
+
+
+def _ext_keys_request(key_id: str, hop_sequence: int | None = 1) -> dict:
+    return {
+        'first_key_id': key_id,
+        'key_id': key_id,
+        'initiator_trusted_node_id': PEER_TRUSTED_NODE_ID,
+        'initiator_sae_id': PEER_SAE_ID,
+        'target_trusted_node_id': TRUSTED_NODE_ID,
+        'target_sae_node_id': SAE_ID,
+        'path_to_go': [TRUSTED_NODE_ID],
+        'discovered_network': [
+            {
+                'trusted_node_id': PEER_TRUSTED_NODE_ID,
+                'kme_ids': [PEER_KME_ID, KME_ID],
+                'sae_ids': [PEER_SAE_ID],
+                'trusted_node_ids': [TRUSTED_NODE_ID],
+                'distance': 0
+            },
+            {
+                'trusted_node_id': TRUSTED_NODE_ID,
+                'kme_ids': [KME_ID, PEER_KME_ID],
+                'sae_ids': [SAE_ID],
+                'trusted_node_ids': [PEER_TRUSTED_NODE_ID],
+                'distance': 1
+            }
+        ],
+        'hop_sequence': hop_sequence
+    }
+
+
+def _send_ext_keys(peer, data: dict) -> dict:
+    response = peer.post(f'https://{TRUSTED_NODE_ID}/api/v1/kmapi/v1/ext_keys', timeout=5, json=data)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def test_retried_ext_keys_returns_the_cached_key(peer, stub_kme, lifecycle):
+    key_id = str(uuid4())
+
+    first = _send_ext_keys(peer, _ext_keys_request(key_id))
+    retried = _send_ext_keys(peer, _ext_keys_request(key_id))
+
+    assert retried == first
+    assert stub_kme.calls == [key_id]
+    assert lifecycle.key_manager.get_activated_key_metadata(key_id) is not None
+
+
+def test_concurrent_retry_waits_for_the_first_call(peer, stub_kme):
+    key_id = str(uuid4())
+    stub_kme.delay = 0.3
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, retried = executor.map(lambda _: _send_ext_keys(peer, _ext_keys_request(key_id)), range(2))
+
+    assert retried == first
+    assert stub_kme.calls == [key_id]
+
+
+def test_failed_ext_keys_is_not_cached(peer, stub_kme):
+    key_id = str(uuid4())
+    stub_kme.failures = 1
+
+    with pytest.raises(requests.exceptions.RequestException):
+        _send_ext_keys(peer, _ext_keys_request(key_id))
+
+    assert _send_ext_keys(peer, _ext_keys_request(key_id))['key_ID'] == key_id
+    assert stub_kme.calls == [key_id, key_id]
+
+
+def test_unnumbered_ext_keys_is_not_cached(peer, stub_kme):
+    key_id = str(uuid4())
+
+    _send_ext_keys(peer, _ext_keys_request(key_id, hop_sequence=None))
+    _send_ext_keys(peer, _ext_keys_request(key_id, hop_sequence=None))
+
+    assert stub_kme.calls == [key_id, key_id]
+
+
+def test_idempotency_key_tells_the_end_sae_and_path_apart():
+    from app.routers.kmapi import _get_idempotency_key
+
+    key_ids = [uuid4()]
+    key = _get_idempotency_key('void', PEER_TRUSTED_NODE_ID, key_ids, SAE_ID, [TRUSTED_NODE_ID], 1)
+
+    assert key == _get_idempotency_key('void', PEER_TRUSTED_NODE_ID, key_ids, SAE_ID, [TRUSTED_NODE_ID], 1)
+    assert key != _get_idempotency_key('void', PEER_TRUSTED_NODE_ID, key_ids, PEER_SAE_ID, [TRUSTED_NODE_ID], 1)
+    assert key != _get_idempotency_key('void', PEER_TRUSTED_NODE_ID, key_ids, SAE_ID, [TRUSTED_NODE_ID, 'tn-c'], 1)
+    assert _get_idempotency_key('void', PEER_TRUSTED_NODE_ID, key_ids, SAE_ID, [TRUSTED_NODE_ID], None) is None